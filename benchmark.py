@@ -0,0 +1,223 @@
+# benchmark.py
+#
+# Воспроизводимый бенчмарк конвейера DomainMonitor.check_for_changes.
+#
+# Генерирует синтетические списки доменов, отдаёт их локальным HTTP-сервером,
+# заменяет WHOIS локальным сервером с заданной задержкой, а Telegram - фейковым
+# клиентом, и замеряет каждый этап проверки. Каждый размер списка запускается
+# в отдельном процессе, чтобы пиковый RSS относился только к нему.
+#
+#     python benchmark.py --sizes 10000 100000 1000000 --churn 0.001 --output bench.json
+
+import argparse
+import asyncio
+import gzip
+import json
+import logging
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Tuple
+
+from aiohttp import web
+
+from config import Config
+from database import Database
+from metrics import CHANGES, STAGE_SECONDS
+from domain_monitor import DomainMonitor
+from notifier import Notifier
+from snapshots import SnapshotStore
+from sources import Source
+from whois_client import WhoisClient
+from whois_scheduler import WhoisScheduler
+from whois_service import WhoisService
+
+TLDS = ('com', 'net', 'org', 'ru', 'io')
+
+
+def generate_versions(size: int, churn: float, seed: int) -> Tuple[List[str], List[str]]:
+    """
+    Возвращает предыдущую и текущую версии списка: в текущей доля churn
+    доменов заменена (половина удалена, столько же добавлено).
+    """
+    rng = random.Random(seed)
+    previous = [f"{rng.getrandbits(40):010x}-{i}.{TLDS[i % len(TLDS)]}" for i in range(size)]
+    changed = int(size * churn / 2) if churn > 0 else 0
+    added = [f"new-{rng.getrandbits(40):010x}-{i}.{TLDS[i % len(TLDS)]}" for i in range(changed)]
+    current = previous[changed:] + added
+    rng.shuffle(current)
+    return previous, current
+
+
+class FakeClient:
+    """
+    Замена pyrogram.Client: считает сообщения и ничего не отправляет.
+    """
+
+    def __init__(self):
+        self.messages = 0
+        self.documents = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.messages += 1
+
+    async def send_document(self, chat_id, document, **kwargs):
+        self.documents += 1
+
+
+async def start_whois_server(latency: float):
+    async def handle(reader, writer):
+        query = (await reader.readline()).decode('utf-8', errors='replace').strip().lstrip('=')
+        await asyncio.sleep(latency)
+        writer.write(f"Domain Name: {query}\r\nRegistrant Organization: Bench Org\r\n".encode('utf-8'))
+        await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(handle, '127.0.0.1', 0)
+    return server, f"127.0.0.1:{server.sockets[0].getsockname()[1]}"
+
+
+async def start_http_server(body: bytes):
+    async def handle(request):
+        if request.headers.get('If-None-Match') == '"bench"':
+            return web.Response(status=304)
+        return web.Response(body=body, headers={'ETag': '"bench"'}, content_type='text/plain')
+
+    app = web.Application()
+    app.router.add_get('/domains.lst', handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f"http://127.0.0.1:{port}/domains.lst"
+
+
+def stage_totals() -> Dict[str, float]:
+    """
+    Суммарное время этапов проверки по метрике STAGE_SECONDS, которую ведёт сам DomainMonitor.
+    """
+    return {dict(key)['stage']: round(data[-2], 6) for key, data in sorted(STAGE_SECONDS.values.items())}
+
+
+async def run_single(size: int, churn: float, whois_latency: float, seed: int, compress: bool) -> dict:
+    previous, current = generate_versions(size, churn, seed)
+    body = ("\n".join(current) + "\n").encode('utf-8')
+    if compress:
+        body = gzip.compress(body)
+
+    with tempfile.TemporaryDirectory(prefix='domainsentinel-bench-') as workdir:
+        whois_server, whois_address = await start_whois_server(whois_latency)
+        http_runner, url = await start_http_server(body)
+        Config.ADMIN_USER_IDS = [1]
+        Config.REPORT_DIGEST_MINUTES = 0
+
+        database = Database(os.path.join(workdir, 'bench.db'))
+        await database.connect()
+        await database.apply_changes({domain: "Seed" for domain in previous}, (), 'bench')
+        del previous
+
+        scheduler = WhoisScheduler(concurrency=64, max_concurrency=256, rate=100000, total_concurrency=512)
+        client = WhoisClient(timeout=30, servers={tld: whois_address for tld in TLDS}, scheduler=scheduler)
+        whois_service = WhoisService(timeout=30, database=database, client=client)
+        fake_client = FakeClient()
+        source = Source('bench', url)
+        notifier = Notifier(fake_client)
+        # Фейковый Telegram не ограничивает частоту: паузы между сообщениями в чат
+        # замеряли бы только настройку BROADCAST_PER_CHAT_INTERVAL, а не работу бота
+        notifier.broadcaster.per_chat_interval = 0
+        monitor = DomainMonitor(notifier, database, whois_service, [source])
+        # Версии списка пишутся во временный каталог, а не в каталог запуска
+        monitor.snapshots = SnapshotStore(database, os.path.join(workdir, 'snapshots'))
+        writes_before = database.conn.total_changes
+
+        try:
+            # Проверка целиком, как её запускает планировщик: журнал запуска, снимки,
+            # отчёт до WHOIS и его правки; этапы замеряет сам монитор
+            started = time.perf_counter()
+            await monitor.check_source(source.name)
+            total = time.perf_counter() - started
+            stages = stage_totals()
+            changes = {dict(key)['action']: int(value) for key, value in CHANGES.values.items()}
+
+            # Повторная проверка неизменённого источника должна закончиться на условном запросе
+            started = time.perf_counter()
+            await monitor.check_source(source.name)
+            noop_check = time.perf_counter() - started
+
+            return {
+                "size": size,
+                "churn": churn,
+                "compressed": compress,
+                "whois_latency": whois_latency,
+                "added": changes.get('added', 0),
+                "removed": changes.get('removed', 0),
+                "stages": stages,
+                "total": round(total, 6),
+                "noop_check": round(noop_check, 6),
+                "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                "sqlite_writes": database.conn.total_changes - writes_before,
+                "messages_sent": fake_client.messages,
+                "documents_sent": fake_client.documents,
+                "whois_lookups": whois_service.lookups,
+            }
+        finally:
+            await monitor.close()
+            await database.close()
+            await http_runner.cleanup()
+            whois_server.close()
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ""
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк конвейера check_for_changes")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--churn', type=float, default=0.001, help="Доля изменившихся доменов")
+    parser.add_argument('--whois-latency', type=float, default=0.05, help="Задержка фейкового WHOIS в секундах")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--gzip', action='store_true', help="Отдавать список сжатым gzip")
+    parser.add_argument('--output', help="Файл для результатов в формате JSON")
+    parser.add_argument('--single', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.CRITICAL)
+
+    if args.single:
+        result = asyncio.run(run_single(args.sizes[0], args.churn, args.whois_latency, args.seed, args.gzip))
+        print(json.dumps(result))
+        return
+
+    results = []
+    for size in args.sizes:
+        command = [sys.executable, os.path.abspath(__file__), '--single', '--sizes', str(size),
+                   '--churn', str(args.churn), '--whois-latency', str(args.whois_latency), '--seed', str(args.seed)]
+        if args.gzip:
+            command.append('--gzip')
+        completed = subprocess.run(command, capture_output=True, text=True, check=True)
+        result = json.loads(completed.stdout.strip().splitlines()[-1])
+        results.append(result)
+        print(f"{size}: {result['total']:.2f} с, RSS {result['peak_rss_kb'] // 1024} МБ, "
+              f"записей SQLite {result['sqlite_writes']}", file=sys.stderr)
+
+    report = {"revision": git_revision(), "python": sys.version.split()[0], "results": results}
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
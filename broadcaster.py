@@ -0,0 +1,225 @@
+# broadcaster.py
+
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Iterable, Optional
+
+from pyrogram.enums import ParseMode
+from pyrogram.errors import (
+    ChatWriteForbidden, FloodWait, InputUserDeactivated, InternalServerError, MessageEditTimeExpired,
+    MessageIdInvalid, MessageNotModified, PeerIdInvalid, ServiceUnavailable, UserDeactivated,
+    UserDeactivatedBan, UserIsBlocked
+)
+
+from config import Config
+from metrics import MESSAGES
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Пользователь заблокировал бота или удалил аккаунт: повторять бессмысленно
+PERMANENT_ERRORS = (
+    UserIsBlocked, InputUserDeactivated, UserDeactivated, UserDeactivatedBan, PeerIdInvalid, ChatWriteForbidden
+)
+# Временные сбои Telegram или сети: повторяем с паузой
+TRANSIENT_ERRORS = (InternalServerError, ServiceUnavailable, OSError, asyncio.TimeoutError)
+# Сообщение нельзя изменить: удалено пользователем или слишком старое
+STALE_MESSAGE_ERRORS = (MessageIdInvalid, MessageEditTimeExpired)
+
+MAX_FLOOD_WAITS = 5  # Сколько раз переносим одно сообщение из-за FloodWait
+
+
+class BroadcastResult:
+    def __init__(self, total: int):
+        self.total = total
+        self.sent = 0
+        self.failed = 0
+        self.unsubscribed = 0
+        self.retries = 0
+        self.flood_waits = 0
+        # Идентификаторы отправленных сообщений по чатам, чтобы потом их изменить
+        self.messages: Dict[int, int] = {}
+        self.started = time.monotonic()
+        self.finished = None
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def throughput(self) -> float:
+        return self.sent / self.elapsed if self.elapsed > 0 else 0.0
+
+    def summary(self) -> str:
+        return (
+            f"Рассылка: отправлено {self.sent} из {self.total}, ошибок {self.failed}, "
+            f"отписано {self.unsubscribed}, FloodWait {self.flood_waits}, повторов {self.retries}. "
+            f"Время {self.elapsed:.1f} с, {self.throughput:.1f} сообщ./с."
+        )
+
+
+class Broadcaster:
+    """
+    Параллельная рассылка сообщений с учётом ограничений Telegram.
+
+    Соблюдает общий бюджет сообщений в секунду и минимальный интервал
+    между сообщениями в один чат, переносит сообщения при FloodWait,
+    повторяет отправку при временных сбоях и сообщает о пользователях,
+    заблокировавших бота, через on_blocked.
+
+    :param app: Клиент Pyrogram или любой объект с методом send_message
+    :param on_blocked: Корутина, вызываемая с chat_id недоступного пользователя
+    """
+
+    def __init__(self, app, rate: float = Config.BROADCAST_RATE,
+                 per_chat_interval: float = Config.BROADCAST_PER_CHAT_INTERVAL,
+                 workers: int = Config.BROADCAST_WORKERS, max_retries: int = 3,
+                 on_blocked: Optional[Callable[[int], Awaitable]] = None):
+        self.app = app
+        self.bucket = TokenBucket(rate)
+        self.per_chat_interval = per_chat_interval
+        self.workers = workers
+        self.max_retries = max_retries
+        self.on_blocked = on_blocked
+        # Время, раньше которого нельзя писать в чат; устаревшие записи удаляются
+        self._chat_ready: Dict[int, float] = {}
+        self._paused_until = 0.0
+
+    async def broadcast(self, chat_ids: Iterable[int], text: str,
+                        progress: Optional[Callable[[BroadcastResult], Awaitable]] = None,
+                        progress_interval: float = Config.BROADCAST_PROGRESS_INTERVAL,
+                        unsubscribe: bool = True) -> BroadcastResult:
+        return await self._run(chat_ids, text, progress, progress_interval, unsubscribe)
+
+    async def edit(self, message_ids: Dict[int, int], text: str) -> BroadcastResult:
+        """
+        Заменяет текст ранее отправленных сообщений ({chat_id: message_id}).
+        Правки идут с теми же ограничениями скорости, что и рассылка.
+        """
+        return await self._run(message_ids, text, unsubscribe=False, message_ids=message_ids)
+
+    async def _run(self, chat_ids: Iterable[int], text: str,
+                   progress: Optional[Callable[[BroadcastResult], Awaitable]] = None,
+                   progress_interval: float = Config.BROADCAST_PROGRESS_INTERVAL,
+                   unsubscribe: bool = True, message_ids: Optional[Dict[int, int]] = None) -> BroadcastResult:
+        chat_ids = list(dict.fromkeys(chat_ids))
+        result = BroadcastResult(len(chat_ids))
+        if not chat_ids:
+            result.finished = time.monotonic()
+            return result
+
+        loop = asyncio.get_event_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        for chat_id in chat_ids:
+            queue.put_nowait((chat_id, 0, 0))
+        remaining = len(chat_ids)
+        done = asyncio.Event()
+
+        def finish():
+            nonlocal remaining
+            remaining -= 1
+            if remaining == 0:
+                done.set()
+
+        def requeue(item, delay: float):
+            loop.call_later(max(delay, 0.0), queue.put_nowait, item)
+
+        async def worker():
+            while True:
+                chat_id, attempt, floods = await queue.get()
+                now = time.monotonic()
+                wait = max(self._chat_ready.get(chat_id, 0.0), self._paused_until) - now
+                if wait > 0:
+                    # Чат или вся рассылка на паузе: возвращаем в очередь, не занимая исполнителя
+                    requeue((chat_id, attempt, floods), wait)
+                    continue
+                await self.bucket.acquire()
+                self._chat_ready[chat_id] = time.monotonic() + self.per_chat_interval
+                outcome = await self._send(chat_id, text, result, unsubscribe,
+                                           message_ids.get(chat_id) if message_ids is not None else None)
+                if outcome == 'flood' and floods < MAX_FLOOD_WAITS:
+                    requeue((chat_id, attempt, floods + 1), self._paused_until - time.monotonic())
+                elif outcome == 'retry' and attempt < self.max_retries:
+                    result.retries += 1
+                    requeue((chat_id, attempt + 1, floods), 2 ** attempt)
+                else:
+                    if outcome in ('flood', 'retry'):
+                        result.failed += 1
+                    finish()
+
+        async def reporter():
+            while True:
+                await asyncio.sleep(progress_interval)
+                await progress(result)
+
+        tasks = [asyncio.ensure_future(worker()) for _ in range(min(self.workers, len(chat_ids)))]
+        if progress is not None:
+            tasks.append(asyncio.ensure_future(reporter()))
+        try:
+            await done.wait()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        result.finished = time.monotonic()
+        self._prune_chats()
+        logger.info(result.summary())
+        return result
+
+    async def _send(self, chat_id: int, text: str, result: BroadcastResult, unsubscribe: bool,
+                    message_id: Optional[int] = None) -> str:
+        try:
+            if message_id is not None:
+                await self.app.edit_message_text(chat_id=chat_id, message_id=message_id, text=text,
+                                                 parse_mode=ParseMode.MARKDOWN)
+                result.sent += 1
+                MESSAGES.inc(result='edited')
+                logger.debug(f"Сообщение {message_id} пользователя {chat_id} изменено.")
+                return 'sent'
+            message = await self.app.send_message(chat_id=chat_id, text=text, parse_mode=ParseMode.MARKDOWN)
+            if message is not None:
+                result.messages[chat_id] = message.id
+            result.sent += 1
+            MESSAGES.inc(result='sent')
+            logger.debug(f"Уведомление отправлено пользователю {chat_id}.")
+            return 'sent'
+        except MessageNotModified:
+            result.sent += 1
+            return 'sent'
+        except STALE_MESSAGE_ERRORS as e:
+            result.failed += 1
+            MESSAGES.inc(result='stale')
+            logger.info(f"Сообщение {message_id} пользователя {chat_id} нельзя изменить ({type(e).__name__}).")
+            return 'stale'
+        except FloodWait as e:
+            result.flood_waits += 1
+            MESSAGES.inc(result='flood_wait')
+            delay = float(e.value or 1)
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+            logger.warning(f"FloodWait {delay:.0f} с при отправке пользователю {chat_id}, рассылка приостановлена.")
+            return 'flood'
+        except PERMANENT_ERRORS as e:
+            result.failed += 1
+            MESSAGES.inc(result='blocked')
+            logger.info(f"Пользователь {chat_id} недоступен ({type(e).__name__}).")
+            if unsubscribe and self.on_blocked is not None:
+                try:
+                    await self.on_blocked(chat_id)
+                    result.unsubscribed += 1
+                except Exception as e:
+                    logger.error(f"Не удалось отписать пользователя {chat_id}: {e}")
+            return 'blocked'
+        except TRANSIENT_ERRORS as e:
+            MESSAGES.inc(result='retry')
+            logger.warning(f"Временная ошибка при отправке пользователю {chat_id}: {e}")
+            return 'retry'
+        except Exception as e:
+            result.failed += 1
+            MESSAGES.inc(result='failed')
+            logger.error(f"Не удалось отправить сообщение пользователю {chat_id}: {e}")
+            return 'failed'
+
+    def _prune_chats(self):
+        now = time.monotonic()
+        self._chat_ready = {chat_id: ready for chat_id, ready in self._chat_ready.items() if ready > now}
@@ -11,10 +11,58 @@ class Config:
     API_HASH: str = os.getenv('API_HASH', '')
     BOT_TOKEN: str = os.getenv('BOT_TOKEN', '')
     CHECK_INTERVAL: int = int(os.getenv('CHECK_INTERVAL', '60'))  # в минутах
+    CHECK_ENRICH_BATCH: int = int(os.getenv('CHECK_ENRICH_BATCH', '1000'))  # Доменов между сохранениями прогресса
+    SEED_ENRICH_BATCH: int = int(os.getenv('SEED_ENRICH_BATCH', '500'))  # Доменов в пачке фонового определения организаций
+    SEED_ENRICH_RATE: float = float(os.getenv('SEED_ENRICH_RATE', '20'))  # доменов в секунду, 0 - без ограничения
     LOCAL_SOURCE: bool = os.getenv('LOCAL_SOURCE', 'true').lower() in ('false', '1', 't')
     SOURCE_URL: str = os.getenv('SOURCE_URL', 'https://community.antifilter.download/list/domains.lst')
     SOURCE_PATH: str = os.getenv('SOURCE_PATH', 'domains.lst')  # Путь к локальному файлу
+    SOURCE_LOG_COMPACT_RECORDS: int = int(os.getenv('SOURCE_LOG_COMPACT_RECORDS', '1000'))  # Записей журнала до уплотнения
+    SOURCES_FILE: str = os.getenv('SOURCES_FILE', 'sources.json')  # Список источников; если файла нет - SOURCE_URL/SOURCE_PATH
+    SOURCE_FETCH_CONCURRENCY: int = int(os.getenv('SOURCE_FETCH_CONCURRENCY', '4'))  # Одновременных загрузок источников
+    HTTP_POOL_SIZE: int = int(os.getenv('HTTP_POOL_SIZE', '20'))  # Соединений в общем пуле HTTP
+    HTTP_TIMEOUT: int = int(os.getenv('HTTP_TIMEOUT', '300'))  # в секундах, на всю загрузку источника
     WHOIS_TIMEOUT: int = int(os.getenv('WHOIS_TIMEOUT', '10'))  # в секундах
+    WHOIS_CACHE_TTL: int = int(os.getenv('WHOIS_CACHE_TTL', str(30 * 24 * 3600)))  # в секундах
+    WHOIS_NEGATIVE_TTL: int = int(os.getenv('WHOIS_NEGATIVE_TTL', '3600'))  # в секундах, удваивается при повторных неудачах
+    WHOIS_NEGATIVE_TTL_MAX: int = int(os.getenv('WHOIS_NEGATIVE_TTL_MAX', str(7 * 24 * 3600)))  # в секундах
+    WHOIS_SERVER_CONCURRENCY: int = int(os.getenv('WHOIS_SERVER_CONCURRENCY', '4'))  # Начальный лимит на сервер
+    WHOIS_SERVER_MAX_CONCURRENCY: int = int(os.getenv('WHOIS_SERVER_MAX_CONCURRENCY', '16'))
+    WHOIS_SERVER_RATE: float = float(os.getenv('WHOIS_SERVER_RATE', '2'))  # запросов в секунду на сервер
+    WHOIS_MAX_CONCURRENCY: int = int(os.getenv('WHOIS_MAX_CONCURRENCY', '100'))  # Общий лимит запросов
+    WHOIS_BREAKER_THRESHOLD: int = int(os.getenv('WHOIS_BREAKER_THRESHOLD', '5'))  # Ошибок подряд до отключения
+    WHOIS_BREAKER_COOLDOWN: int = int(os.getenv('WHOIS_BREAKER_COOLDOWN', '60'))  # в секундах
+    WHOIS_BREAKER_COOLDOWN_MAX: int = int(os.getenv('WHOIS_BREAKER_COOLDOWN_MAX', '3600'))  # в секундах
+    # Встроенная копия https://publicsuffix.org/list/public_suffix_list.dat для группировки доменов по eTLD+1
+    PUBLIC_SUFFIX_FILE: str = os.getenv('PUBLIC_SUFFIX_FILE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'public_suffix_list.dat'))
+    WHOIS_MEMORY_CACHE_SIZE: int = int(os.getenv('WHOIS_MEMORY_CACHE_SIZE', '10000'))
+    WHOIS_WORKERS: int = int(os.getenv('WHOIS_WORKERS', '0'))  # Процессов для WHOIS-запросов, 0 - запросы в процессе бота
+    WHOIS_WORKER_BATCH: int = int(os.getenv('WHOIS_WORKER_BATCH', '100'))  # Заданий, которые процесс берёт за раз
+    WHOIS_JOB_VISIBILITY: int = int(os.getenv('WHOIS_JOB_VISIBILITY', '300'))  # в секундах, срок аренды задания
+    WHOIS_JOB_MAX_ATTEMPTS: int = int(os.getenv('WHOIS_JOB_MAX_ATTEMPTS', '3'))  # Попыток до отказа от задания
+    WHOIS_QUEUE_POLL: float = float(os.getenv('WHOIS_QUEUE_POLL', '0.5'))  # в секундах
+    SNAPSHOT_DIR: str = os.getenv('SNAPSHOT_DIR', 'snapshots')  # Каталог версий списков, пусто - версии не сохраняются
+    SNAPSHOT_BASE_EVERY: int = int(os.getenv('SNAPSHOT_BASE_EVERY', '20'))  # Версий между полными снимками
+    SNAPSHOT_KEEP_BASES: int = int(os.getenv('SNAPSHOT_KEEP_BASES', '5'))  # Полных снимков в хранении, не меньше 2
     DATABASE_PATH: str = os.getenv('DATABASE_PATH', 'domains.db')
+    SQLITE_CACHE_SIZE_KB: int = int(os.getenv('SQLITE_CACHE_SIZE_KB', '65536'))  # Кэш страниц SQLite
+    SQLITE_BUSY_TIMEOUT: int = int(os.getenv('SQLITE_BUSY_TIMEOUT', '30'))  # в секундах, ожидание блокировки другого процесса
+    SQLITE_MMAP_SIZE: int = int(os.getenv('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)))  # в байтах
     USERS_FILE: str = 'users.json'
+    COMMAND_GLOBAL_RATE: float = float(os.getenv('COMMAND_GLOBAL_RATE', '20'))  # команд в секунду на всех, 0 - без лимита
+    REPORT_MAX_ENTRIES: int = int(os.getenv('REPORT_MAX_ENTRIES', '500'))  # Строк на раздел, остальное - во вложении
+    USER_REPORT_MAX_ENTRIES: int = int(os.getenv('USER_REPORT_MAX_ENTRIES', '50'))  # Строк на раздел в рассылке подписчикам
+    HISTORY_PAGE_SIZE: int = int(os.getenv('HISTORY_PAGE_SIZE', '50'))  # Событий на страницу /history и /changes
+    SEARCH_PAGE_SIZE: int = int(os.getenv('SEARCH_PAGE_SIZE', '20'))  # Доменов на страницу /find
+    SEARCH_CACHE_SIZE: int = int(os.getenv('SEARCH_CACHE_SIZE', '256'))  # Страниц /find и ответов /lookup в кэше
+    MAX_FILTERS_PER_USER: int = int(os.getenv('MAX_FILTERS_PER_USER', '50'))
+    NOTIFY_BEFORE_ENRICH: bool = os.getenv('NOTIFY_BEFORE_ENRICH', 'true').lower() in ('true', '1', 't')  # Отчёт до WHOIS, организации - правкой
+    REPORT_DIGEST_MINUTES: int = int(os.getenv('REPORT_DIGEST_MINUTES', '0'))  # 0 - дайджест отключён
+    REPORT_DIGEST_MAX_ENTRIES: int = int(os.getenv('REPORT_DIGEST_MAX_ENTRIES', '50'))  # Больше - отчёт сразу
+    BROADCAST_RATE: float = float(os.getenv('BROADCAST_RATE', '25'))  # сообщений в секунду на всех
+    BROADCAST_PER_CHAT_INTERVAL: float = float(os.getenv('BROADCAST_PER_CHAT_INTERVAL', '1'))  # в секундах
+    BROADCAST_WORKERS: int = int(os.getenv('BROADCAST_WORKERS', '20'))
+    BROADCAST_PROGRESS_INTERVAL: int = int(os.getenv('BROADCAST_PROGRESS_INTERVAL', '60'))  # в секундах
+    METRICS_PORT: int = int(os.getenv('METRICS_PORT', '0'))  # Порт эндпоинта /metrics, 0 - отключён
+    METRICS_HOST: str = os.getenv('METRICS_HOST', '127.0.0.1')
     ADMIN_USER_IDS: list = []  # Замените на ваши user_id или добавьте других администраторов
@@ -1,107 +1,1066 @@
 # database.py
 
+import asyncio
 import aiosqlite
+import hashlib
+import sqlite3
 from config import Config
+from metrics import DB_ROWS, DB_SECONDS
+from sources import DEFAULT_SOURCE
+from whois_cache import CacheEntry
+from domain_search import reverse_labels
+from public_suffix import get_public_suffix_list
+import json
 import logging
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Tuple
 
 logger = logging.getLogger(__name__)
 
+SQLITE_MAX_VARIABLES = 900  # Запас до лимита SQLite в 999 параметров на запрос
+DIGEST_MODULUS = 1 << 63  # Отпечаток списка помещается в INTEGER SQLite
+
+
+def domains_digest(domains: Iterable[str], digest: int = 0, sign: int = 1) -> int:
+    """
+    Отпечаток множества доменов: сумма их 63-битных хэшей по модулю. Не зависит
+    от порядка, поэтому при изменениях списка обновляется прибавлением хэшей
+    добавленных доменов (sign=1) и вычитанием удалённых (sign=-1).
+    """
+    for domain in domains:
+        digest += sign * int.from_bytes(hashlib.blake2b(domain.encode('utf-8'), digest_size=8).digest(), 'big')
+    return digest % DIGEST_MODULUS
+
 
 class Database:
     def __init__(self, path=Config.DATABASE_PATH):
         self.path = path
         self.conn = None
+        # Все транзакции записи идут через одно соединение, поэтому сериализуем их
+        self._write_lock = asyncio.Lock()
+        self._tx_owner = None
+        # Растёт при каждом изменении списка доменов: по нему сбрасываются кэши поиска
+        self.domains_version = 0
+        self.search_index = False  # Есть ли триграммный индекс FTS5 для поиска подстрок
 
     async def connect(self):
         try:
-            self.conn = await aiosqlite.connect(self.path)
+            # Транзакциями управляем явно через transaction()
+            # Базу могут делить процессы WHOIS: блокировку записи ждём, а не падаем сразу
+            self.conn = await aiosqlite.connect(self.path, isolation_level=None, timeout=Config.SQLITE_BUSY_TIMEOUT)
+            await self.configure()
             await self.create_tables()
             logger.info("Соединение с базой данных установлено.")
         except Exception as e:
             logger.error(f"Ошибка подключения к базе данных: {e}")
 
+    async def configure(self):
+        """
+        WAL-журнал и ослабленный synchronous: одна fsync на контрольную точку
+        вместо fsync на каждую транзакцию, при этом база остаётся согласованной.
+        """
+        await self.conn.execute("PRAGMA journal_mode=WAL")
+        await self.conn.execute("PRAGMA synchronous=NORMAL")
+        await self.conn.execute(f"PRAGMA cache_size=-{Config.SQLITE_CACHE_SIZE_KB}")
+        await self.conn.execute(f"PRAGMA mmap_size={Config.SQLITE_MMAP_SIZE}")
+        await self.conn.execute("PRAGMA temp_store=MEMORY")
+
+    @asynccontextmanager
+    async def transaction(self):
+        """
+        Открывает транзакцию записи: всё внутри блока применяется целиком или никак.
+        Вложенные вызовы из той же задачи выполняются во внешней транзакции.
+        """
+        task = asyncio.current_task()
+        if self._tx_owner is task:
+            yield
+            return
+        async with self._write_lock:
+            self._tx_owner = task
+            try:
+                await self.conn.execute("BEGIN IMMEDIATE")
+                try:
+                    yield
+                except BaseException:
+                    await self.conn.rollback()
+                    raise
+                await self.conn.commit()
+            finally:
+                self._tx_owner = None
+
     async def create_tables(self):
         try:
-            await self.conn.execute("""
-                CREATE TABLE IF NOT EXISTS domains (
-                    domain TEXT PRIMARY KEY,
-                    organization TEXT
+            async with self.transaction():
+                await self.conn.execute("""
+                    CREATE TABLE IF NOT EXISTS domains (
+                        domain_id INTEGER PRIMARY KEY,
+                        domain TEXT NOT NULL UNIQUE,
+                        organization TEXT
+                    )
+                """)
+                await self.conn.execute("""
+                    CREATE TABLE IF NOT EXISTS whois_cache (
+                        domain TEXT PRIMARY KEY,
+                        organization TEXT,
+                        expires_at REAL,
+                        failures INTEGER NOT NULL DEFAULT 0
+                    )
+                """)
+                # Принадлежность доменов источникам; в domains хранится их объединение
+                await self.conn.execute("""
+                    CREATE TABLE IF NOT EXISTS source_domains (
+                        source TEXT NOT NULL,
+                        domain TEXT NOT NULL,
+                        PRIMARY KEY (source, domain)
+                    ) WITHOUT ROWID
+                """)
+                await self.conn.execute(
+                    "CREATE INDEX IF NOT EXISTS idx_source_domains_domain ON source_domains (domain)"
                 )
-            """)
-            await self.conn.execute("""
-                CREATE TABLE IF NOT EXISTS whois_cache (
-                    domain TEXT PRIMARY KEY,
-                    organization TEXT
+                await self.conn.execute("""
+                    CREATE TABLE IF NOT EXISTS source_state (
+                        source TEXT PRIMARY KEY,
+                        state TEXT NOT NULL
+                    )
+                """)
+                await self.conn.execute("""
+                    CREATE TABLE IF NOT EXISTS subscribers (
+                        user_id INTEGER PRIMARY KEY,
+                        subscribed_at REAL NOT NULL
+                    )
+                """)
+                # Фильтры подписчиков: суффиксы (".ru") и ключевые слова ("bank")
+                await self.conn.execute("""
+                    CREATE TABLE IF NOT EXISTS subscriber_filters (
+                        user_id INTEGER NOT NULL,
+                        kind TEXT NOT NULL,
+                        pattern TEXT NOT NULL,
+                        PRIMARY KEY (user_id, kind, pattern)
+                    ) WITHOUT ROWID
+                """)
+                # Журнал проверок: этап каждого запуска и его изменения, чтобы
+                # прерванная проверка продолжилась с последнего этапа
+                await self.conn.execute("""
+                    CREATE TABLE IF NOT EXISTS check_runs (
+                        run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        source TEXT NOT NULL DEFAULT 'default',
+                        trigger TEXT NOT NULL,
+                        stage TEXT NOT NULL,
+                        started_at REAL NOT NULL,
+                        updated_at REAL NOT NULL
+                    )
+                """)
+                await self.conn.execute("""
+                    CREATE TABLE IF NOT EXISTS check_run_domains (
+                        run_id INTEGER NOT NULL,
+                        domain TEXT NOT NULL,
+                        action TEXT NOT NULL,
+                        organization TEXT,
+                        PRIMARY KEY (run_id, domain)
+                    ) WITHOUT ROWID
+                """)
+                # Сообщения отчёта, отправленного до определения организаций: текст
+                # каждого сообщения хранится один раз, копии по чатам ссылаются на него
+                await self.conn.execute("""
+                    CREATE TABLE IF NOT EXISTS report_pages (
+                        page_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        run_id INTEGER NOT NULL,
+                        text TEXT NOT NULL
+                    )
+                """)
+                await self.conn.execute("CREATE INDEX IF NOT EXISTS idx_report_pages_run ON report_pages (run_id)")
+                await self.conn.execute("""
+                    CREATE TABLE IF NOT EXISTS report_messages (
+                        page_id INTEGER NOT NULL,
+                        chat_id INTEGER NOT NULL,
+                        message_id INTEGER NOT NULL,
+                        PRIMARY KEY (page_id, chat_id)
+                    ) WITHOUT ROWID
+                """)
+                # История изменений: только добавление строк. Индексы покрывают
+                # выборки по домену и по времени с постраничным переходом по ключу
+                await self.conn.execute("""
+                    CREATE TABLE IF NOT EXISTS domain_events (
+                        event_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        domain TEXT NOT NULL,
+                        action TEXT NOT NULL,
+                        source TEXT NOT NULL,
+                        organization TEXT,
+                        created_at REAL NOT NULL,
+                        run_id INTEGER
+                    )
+                """)
+                await self.conn.execute(
+                    "CREATE INDEX IF NOT EXISTS idx_domain_events_domain ON domain_events (domain, event_id)"
                 )
-            """)
-            await self.conn.commit()
+                await self.conn.execute(
+                    "CREATE INDEX IF NOT EXISTS idx_domain_events_time ON domain_events (created_at, event_id)"
+                )
+                # Позиции фоновых заданий, которые продолжаются после перезапуска
+                await self.conn.execute("""
+                    CREATE TABLE IF NOT EXISTS job_progress (
+                        job TEXT PRIMARY KEY,
+                        cursor TEXT NOT NULL,
+                        updated_at REAL NOT NULL
+                    )
+                """)
+                # Очередь WHOIS-заданий для отдельных процессов: задание берётся
+                # в аренду до lease_expires и возвращается в очередь, если процесс
+                # не успел его выполнить. Новые задания - state 'queued' и lease_expires 0
+                await self.conn.execute("""
+                    CREATE TABLE IF NOT EXISTS whois_jobs (
+                        job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        batch_id INTEGER NOT NULL,
+                        domain TEXT NOT NULL,
+                        state TEXT NOT NULL DEFAULT 'queued',
+                        lease_owner TEXT,
+                        lease_expires REAL NOT NULL DEFAULT 0,
+                        attempts INTEGER NOT NULL DEFAULT 0,
+                        organization TEXT
+                    )
+                """)
+                await self.conn.execute(
+                    "CREATE INDEX IF NOT EXISTS idx_whois_jobs_batch ON whois_jobs (batch_id, state)"
+                )
+                await self.conn.execute(
+                    "CREATE INDEX IF NOT EXISTS idx_whois_jobs_lease ON whois_jobs (state, lease_expires)"
+                )
+                # Версии списков источников; сами списки и изменения лежат в файлах SNAPSHOT_DIR
+                await self.conn.execute("""
+                    CREATE TABLE IF NOT EXISTS snapshots (
+                        source TEXT NOT NULL,
+                        version INTEGER NOT NULL,
+                        kind TEXT NOT NULL,
+                        run_id INTEGER,
+                        domains INTEGER NOT NULL,
+                        added INTEGER NOT NULL DEFAULT 0,
+                        removed INTEGER NOT NULL DEFAULT 0,
+                        created_at REAL NOT NULL,
+                        digest INTEGER,
+                        PRIMARY KEY (source, version, kind)
+                    ) WITHOUT ROWID
+                """)
+                # Отпечаток списка каждого источника (domains_digest) обновляется вместе
+                # с source_domains: по нему проверяется, что снимок совпадает с базой
+                await self.conn.execute("""
+                    CREATE TABLE IF NOT EXISTS source_digests (
+                        source TEXT PRIMARY KEY,
+                        digest INTEGER NOT NULL
+                    )
+                """)
+                await self._migrate_whois_cache()
+                await self._migrate_sources()
+                await self._migrate_domain_search()
+                await self._migrate_domain_ids()
+                await self._migrate_source_digests()
+            await self._create_search_index()
             logger.info("Таблицы в базе данных созданы или уже существуют.")
         except Exception as e:
             logger.error(f"Ошибка при создании таблиц: {e}")
 
-    async def get_all_domains(self) -> set:
+    async def _migrate_whois_cache(self):
+        # Кэш старого формата не содержал сроков жизни: добавляем колонки,
+        # старым записям даём полный TTL, а "Неизвестно" отправляем на повторный запрос
+        cursor = await self.conn.execute("PRAGMA table_info(whois_cache)")
+        columns = {row[1] for row in await cursor.fetchall()}
+        if "expires_at" in columns:
+            return
+        await self.conn.execute("ALTER TABLE whois_cache ADD COLUMN expires_at REAL")
+        await self.conn.execute("ALTER TABLE whois_cache ADD COLUMN failures INTEGER NOT NULL DEFAULT 0")
+        now = time.time()
+        await self.conn.execute(
+            "UPDATE whois_cache SET organization = NULL, expires_at = ?, failures = 1 "
+            "WHERE organization IS NULL OR organization = 'Неизвестно'",
+            (now,)
+        )
+        await self.conn.execute(
+            "UPDATE whois_cache SET expires_at = ? WHERE expires_at IS NULL",
+            (now + Config.WHOIS_CACHE_TTL,)
+        )
+        logger.info("Таблица whois_cache переведена на формат со сроками жизни.")
+
+    async def _migrate_sources(self):
+        # До поддержки нескольких источников все домены принадлежали одному
+        cursor = await self.conn.execute("PRAGMA table_info(check_runs)")
+        if "source" not in {row[1] for row in await cursor.fetchall()}:
+            await self.conn.execute("ALTER TABLE check_runs ADD COLUMN source TEXT NOT NULL DEFAULT 'default'")
+        cursor = await self.conn.execute("SELECT EXISTS (SELECT 1 FROM source_domains)")
+        if (await cursor.fetchone())[0]:
+            return
+        cursor = await self.conn.execute(
+            "INSERT INTO source_domains (source, domain) SELECT ?, domain FROM domains",
+            (DEFAULT_SOURCE,)
+        )
+        if cursor.rowcount > 0:
+            logger.info(f"Домены ({cursor.rowcount}) отнесены к источнику {DEFAULT_SOURCE}.")
+
+    async def _migrate_source_digests(self):
+        # Снимки, записанные до появления отпечатков, получают NULL и при запуске пересоздаются
+        cursor = await self.conn.execute("PRAGMA table_info(snapshots)")
+        if "digest" not in {row[1] for row in await cursor.fetchall()}:
+            await self.conn.execute("ALTER TABLE snapshots ADD COLUMN digest INTEGER")
+        # Отпечатки списков, сохранённых до появления таблицы, считаются один раз полным проходом
+        cursor = await self.conn.execute("SELECT EXISTS (SELECT 1 FROM source_digests)")
+        if (await cursor.fetchone())[0]:
+            return
+        cursor = await self.conn.execute("SELECT DISTINCT source FROM source_domains")
+        for source, in await cursor.fetchall():
+            digest = 0
+            async for batch in self.iter_domains(source):
+                digest = domains_digest(batch, digest)
+            await self.conn.execute("INSERT INTO source_digests (source, digest) VALUES (?, ?)", (source, digest))
+            logger.info(f"Посчитан отпечаток списка источника {source}.")
+
+    async def _migrate_domain_search(self):
+        # Метки домена в обратном порядке ("com.example.www.") для поиска по суффиксу
+        # диапазоном индекса; старые строки заполняются пачками по rowid
+        cursor = await self.conn.execute("PRAGMA table_info(domains)")
+        if "reversed" not in {row[1] for row in await cursor.fetchall()}:
+            await self.conn.execute("ALTER TABLE domains ADD COLUMN reversed TEXT")
+            last = 0
+            while True:
+                cursor = await self.conn.execute(
+                    "SELECT rowid, domain FROM domains WHERE rowid > ? ORDER BY rowid LIMIT 50000", (last,)
+                )
+                rows = await cursor.fetchall()
+                if not rows:
+                    break
+                await self.conn.executemany(
+                    "UPDATE domains SET reversed = ? WHERE rowid = ?",
+                    [(reverse_labels(domain), rowid) for rowid, domain in rows]
+                )
+                last = rows[-1][0]
+            logger.info("В таблицу domains добавлены обращённые имена для поиска по суффиксу.")
+        await self.conn.execute("CREATE INDEX IF NOT EXISTS idx_domains_reversed ON domains (reversed)")
+
+    async def _migrate_domain_ids(self):
+        # Индекс FTS5 ссылается на строки domains по номеру, а неявный rowid таблицы
+        # с текстовым первичным ключом VACUUM может перенумеровать. Таблица
+        # пересоздаётся с явным domain_id (номера сохраняются), индекс поиска - заново
+        cursor = await self.conn.execute("PRAGMA table_info(domains)")
+        if "domain_id" in {row[1] for row in await cursor.fetchall()}:
+            return
+        await self.conn.execute("""
+            CREATE TABLE domains_new (
+                domain_id INTEGER PRIMARY KEY,
+                domain TEXT NOT NULL UNIQUE,
+                organization TEXT,
+                reversed TEXT
+            )
+        """)
+        await self.conn.execute(
+            "INSERT INTO domains_new (domain_id, domain, organization, reversed) "
+            "SELECT rowid, domain, organization, reversed FROM domains"
+        )
+        await self.conn.execute("DROP TABLE IF EXISTS domains_fts")
+        await self.conn.execute("DROP TABLE domains")
+        await self.conn.execute("ALTER TABLE domains_new RENAME TO domains")
+        await self.conn.execute("CREATE INDEX IF NOT EXISTS idx_domains_reversed ON domains (reversed)")
+        logger.info("Таблица domains пересоздана с постоянными номерами строк для индекса поиска.")
+
+    async def _create_search_index(self):
+        """
+        Триграммный индекс FTS5 по именам доменов для поиска подстрок. Индекс
+        ссылается на строки domains; удалённые строки убирает из него триггер,
+        новые добавляет apply_changes одним запросом на пачку. Если SQLite
+        собран без FTS5 или старше 3.34, поиск подстрок идёт перебором таблицы.
+        """
         try:
-            cursor = await self.conn.execute("SELECT domain FROM domains")
-            rows = await cursor.fetchall()
-            return set(row[0] for row in rows)
-        except Exception as e:
-            logger.error(f"Ошибка при получении доменов: {e}")
-            return set()
+            async with self.transaction():
+                cursor = await self.conn.execute(
+                    "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'domains_fts'"
+                )
+                exists = await cursor.fetchone() is not None
+                await self.conn.execute(
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS domains_fts USING fts5("
+                    "domain, content='domains', content_rowid='domain_id', tokenize='trigram')"
+                )
+                # Имя домена не меняется (это первичный ключ), поэтому триггер на UPDATE не нужен
+                await self.conn.execute("""
+                    CREATE TRIGGER IF NOT EXISTS domains_fts_delete AFTER DELETE ON domains BEGIN
+                        INSERT INTO domains_fts (domains_fts, rowid, domain) VALUES ('delete', old.domain_id, old.domain);
+                    END
+                """)
+                if not exists:
+                    await self.conn.execute(
+                        "INSERT INTO domains_fts (rowid, domain) SELECT domain_id, domain FROM domains"
+                    )
+                    logger.info("Построен триграммный индекс доменов для поиска подстрок.")
+            self.search_index = True
+        except sqlite3.OperationalError as e:
+            logger.warning(f"Триграммный индекс FTS5 недоступен, поиск подстрок будет перебирать таблицу: {e}")
 
-    async def add_domain(self, domain: str, organization: str):
+    async def iter_domains(self, source: str, batch_size: int = 50000) -> AsyncIterator[List[str]]:
+        """
+        Отдаёт домены источника пачками по возрастанию, не загружая их все в память.
+        """
+        cursor = await self.conn.execute(
+            "SELECT domain FROM source_domains WHERE source = ? ORDER BY domain", (source,)
+        )
         try:
+            while True:
+                rows = await cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield [row[0] for row in rows]
+        finally:
+            await cursor.close()
+
+    async def get_source_digest(self, source: str) -> int:
+        """
+        Отпечаток списка источника (domains_digest); у пустого списка - 0.
+        """
+        cursor = await self.conn.execute("SELECT digest FROM source_digests WHERE source = ?", (source,))
+        row = await cursor.fetchone()
+        return row[0] if row else 0
+
+    async def set_source_digest(self, source: str, digest: int):
+        """
+        Заменяет отпечаток списка источника посчитанным полным проходом по базе.
+        """
+        async with self.transaction():
             await self.conn.execute(
-                "INSERT OR REPLACE INTO domains (domain, organization) VALUES (?, ?)",
-                (domain, organization)
+                "INSERT OR REPLACE INTO source_digests (source, digest) VALUES (?, ?)", (source, digest)
             )
-            await self.conn.execute(
-                "INSERT OR REPLACE INTO whois_cache (domain, organization) VALUES (?, ?)",
-                (domain, organization)
+
+    async def count_domains(self, source: str) -> int:
+        cursor = await self.conn.execute("SELECT COUNT(*) FROM source_domains WHERE source = ?", (source,))
+        return (await cursor.fetchone())[0]
+
+    async def has_domains(self, source: str) -> bool:
+        cursor = await self.conn.execute("SELECT EXISTS (SELECT 1 FROM source_domains WHERE source = ?)", (source,))
+        return bool((await cursor.fetchone())[0])
+
+    async def get_source_domains(self, source: str, domains: Iterable[str]) -> set:
+        """
+        Возвращает те из переданных доменов, которые сохранены для источника.
+        """
+        result = set()
+        domains = list(domains)
+        for i in range(0, len(domains), SQLITE_MAX_VARIABLES):
+            chunk = domains[i:i + SQLITE_MAX_VARIABLES]
+            placeholders = ", ".join("?" * len(chunk))
+            cursor = await self.conn.execute(
+                f"SELECT domain FROM source_domains WHERE source = ? AND domain IN ({placeholders})",
+                [source, *chunk]
             )
-            await self.conn.commit()
-            logger.debug(f"Домен {domain} добавлен/обновлён в базе данных и кэше WHOIS.")
+            result.update(domain for domain, in await cursor.fetchall())
+        return result
+
+    async def apply_changes(self, added: Dict[str, str], removed: Iterable[str], source: str = DEFAULT_SOURCE):
+        """
+        Применяет набор изменений источника одной транзакцией.
+
+        Домен удаляется из domains, только когда его не осталось ни в одном
+        источнике, а запись кэша WHOIS его регистрируемого домена - когда
+        не осталось и других доменов, которые её используют.
+
+        :param added: Добавленные домены и их организации (None - ещё не определена)
+        :param removed: Удалённые домены
+        """
+        removed = [(domain,) for domain in removed]
+        try:
+            with DB_SECONDS.time(op='apply'):
+                async with self.transaction():
+                    # В отпечаток попадают только строки, которые действительно меняются
+                    # Пока источник пуст (начальное заполнение), проверять нечего
+                    present = await self.get_source_domains(source, added) if await self.has_domains(source) else ()
+                    gone = await self.get_source_domains(source, (domain for domain, in removed))
+                    digest = await self.get_source_digest(source)
+                    digest = domains_digest((domain for domain in added if domain not in present), digest)
+                    digest = domains_digest(gone, digest, sign=-1)
+                    await self.conn.execute(
+                        "INSERT OR REPLACE INTO source_digests (source, digest) VALUES (?, ?)", (source, digest)
+                    )
+                    last_rowid = 0
+                    if self.search_index and added:
+                        cursor = await self.conn.execute("SELECT COALESCE(MAX(domain_id), 0) FROM domains")
+                        last_rowid = (await cursor.fetchone())[0]
+                    await self.conn.executemany(
+                        "INSERT OR IGNORE INTO source_domains (source, domain) VALUES (?, ?)",
+                        [(source, domain) for domain in added]
+                    )
+                    # Организация None (ещё не определена) не затирает уже известную
+                    await self.conn.executemany(
+                        "INSERT INTO domains (domain, organization, reversed) VALUES (?, ?, ?) ON CONFLICT (domain) "
+                        "DO UPDATE SET organization = COALESCE(excluded.organization, organization)",
+                        [(domain, organization, reverse_labels(domain)) for domain, organization in added.items()]
+                    )
+                    if self.search_index and added:
+                        # Новые строки получают domain_id больше прежнего максимума: индексируем их
+                        # одним запросом, это в разы быстрее триггера на каждую строку
+                        await self.conn.execute(
+                            "INSERT INTO domains_fts (rowid, domain) SELECT domain_id, domain FROM domains WHERE domain_id > ?",
+                            (last_rowid,)
+                        )
+                    await self.conn.executemany(
+                        "DELETE FROM source_domains WHERE source = ? AND domain = ?",
+                        [(source, domain) for domain, in removed]
+                    )
+                    await self.conn.executemany(
+                        "DELETE FROM domains WHERE domain = ?1 "
+                        "AND NOT EXISTS (SELECT 1 FROM source_domains WHERE domain = ?1)",
+                        removed
+                    )
+                    # Кэш WHOIS хранится по регистрируемому домену (WhoisService.whois_key),
+                    # общему для всех его поддоменов: запись удаляется, только когда в списке
+                    # не осталось ни его самого, ни поддоменов. Сам удалённый домен тоже
+                    # проверяется - так хранились записи до группировки по родителю
+                    await self.conn.executemany(
+                        "DELETE FROM whois_cache WHERE domain = ? "
+                        "AND NOT EXISTS (SELECT 1 FROM domains WHERE reversed >= ? AND reversed < ?)",
+                        [(key, reverse_labels(key), reverse_labels(key)[:-1] + '/')
+                         for key in self._whois_keys(domain for domain, in removed)]
+                    )
+            self.domains_version += 1
+            DB_ROWS.inc(len(added) + len(removed), table='domains')
+            logger.debug(f"Применены изменения: добавлено {len(added)}, удалено {len(removed)} доменов.")
+        except Exception as e:
+            logger.error(f"Ошибка при применении изменений к базе данных: {e}")
+            raise
+
+    @staticmethod
+    def _whois_keys(domains: Iterable[str]) -> set:
+        public_suffixes = get_public_suffix_list()
+        keys = set()
+        for domain in domains:
+            keys.add(domain)
+            keys.add(public_suffixes.registrable_domain(domain) or domain)
+        return keys
+
+    async def add_domain(self, domain: str, organization: str, source: str = DEFAULT_SOURCE):
+        try:
+            async with self.transaction():
+                await self.apply_changes({domain: organization}, (), source)
+                await self.record_events({domain: organization}, {}, source)
+            logger.debug(f"Домен {domain} добавлен/обновлён в базе данных.")
         except Exception as e:
             logger.error(f"Ошибка при добавлении/обновлении домена {domain}: {e}")
 
-    async def remove_domains(self, domains: set):
+    async def remove_domains(self, domains: set, source: str = DEFAULT_SOURCE):
         try:
-            await self.conn.executemany(
-                "DELETE FROM domains WHERE domain = ?",
-                [(domain,) for domain in domains]
-            )
-            await self.conn.executemany(
-                "DELETE FROM whois_cache WHERE domain = ?",
-                [(domain,) for domain in domains]
-            )
-            await self.conn.commit()
+            async with self.transaction():
+                # Организация в истории - последняя известная до удаления
+                removed = dict.fromkeys(domains)
+                removed.update(await self._select_organizations("domains", domains))
+                await self.apply_changes({}, domains, source)
+                await self.record_events({}, removed, source)
             logger.debug(f"Домен(ы) {', '.join(domains)} удалены из базы данных и кэша WHOIS.")
         except Exception as e:
             logger.error(f"Ошибка при удалении доменов {domains}: {e}")
 
-    async def get_cached_whois(self, domain: str) -> str:
-        try:
+    async def _select_organizations(self, table: str, domains: Iterable[str]) -> Dict[str, str]:
+        # Пакетная выборка организаций чанками IN (...) вместо отдельного SELECT на домен
+        result = {}
+        domains = list(domains)
+        for i in range(0, len(domains), SQLITE_MAX_VARIABLES):
+            chunk = domains[i:i + SQLITE_MAX_VARIABLES]
+            placeholders = ", ".join("?" * len(chunk))
             cursor = await self.conn.execute(
-                "SELECT organization FROM whois_cache WHERE domain = ?",
-                (domain,)
+                f"SELECT domain, organization FROM {table} WHERE domain IN ({placeholders})",
+                chunk
             )
-            row = await cursor.fetchone()
-            if row:
-                return row[0]
+            for domain, organization in await cursor.fetchall():
+                if organization:
+                    result[domain] = organization
+        return result
+
+    async def get_domain_info(self, domain: str) -> Optional[Tuple[Optional[str], List[str]]]:
+        """
+        Организация домена и источники, в которых он есть, или None, если домена нет в списке.
+        """
+        cursor = await self.conn.execute("SELECT organization FROM domains WHERE domain = ?", (domain,))
+        row = await cursor.fetchone()
+        if row is None:
             return None
+        cursor = await self.conn.execute(
+            "SELECT source FROM source_domains WHERE domain = ? ORDER BY source", (domain,)
+        )
+        return row[0], [source for source, in await cursor.fetchall()]
+
+    async def find_domains_by_suffix(self, prefix: str, after: Optional[str] = None, include_apex: bool = True,
+                                     limit: int = 20) -> List[Tuple[str, str, Optional[str]]]:
+        """
+        Домены с суффиксом по индексу обращённых имён: строки (reversed, domain, organization).
+
+        :param prefix: Обращённый суффикс с точкой на конце ("com.example.")
+        :param after: Обращённое имя последнего домена предыдущей страницы
+        :param include_apex: Включать ли сам домен суффикса, а не только поддомены
+        """
+        # Все имена с префиксом "com.example." лежат в диапазоне до "com.example/":
+        # '/' следует за '.' в ASCII
+        upper = prefix[:-1] + '/'
+        if after is not None:
+            condition, lower = "reversed > ?", max(after, prefix)
+        else:
+            condition, lower = ("reversed >= ?" if include_apex else "reversed > ?"), prefix
+        cursor = await self.conn.execute(
+            f"SELECT reversed, domain, organization FROM domains WHERE {condition} AND reversed < ? "
+            f"ORDER BY reversed LIMIT ?",
+            (lower, upper, limit)
+        )
+        return [tuple(row) for row in await cursor.fetchall()]
+
+    async def find_domains_by_substring(self, text: str, after: int = 0,
+                                        limit: int = 20) -> List[Tuple[int, str, Optional[str]]]:
+        """
+        Домены, содержащие подстроку (не короче трёх символов для индекса):
+        строки (domain_id, domain, organization) в порядке domain_id после after.
+        """
+        if self.search_index:
+            phrase = '"' + text.replace('"', '""') + '"'
+            cursor = await self.conn.execute(
+                "SELECT d.domain_id, d.domain, d.organization FROM domains_fts f "
+                "JOIN domains d ON d.domain_id = f.rowid "
+                "WHERE domains_fts MATCH ? AND f.rowid > ? ORDER BY f.rowid LIMIT ?",
+                (phrase, after, limit)
+            )
+        else:
+            cursor = await self.conn.execute(
+                "SELECT domain_id, domain, organization FROM domains WHERE domain_id > ? AND instr(domain, ?) > 0 "
+                "ORDER BY domain_id LIMIT ?",
+                (after, text, limit)
+            )
+        return [tuple(row) for row in await cursor.fetchall()]
+
+    async def get_whois_entries(self, domains: Iterable[str]) -> Dict[str, CacheEntry]:
+        """
+        Возвращает записи кэша WHOIS для набора доменов, включая устаревшие:
+        по ним вызывающий код определяет число предыдущих неудач.
+        """
+        result = {}
+        domains = list(domains)
+        try:
+            for i in range(0, len(domains), SQLITE_MAX_VARIABLES):
+                chunk = domains[i:i + SQLITE_MAX_VARIABLES]
+                placeholders = ", ".join("?" * len(chunk))
+                cursor = await self.conn.execute(
+                    f"SELECT domain, organization, expires_at, failures FROM whois_cache "
+                    f"WHERE domain IN ({placeholders})",
+                    chunk
+                )
+                for domain, organization, expires_at, failures in await cursor.fetchall():
+                    result[domain] = CacheEntry(organization, expires_at or 0.0, failures or 0)
+            return result
         except Exception as e:
-            logger.error(f"Ошибка при получении кэша WHOIS для {domain}: {e}")
-            return None
+            logger.error(f"Ошибка при пакетном получении кэша WHOIS: {e}")
+            return result
 
-    async def cache_whois(self, domain: str, organization: str):
+    async def get_domain_organizations(self, domains: Iterable[str]) -> Dict[str, str]:
         try:
-            await self.conn.execute(
-                "INSERT OR REPLACE INTO whois_cache (domain, organization) VALUES (?, ?)",
-                (domain, organization)
+            return await self._select_organizations("domains", domains)
+        except Exception as e:
+            logger.error(f"Ошибка при получении организаций доменов: {e}")
+            return {}
+
+    async def store_whois_entries(self, entries: Dict[str, CacheEntry]):
+        try:
+            with DB_SECONDS.time(op='whois_store'):
+                async with self.transaction():
+                    await self.conn.executemany(
+                        "INSERT OR REPLACE INTO whois_cache (domain, organization, expires_at, failures) "
+                        "VALUES (?, ?, ?, ?)",
+                        [(domain, *entry) for domain, entry in entries.items()]
+                    )
+            DB_ROWS.inc(len(entries), table='whois_cache')
+            logger.debug(f"Кэш WHOIS обновлён для {len(entries)} доменов.")
+        except Exception as e:
+            logger.error(f"Ошибка при пакетном кэшировании WHOIS: {e}")
+
+    async def get_subscribers(self) -> set:
+        try:
+            cursor = await self.conn.execute("SELECT user_id FROM subscribers")
+            return set(row[0] for row in await cursor.fetchall())
+        except Exception as e:
+            logger.error(f"Ошибка при получении подписчиков: {e}")
+            return set()
+
+    async def add_subscribers(self, user_ids: Iterable[int]):
+        now = time.time()
+        async with self.transaction():
+            await self.conn.executemany(
+                "INSERT OR IGNORE INTO subscribers (user_id, subscribed_at) VALUES (?, ?)",
+                [(user_id, now) for user_id in user_ids]
             )
-            await self.conn.commit()
-            logger.debug(f"Кэш WHOIS для {domain} обновлён.")
+
+    async def remove_subscriber(self, user_id: int):
+        async with self.transaction():
+            await self.conn.execute("DELETE FROM subscribers WHERE user_id = ?", (user_id,))
+            await self.conn.execute("DELETE FROM subscriber_filters WHERE user_id = ?", (user_id,))
+
+    async def get_subscriber_filters(self) -> List[Tuple[int, str, str]]:
+        try:
+            cursor = await self.conn.execute("SELECT user_id, kind, pattern FROM subscriber_filters")
+            return [tuple(row) for row in await cursor.fetchall()]
         except Exception as e:
-            logger.error(f"Ошибка при кэшировании WHOIS для {domain}: {e}")
+            logger.error(f"Ошибка при получении фильтров подписчиков: {e}")
+            return []
+
+    async def add_subscriber_filter(self, user_id: int, kind: str, pattern: str):
+        async with self.transaction():
+            await self.conn.execute(
+                "INSERT OR IGNORE INTO subscriber_filters (user_id, kind, pattern) VALUES (?, ?, ?)",
+                (user_id, kind, pattern)
+            )
+
+    async def remove_subscriber_filters(self, user_id: int, kind: Optional[str] = None, pattern: Optional[str] = None):
+        """
+        Удаляет фильтр пользователя или, если он не указан, все его фильтры.
+        """
+        async with self.transaction():
+            if kind is None:
+                await self.conn.execute("DELETE FROM subscriber_filters WHERE user_id = ?", (user_id,))
+            else:
+                await self.conn.execute(
+                    "DELETE FROM subscriber_filters WHERE user_id = ? AND kind = ? AND pattern = ?",
+                    (user_id, kind, pattern)
+                )
+
+    async def create_check_run(self, source: str, trigger: str, added: Iterable[str], removed: Iterable[str]) -> int:
+        """
+        Записывает в журнал новый запуск проверки источника вместе с вычисленной разницей.
+        """
+        now = time.time()
+        async with self.transaction():
+            cursor = await self.conn.execute(
+                "INSERT INTO check_runs (source, trigger, stage, started_at, updated_at) "
+                "VALUES (?, ?, 'diffed', ?, ?)",
+                (source, trigger, now, now)
+            )
+            run_id = cursor.lastrowid
+            await self.conn.executemany(
+                "INSERT INTO check_run_domains (run_id, domain, action) VALUES (?, ?, ?)",
+                [(run_id, domain, 'added') for domain in added] +
+                [(run_id, domain, 'removed') for domain in removed]
+            )
+        return run_id
+
+    async def get_unfinished_run(self, source: str) -> Optional[Tuple[int, str]]:
+        """
+        Возвращает (run_id, этап) последнего незавершённого запуска проверки источника.
+        """
+        cursor = await self.conn.execute(
+            "SELECT run_id, stage FROM check_runs WHERE source = ? AND stage != 'done' "
+            "ORDER BY run_id DESC LIMIT 1",
+            (source,)
+        )
+        row = await cursor.fetchone()
+        return (row[0], row[1]) if row else None
+
+    async def get_run_domains(self, run_id: int) -> Tuple[Dict[str, Optional[str]], Dict[str, Optional[str]]]:
+        """
+        Возвращает добавленные и удалённые домены запуска с уже определёнными организациями
+        (None - организация ещё не определена).
+        """
+        added, removed = {}, {}
+        cursor = await self.conn.execute(
+            "SELECT domain, action, organization FROM check_run_domains WHERE run_id = ?",
+            (run_id,)
+        )
+        async for domain, action, organization in cursor:
+            (added if action == 'added' else removed)[domain] = organization
+        return added, removed
+
+    async def set_run_organizations(self, run_id: int, organizations: Dict[str, str]):
+        async with self.transaction():
+            await self.conn.executemany(
+                "UPDATE check_run_domains SET organization = ? WHERE run_id = ? AND domain = ?",
+                [(organization, run_id, domain) for domain, organization in organizations.items()]
+            )
+            await self.conn.execute("UPDATE check_runs SET updated_at = ? WHERE run_id = ?", (time.time(), run_id))
+
+    async def set_run_stage(self, run_id: int, stage: str):
+        async with self.transaction():
+            await self.conn.execute(
+                "UPDATE check_runs SET stage = ?, updated_at = ? WHERE run_id = ?",
+                (stage, time.time(), run_id)
+            )
+            if stage == 'done':
+                # Изменения завершённого запуска уже в domains, в журнале остаётся только сам запуск
+                await self.conn.execute("DELETE FROM check_run_domains WHERE run_id = ?", (run_id,))
+                await self.conn.execute(
+                    "DELETE FROM report_messages WHERE page_id IN (SELECT page_id FROM report_pages WHERE run_id = ?)",
+                    (run_id,)
+                )
+                await self.conn.execute("DELETE FROM report_pages WHERE run_id = ?", (run_id,))
+
+    async def store_report_pages(self, run_id: int, pages: List[Tuple[str, Dict[int, int]]]):
+        """
+        Сохраняет сообщения отчёта запуска, чтобы дополнить их и после перезапуска.
+        """
+        async with self.transaction():
+            for text, messages in pages:
+                cursor = await self.conn.execute(
+                    "INSERT INTO report_pages (run_id, text) VALUES (?, ?)", (run_id, text)
+                )
+                page_id = cursor.lastrowid
+                await self.conn.executemany(
+                    "INSERT INTO report_messages (page_id, chat_id, message_id) VALUES (?, ?, ?)",
+                    [(page_id, chat_id, message_id) for chat_id, message_id in messages.items()]
+                )
+
+    async def get_report_pages(self, run_id: int) -> List[Tuple[str, Dict[int, int]]]:
+        cursor = await self.conn.execute(
+            "SELECT p.page_id, p.text, m.chat_id, m.message_id FROM report_pages p "
+            "LEFT JOIN report_messages m ON m.page_id = p.page_id WHERE p.run_id = ? ORDER BY p.page_id",
+            (run_id,)
+        )
+        pages: Dict[int, Tuple[str, Dict[int, int]]] = {}
+        for page_id, text, chat_id, message_id in await cursor.fetchall():
+            page = pages.setdefault(page_id, (text, {}))
+            if chat_id is not None:
+                page[1][chat_id] = message_id
+        return list(pages.values())
+
+    async def record_events(self, added: Dict[str, Optional[str]], removed: Dict[str, Optional[str]],
+                            source: str = DEFAULT_SOURCE, run_id: Optional[int] = None):
+        """
+        Дописывает изменения в историю одной пакетной вставкой.
+        Вызывается в той же транзакции, что и применение изменений.
+        """
+        now = time.time()
+        with DB_SECONDS.time(op='events'):
+            async with self.transaction():
+                for action, domains in (('added', added), ('removed', removed)):
+                    await self.conn.executemany(
+                        "INSERT INTO domain_events (domain, action, source, organization, created_at, run_id) "
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        ((domain, action, source, organization, now, run_id)
+                         for domain, organization in domains.items())
+                    )
+        DB_ROWS.inc(len(added) + len(removed), table='domain_events')
+
+    async def get_domain_history(self, domain: str, before: Optional[int] = None, limit: int = 50) -> List[tuple]:
+        """
+        События домена от новых к старым, страница после события before.
+        Возвращает строки (event_id, domain, action, source, organization, created_at).
+        """
+        cursor = await self.conn.execute(
+            "SELECT event_id, domain, action, source, organization, created_at FROM domain_events "
+            "WHERE domain = ? AND event_id < ? ORDER BY event_id DESC LIMIT ?",
+            (domain, before if before is not None else 2 ** 63 - 1, limit)
+        )
+        return [tuple(row) for row in await cursor.fetchall()]
+
+    async def get_events_since(self, since: float, after: Optional[int] = None, limit: int = 50) -> List[tuple]:
+        """
+        События начиная с момента since в хронологическом порядке, страница после события after.
+
+        События записываются под общей блокировкой записи, поэтому порядок
+        event_id совпадает с хронологическим. Индекс по времени нужен только
+        для поиска первого события периода, дальше страницы отсчитываются
+        от event_id последнего показанного события, а не смещением, и каждая
+        читается за одинаковое время независимо от её номера.
+        """
+        if after is None:
+            cursor = await self.conn.execute(
+                "SELECT event_id FROM domain_events WHERE created_at >= ? ORDER BY created_at, event_id LIMIT 1",
+                (since,)
+            )
+            row = await cursor.fetchone()
+            if row is None:
+                return []
+            after = row[0] - 1
+        cursor = await self.conn.execute(
+            "SELECT event_id, domain, action, source, organization, created_at FROM domain_events "
+            "WHERE event_id > ? ORDER BY event_id LIMIT ?",
+            (after, limit)
+        )
+        return [tuple(row) for row in await cursor.fetchall()]
+
+    async def get_unenriched_domains(self, after: str, limit: int) -> List[str]:
+        """
+        Домены без организации после after в порядке первичного ключа.
+        """
+        cursor = await self.conn.execute(
+            "SELECT domain FROM domains WHERE domain > ? AND organization IS NULL ORDER BY domain LIMIT ?",
+            (after, limit)
+        )
+        return [row[0] for row in await cursor.fetchall()]
+
+    async def set_domain_organizations(self, companies: Dict[str, str]):
+        async with self.transaction():
+            await self.conn.executemany(
+                "UPDATE domains SET organization = ? WHERE domain = ? AND organization IS NULL",
+                [(organization, domain) for domain, organization in companies.items()]
+            )
+        DB_ROWS.inc(len(companies), table='domains')
+
+    async def get_job_cursor(self, job: str) -> Optional[str]:
+        cursor = await self.conn.execute("SELECT cursor FROM job_progress WHERE job = ?", (job,))
+        row = await cursor.fetchone()
+        return row[0] if row else None
+
+    async def set_job_cursor(self, job: str, position: Optional[str]):
+        """
+        Сохраняет позицию фонового задания; None - задание завершено.
+        """
+        async with self.transaction():
+            if position is None:
+                await self.conn.execute("DELETE FROM job_progress WHERE job = ?", (job,))
+            else:
+                await self.conn.execute(
+                    "INSERT OR REPLACE INTO job_progress (job, cursor, updated_at) VALUES (?, ?, ?)",
+                    (job, position, time.time())
+                )
+
+    async def enqueue_whois_jobs(self, domains: Iterable[str]) -> int:
+        """
+        Ставит домены в очередь WHOIS одной пачкой. Возвращает номер пачки.
+        """
+        async with self.transaction():
+            cursor = await self.conn.execute("SELECT COALESCE(MAX(batch_id), 0) + 1 FROM whois_jobs")
+            batch_id = (await cursor.fetchone())[0]
+            await self.conn.executemany(
+                "INSERT INTO whois_jobs (batch_id, domain) VALUES (?, ?)",
+                [(batch_id, domain) for domain in domains]
+            )
+        return batch_id
+
+    async def count_pending_whois_jobs(self, batch_id: int) -> int:
+        cursor = await self.conn.execute(
+            "SELECT COUNT(*) FROM whois_jobs WHERE batch_id = ? AND state != 'done'", (batch_id,)
+        )
+        return (await cursor.fetchone())[0]
+
+    async def pop_whois_results(self, batch_id: int) -> Dict[str, Optional[str]]:
+        """
+        Забирает результаты выполненной пачки и удаляет её из очереди.
+        """
+        async with self.transaction():
+            cursor = await self.conn.execute(
+                "SELECT domain, organization FROM whois_jobs WHERE batch_id = ? AND state = 'done'", (batch_id,)
+            )
+            results = {domain: organization for domain, organization in await cursor.fetchall()}
+            await self.conn.execute("DELETE FROM whois_jobs WHERE batch_id = ?", (batch_id,))
+        return results
+
+    async def delete_whois_jobs(self, batch_id: Optional[int] = None):
+        """
+        Удаляет пачку заданий или, без batch_id, всю очередь.
+        """
+        async with self.transaction():
+            if batch_id is None:
+                await self.conn.execute("DELETE FROM whois_jobs")
+            else:
+                await self.conn.execute("DELETE FROM whois_jobs WHERE batch_id = ?", (batch_id,))
+
+    async def claim_whois_jobs(self, owner: str, limit: int, visibility: float,
+                               max_attempts: int) -> List[Tuple[int, str]]:
+        """
+        Берёт в аренду до limit заданий: новые и те, чья аренда истекла.
+        Задания, исчерпавшие попытки, закрываются без результата.
+        """
+        now = time.time()
+        # Проверка без блокировки записи: пустая очередь не мешает другим процессам
+        cursor = await self.conn.execute(
+            "SELECT 1 FROM whois_jobs WHERE state IN ('queued', 'leased') AND lease_expires < ? LIMIT 1", (now,)
+        )
+        if await cursor.fetchone() is None:
+            return []
+        async with self.transaction():
+            await self.conn.execute(
+                "UPDATE whois_jobs SET state = 'done', lease_owner = NULL "
+                "WHERE state = 'leased' AND lease_expires < ? AND attempts >= ?",
+                (now, max_attempts)
+            )
+            cursor = await self.conn.execute(
+                "SELECT job_id, domain FROM whois_jobs "
+                "WHERE state IN ('queued', 'leased') AND lease_expires < ? LIMIT ?",
+                (now, limit)
+            )
+            jobs = [tuple(row) for row in await cursor.fetchall()]
+            await self.conn.executemany(
+                "UPDATE whois_jobs SET state = 'leased', lease_owner = ?, lease_expires = ?, "
+                "attempts = attempts + 1 WHERE job_id = ?",
+                [(owner, now + visibility, job_id) for job_id, _ in jobs]
+            )
+        return jobs
+
+    async def extend_whois_leases(self, owner: str, job_ids: Iterable[int], visibility: float):
+        async with self.transaction():
+            await self.conn.executemany(
+                "UPDATE whois_jobs SET lease_expires = ? WHERE job_id = ? AND lease_owner = ? AND state = 'leased'",
+                [(time.time() + visibility, job_id, owner) for job_id in job_ids]
+            )
+
+    async def complete_whois_jobs(self, owner: str, results: Dict[int, Optional[str]]):
+        """
+        Записывает результаты заданий одной транзакцией. Задания, аренду которых
+        за это время забрал другой процесс, не трогаются.
+        """
+        async with self.transaction():
+            await self.conn.executemany(
+                "UPDATE whois_jobs SET state = 'done', organization = ?, lease_owner = NULL "
+                "WHERE job_id = ? AND lease_owner = ? AND state = 'leased'",
+                [(organization, job_id, owner) for job_id, organization in results.items()]
+            )
+
+    async def release_whois_jobs(self, owner: str):
+        """
+        Возвращает в очередь задания, арендованные процессом, который завершает работу.
+        """
+        async with self.transaction():
+            await self.conn.execute(
+                "UPDATE whois_jobs SET state = 'queued', lease_owner = NULL, lease_expires = 0, "
+                "attempts = attempts - 1 WHERE lease_owner = ? AND state = 'leased'",
+                (owner,)
+            )
+
+    async def get_whois_queue_stats(self) -> Dict[str, int]:
+        cursor = await self.conn.execute("SELECT state, COUNT(*) FROM whois_jobs GROUP BY state")
+        return {state: count for state, count in await cursor.fetchall()}
+
+    async def add_snapshot(self, source: str, version: int, kind: str, run_id: Optional[int],
+                           domains: int, added: int, removed: int, digest: Optional[int]):
+        async with self.transaction():
+            await self.conn.execute(
+                "INSERT OR REPLACE INTO snapshots "
+                "(source, version, kind, run_id, domains, added, removed, created_at, digest) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (source, version, kind, run_id, domains, added, removed, time.time(), digest)
+            )
+
+    async def get_snapshots(self, source: str) -> List[tuple]:
+        """
+        Версии источника по возрастанию: строки
+        (version, kind, run_id, domains, added, removed, created_at, digest).
+        """
+        cursor = await self.conn.execute(
+            "SELECT version, kind, run_id, domains, added, removed, created_at, digest FROM snapshots "
+            "WHERE source = ? ORDER BY version, kind",
+            (source,)
+        )
+        return [tuple(row) for row in await cursor.fetchall()]
+
+    async def get_snapshot_version_at(self, source: str, moment: float) -> Optional[int]:
+        cursor = await self.conn.execute(
+            "SELECT MAX(version) FROM snapshots WHERE source = ? AND created_at <= ?", (source, moment)
+        )
+        return (await cursor.fetchone())[0]
+
+    async def delete_snapshots(self, source: str, oldest: int):
+        """
+        Удаляет версии старше oldest и изменения самой версии oldest: от неё остаётся полный снимок.
+        """
+        async with self.transaction():
+            await self.conn.execute(
+                "DELETE FROM snapshots WHERE source = ?1 AND (version < ?2 OR (version = ?2 AND kind = 'delta'))",
+                (source, oldest)
+            )
+
+    async def get_source_state(self, source: str) -> dict:
+        cursor = await self.conn.execute("SELECT state FROM source_state WHERE source = ?", (source,))
+        row = await cursor.fetchone()
+        return json.loads(row[0]) if row else {}
+
+    async def set_source_state(self, source: str, state: dict):
+        async with self.transaction():
+            await self.conn.execute(
+                "INSERT OR REPLACE INTO source_state (source, state) VALUES (?, ?)",
+                (source, json.dumps(state))
+            )
 
     async def close(self):
         if self.conn:
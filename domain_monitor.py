@@ -1,125 +1,582 @@
 # domain_monitor.py
-import aiofiles
 import aiohttp
-import asyncio
 from whois_service import WhoisService
-from notifier import Notifier
+from notifier import Notifier, SentPage
 from database import Database
 from config import Config
+from metrics import CHANGES, STAGE_SECONDS
+from ratelimit import TokenBucket
+from report import build_change_report
+from sources import Source, load_sources
+from domain_parser import hash_file, iter_domain_batches, iter_file_chunks, iter_response_chunks, spool_chunks
+from domain_set import DomainSet
+from source_log import LogTail, SourceLog, file_stat
+from snapshots import SnapshotStore
+import asyncio
 import logging
 import os
+import tempfile
+import time
+from urllib.parse import urlparse
+from typing import Awaitable, Callable, Dict, List, Optional, Union
 
 logger = logging.getLogger(__name__)
 
+ENRICH_JOB = 'enrich_domains'  # Фоновое определение организаций после начального заполнения
+
 
 class DomainMonitor:
-    def __init__(self, notifier: Notifier, database: Database, whois_service: WhoisService):
+    """
+    Следит за набором источников списков доменов.
+
+    У каждого источника свой интервал, формат и состояние в базе данных.
+    Все источники загружаются через одну HTTP-сессию с общим пулом
+    соединений, одновременно загружается не больше SOURCE_FETCH_CONCURRENCY
+    источников. Домен, встречающийся в нескольких списках, хранится в базе
+    один раз, и организация для него определяется один раз.
+    """
+
+    def __init__(self, notifier: Notifier, database: Database, whois_service: WhoisService,
+                 sources: Optional[List[Source]] = None):
         self.notifier = notifier
         self.database = database
         self.whois_service = whois_service
-        self.semaphore = asyncio.Semaphore(10)  # Ограничение на 10 параллельных запросов
+        self.sources: Dict[str, Source] = {source.name: source for source in (sources or load_sources())}
+        # Источник, в который попадают домены, добавленные администратором вручную
+        self.primary = next(iter(self.sources.values()))
+        self._session = None
+        self._fetch_slots = asyncio.Semaphore(Config.SOURCE_FETCH_CONCURRENCY)
+        # Если первый источник удалённый, команды правят файл SOURCE_PATH
+        self._fallback_log = SourceLog(Config.SOURCE_PATH)
+        self._compaction: Optional[asyncio.Future] = None
+        self._enrichment: Optional[asyncio.Future] = None
+        self._startup: Optional[asyncio.Future] = None
+        self.snapshots = SnapshotStore(database)
+
+    async def fetch_domains(self, source: Source, force: bool = False,
+                            baseline: Optional[Callable[[], Awaitable[DomainSet]]] = None
+                            ) -> Optional[Union[DomainSet, LogTail]]:
+        """
+        Загружает текущий список доменов источника в компактное множество.
 
-    async def fetch_domains(self) -> set:
+        Возвращает None, если источник не изменился с момента последней
+        применённой проверки. Если у локального файла изменился только журнал,
+        возвращаются изменения из его хвоста (LogTail) с тем же методом diff.
+        При force=True условные запросы и сверка хэша отключаются и список
+        загружается всегда.
+
+        :param baseline: Корутина, возвращающая множество для сравнения; вызывается,
+            только если список действительно придётся разбирать
+        """
+        if source.state is None:
+            source.state = await self.database.get_source_state(source.name)
         try:
-            if Config.LOCAL_SOURCE:
-                # Чтение из локального файла
-                if not os.path.exists(Config.SOURCE_PATH):
-                    logger.warning(f"Локальный файл {Config.SOURCE_PATH} не найден. Создаётся новый файл.")
-                    open(Config.SOURCE_PATH, 'w').close()  # Создаём пустой файл
-                async with aiofiles.open(Config.SOURCE_PATH, 'r', encoding='utf-8') as f:
-                    content = await f.read()
-                    domains = set(line.strip() for line in content.splitlines() if line.strip())
-                    logger.info(f"Скачано {len(domains)} доменов из локального файла.")
-                    return domains
-            else:
-                # Чтение из удаленного источника
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(Config.SOURCE_URL) as response:
-                        response.raise_for_status()
-                        text = await response.text()
-                        domains = set(line.strip() for line in text.splitlines() if line.strip())
-                        logger.info(f"Скачано {len(domains)} доменов из источника.")
-                        return domains
+            async with self._fetch_slots:
+                if source.local:
+                    return await self._fetch_local_domains(source, force, baseline)
+                return await self._fetch_remote_domains(source, force, baseline)
         except Exception as e:
-            logger.error(f"Ошибка при скачивании доменов: {e}")
-            return set()
+            logger.error(f"Ошибка при скачивании доменов источника {source.name}: {e}")
+            raise
+
+    async def _fetch_local_domains(self, source: Source, force: bool, baseline) -> Optional[Union[DomainSet, LogTail]]:
+        # Чтение из локального файла и его журнала изменений
+        path = source.location
+        if not os.path.exists(path):
+            logger.warning(f"Локальный файл {path} не найден. Создаётся новый файл.")
+            open(path, 'w').close()  # Создаём пустой файл
+
+        # Если размер и время изменения файла не поменялись, сам файл не читаем:
+        # изменения, внесённые командами, берутся из хвоста журнала
+        stat_key = file_stat(path)
+        if not force and stat_key == source.state.get('stat'):
+            tail = await source.log.read_tail(source.state.get('log_offset', 0))
+            if tail is not None:
+                ops, offset = tail
+                if not ops:
+                    logger.info(f"Локальный файл {path} не изменился с последней проверки.")
+                    return None
+                source.pending_state = dict(source.state, log_offset=offset)
+                return await self._log_tail_changes(source, ops)
+
+        # Сначала только хэшируем файл: при неизменном содержимом разбор не нужен
+        digest = await hash_file(path)
+        log_offset = await source.log.refresh()
+        source.pending_state = {'stat': stat_key, 'digest': digest, 'log_offset': log_offset}
+        if not force and digest == source.state.get('digest') and log_offset == source.state.get('log_offset', 0):
+            # Файл был перезаписан тем же содержимым: запоминаем новый stat
+            await self.commit_source_state(source)
+            logger.info(f"Содержимое локального файла {path} не изменилось с последней проверки.")
+            return None
 
-    async def check_for_changes(self):
+        domains = await DomainSet.build(
+            source.log.batches(),
+            baseline=await baseline() if baseline is not None else None
+        )
+        logger.info(f"Скачано {len(domains)} доменов из локального файла {path}.")
+        return domains
+
+    async def _log_tail_changes(self, source: Source, ops: Dict[str, bool]) -> LogTail:
+        # Записи журнала, уже отражённые в базе (например, /add_domain сразу
+        # добавляет домен и туда), изменениями не считаются
+        present = await self.database.get_source_domains(source.name, ops)
+        added = {domain for domain, listed in ops.items() if listed and domain not in present}
+        removed = {domain for domain, listed in ops.items() if not listed and domain in present}
+        logger.info(f"Прочитано {len(ops)} записей журнала локального файла {source.location}.")
+        return LogTail(added, removed)
+
+    async def _fetch_remote_domains(self, source: Source, force: bool, baseline) -> Optional[DomainSet]:
+        # Чтение из удаленного источника с условным запросом
+        headers = {}
+        if not force:
+            if source.state.get('etag'):
+                headers['If-None-Match'] = source.state['etag']
+            if source.state.get('last_modified'):
+                headers['If-Modified-Since'] = source.state['last_modified']
+
+        session = await self._get_session()
+        # Ответ сначала сохраняется во временный файл с подсчётом хэша: при неизменном
+        # содержимом ни разбор, ни чтение доменов из базы не нужны
+        fd, spool = tempfile.mkstemp(suffix='.download')
+        os.close(fd)
         try:
-            logger.info("Начата проверка на наличие изменений в списке доменов.")
-            current_domains = await self.fetch_domains()
-            previous_domains = await self.database.get_all_domains()
-
-            added = current_domains - previous_domains
-            removed = previous_domains - current_domains
-
-            report = ""
-
-            if added:
-                report += "*Добавлены новые домены:*\n"
-                added_list = sorted(added)
-                # Обработка добавленных доменов параллельно
-                tasks = [self.process_domain(domain, "added") for domain in added_list]
-                results = await asyncio.gather(*tasks, return_exceptions=True)
-                for result in results:
-                    if isinstance(result, str):
-                        report += f"✅ {result}\n"
-                report += "\n"
-
-            if removed:
-                report += "*Удалены домены:*\n"
-                removed_list = sorted(removed)
-                # Обработка удалённых доменов параллельно
-                tasks = [self.process_domain(domain, "removed") for domain in removed_list]
-                results = await asyncio.gather(*tasks, return_exceptions=True)
-                for result in results:
-                    if isinstance(result, str):
-                        report += f"❌ {result}\n"
-                report += "\n"
-
-            if report:
-                await self.notifier.send_message_to_admin(report)
-                # Обновляем базу данных
-                for domain in added:
-                    company = await self.whois_service.get_company_name_async(domain)
-                    await self.database.add_domain(domain, company)
-                await self.database.remove_domains(removed)
-                logger.info("Изменения отправлены администратору и база данных обновлена.")
-            else:
-                report = "Изменений в списке доменов не обнаружено."
-                await self.notifier.send_message_to_admin(report)
-                logger.info("Изменений не обнаружено.")
+            async with session.get(source.location, headers=headers) as response:
+                if response.status == 304:
+                    logger.info(f"Источник {source.name} вернул 304 Not Modified.")
+                    return None
+                response.raise_for_status()
+                digest = await spool_chunks(iter_response_chunks(response), spool)
+                content_type = response.headers.get('Content-Type', '')
+                etag = response.headers.get('ETag')
+                last_modified = response.headers.get('Last-Modified')
+
+            source.pending_state = {'etag': etag, 'last_modified': last_modified, 'digest': digest}
+            if not force and digest == source.state.get('digest'):
+                # Сервер не поддерживает валидаторы, но содержимое то же самое
+                await self.commit_source_state(source)
+                logger.info(f"Содержимое источника {source.name} не изменилось с последней проверки.")
+                return None
+
+            domains = await DomainSet.build(
+                iter_domain_batches(iter_file_chunks(spool), name=urlparse(source.location).path,
+                                    content_type=content_type, normalize=source.normalize),
+                baseline=await baseline() if baseline is not None else None
+            )
+        finally:
+            os.remove(spool)
+
+        logger.info(f"Скачано {len(domains)} доменов из источника {source.name}.")
+        return domains
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        # Одна сессия на всё время работы и все источники: соединения переиспользуются
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=Config.HTTP_POOL_SIZE, ttl_dns_cache=300),
+                timeout=aiohttp.ClientTimeout(total=Config.HTTP_TIMEOUT)
+            )
+        return self._session
+
+    async def close(self):
+        tasks = [self._startup, self._enrichment] + [source.check_task for source in self.sources.values()]
+        for task in tasks:
+            if task is not None and not task.done():
+                task.cancel()
+        await self.snapshots.close()
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    async def commit_source_state(self, source: Source):
+        """
+        Сохраняет валидаторы (ETag, Last-Modified, stat, хэш) последней загрузки источника.
+
+        Вызывается только после того, как изменения применены к базе данных,
+        чтобы сбой посреди проверки не привёл к пропуску изменений.
+        """
+        if source.pending_state is not None:
+            await self.database.set_source_state(source.name, source.pending_state)
+            source.state = source.pending_state
+            source.pending_state = None
+
+    async def stored_domains(self, source: Source) -> DomainSet:
+        """
+        Компактное множество доменов источника, сохранённых в базе данных.
+
+        Если последняя версия в снимках совпадает с базой, множество строится
+        из её сжатых файлов, что в разы быстрее чтения таблицы. Снимок,
+        разошедшийся с базой, перезаписывается её содержимым новой версией.
+        """
+        if self.snapshots.enabled:
+            try:
+                count = await self.database.count_domains(source.name)
+                digest = await self.database.get_source_digest(source.name)
+                batches = await self.snapshots.current(source.name, count, digest)
+                if batches is None and count:
+                    await self.snapshots.resync(source.name, lambda: self.database.iter_domains(source.name))
+                    # Полный проход заменил отпечаток в базе точным
+                    digest = await self.database.get_source_digest(source.name)
+                    batches = await self.snapshots.current(source.name, count, digest)
+                if batches is not None:
+                    return await DomainSet.build(batches(), replay=batches, detect_collisions=True)
+            except Exception as e:
+                logger.error(f"Не удалось прочитать снимок источника {source.name}, чтение из базы: {e}")
+        return await DomainSet.build(
+            self.database.iter_domains(source.name),
+            replay=lambda: self.database.iter_domains(source.name),
+            detect_collisions=True
+        )
+
+    def start_background(self):
+        """
+        Запускает start() фоновым заданием. Ссылка на задание хранится, чтобы
+        его не собрал сборщик мусора и его можно было отменить при остановке.
+        """
+        if self._startup is None or self._startup.done():
+            self._startup = asyncio.ensure_future(self.start())
+
+    async def start(self):
+        """
+        Фоновый запуск: начальное заполнение базы, продолжение прерванных
+        проверок и определения организаций. Команды бота работают всё это время.
+        """
+        try:
+            await self.seed_sources()
+            await self.resume_unfinished_runs()
+            self.start_enrichment()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка при фоновом запуске мониторинга: {e}")
+
+    async def seed_sources(self):
+        """
+        Заполняет базу данных для источников, по которым ещё нет данных,
+        без отчёта об изменениях.
+
+        Домены сохраняются сразу, без организаций; организации определяет
+        фоновое задание (start_enrichment). Проверки источника ждут окончания
+        заполнения на его блокировке.
+        """
+        async def seed(source: Source):
+            async with source.lock:
+                if await self.database.has_domains(source.name):
+                    return
+                logger.info(f"Инициализация списка доменов источника {source.name}.")
+                try:
+                    # Относительно пустого множества сохраняются строки всех доменов
+                    current = await self.fetch_domains(source, force=True, baseline=self._empty_baseline)
+                except Exception:
+                    return
+                with STAGE_SECONDS.time(stage='seed'):
+                    async with self.database.transaction():
+                        await self.database.apply_changes(dict.fromkeys(current.kept), (), source.name)
+                        await self.database.set_job_cursor(ENRICH_JOB, '')
+                await self.commit_source_state(source)
+                logger.info(f"Начальный список доменов источника {source.name} сохранён в базу данных "
+                            f"({len(current.kept)} доменов), организации будут определены в фоне.")
+
+        await asyncio.gather(*(seed(source) for source in self.sources.values()))
+
+    def start_enrichment(self):
+        """
+        Запускает фоновое определение организаций для доменов, сохранённых без них.
+        """
+        if self._enrichment is None or self._enrichment.done():
+            self._enrichment = asyncio.ensure_future(self._enrich_stored_domains())
+
+    async def _enrich_stored_domains(self):
+        # Домены обходятся по первичному ключу, позиция сохраняется после каждой пачки:
+        # после перезапуска работа продолжается с места остановки
+        position = await self.database.get_job_cursor(ENRICH_JOB)
+        if position is None:
+            return
+        batch_size = Config.SEED_ENRICH_BATCH
+        budget = TokenBucket(Config.SEED_ENRICH_RATE, capacity=batch_size) if Config.SEED_ENRICH_RATE > 0 else None
+        enriched = 0
+        logger.info("Начато фоновое определение организаций для доменов из начального списка.")
+        try:
+            while True:
+                batch = await self.database.get_unenriched_domains(position, batch_size)
+                if not batch:
+                    break
+                if budget is not None:
+                    await budget.acquire(len(batch))
+                with STAGE_SECONDS.time(stage='seed_enrich'):
+                    companies = await self.whois_service.get_company_names_async(batch)
+                    position = batch[-1]
+                    async with self.database.transaction():
+                        await self.database.set_domain_organizations(companies)
+                        await self.database.set_job_cursor(ENRICH_JOB, position)
+                enriched += len(batch)
+                logger.debug(f"Фоновое определение организаций: обработано {enriched} доменов, позиция {position}.")
+            await self.database.set_job_cursor(ENRICH_JOB, None)
+            logger.info(f"Фоновое определение организаций завершено, обработано {enriched} доменов.")
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            logger.error(f"Критическая ошибка в проверке изменений: {e}")
-            await self.notifier.send_message_to_admin(f"Произошла критическая ошибка при проверке изменений: {e}")
+            logger.error(f"Ошибка фонового определения организаций (позиция {position}): {e}")
+
+    @staticmethod
+    async def _empty_baseline() -> DomainSet:
+        return DomainSet.empty()
 
-    async def process_domain(self, domain: str, action: str) -> str:
-        async with self.semaphore:
-            company = await self.whois_service.get_company_name_async(domain)
-            logger.debug(f"Обработан домен {domain} ({company})")
-            return f"{domain} ({company})"
+    async def resume_unfinished_runs(self):
+        """
+        Сразу продолжает проверки, прерванные остановкой бота, не дожидаясь планировщика.
+        """
+        for source in self.sources.values():
+            if await self.database.get_unfinished_run(source.name) is not None:
+                logger.info(f"Найдена незавершённая проверка источника {source.name}, она будет продолжена.")
+                self._start_check(source, 'resume')
+
+    async def check_for_changes(self, trigger: str = 'command') -> Dict[str, Optional[int]]:
+        """
+        Проверяет все источники одновременно.
+        Возвращает номера запусков по источникам (None - изменений не было).
+        """
+        names = list(self.sources)
+        run_ids = await asyncio.gather(*(self.check_source(name, trigger) for name in names))
+        return dict(zip(names, run_ids))
+
+    async def check_source(self, name: str, trigger: str = 'schedule') -> Optional[int]:
+        """
+        Запускает проверку источника или присоединяется к уже выполняющейся.
+
+        Одновременные запросы (планировщик, /check) объединяются в один запуск:
+        все вызвавшие дожидаются его и получают один и тот же номер запуска.
+        Возвращает номер запуска или None, если изменений не было.
+        """
+        return await asyncio.shield(self._start_check(self.sources[name], trigger))
+
+    def _start_check(self, source: Source, trigger: str) -> asyncio.Future:
+        # Задание проверки хранится в источнике: по нему присоединяются и отменяют при остановке
+        if source.check_task is None or source.check_task.done():
+            source.check_task = asyncio.ensure_future(self._run_check(source, trigger))
+        else:
+            logger.info(f"Проверка источника {source.name} уже выполняется, запрос ({trigger}) присоединён к ней.")
+        return source.check_task
+
+    async def _run_check(self, source: Source, trigger: str) -> Optional[int]:
+        started = time.perf_counter()
+        run_id = None
+        async with source.lock:
+            try:
+                # Сначала доводим до конца запуск, прерванный сбоем или перезапуском бота
+                unfinished = await self.database.get_unfinished_run(source.name)
+                if unfinished is not None:
+                    run_id, stage = unfinished
+                    logger.info(f"Продолжение прерванной проверки #{run_id} с этапа {stage}.")
+                    await self._resume_run(source, run_id, stage)
+
+                logger.info(f"Начата проверка на наличие изменений в источнике {source.name}.")
+                previous_domains = None
+
+                async def baseline():
+                    # Домены из базы читаются, только если содержимое источника изменилось:
+                    # и локальный файл, и ответ сервера сначала только хэшируются
+                    nonlocal previous_domains
+                    with STAGE_SECONDS.time(stage='db_scan'):
+                        previous_domains = await self.stored_domains(source)
+                    return previous_domains
+
+                with STAGE_SECONDS.time(stage='fetch'):
+                    current_domains = await self.fetch_domains(source, baseline=baseline)
+                if current_domains is None:
+                    await self._report_no_changes(source)
+                    logger.info(f"Источник {source.name} не изменился, проверка завершена без сравнения.")
+                    return run_id
+
+                with STAGE_SECONDS.time(stage='diff'):
+                    added, removed = await current_domains.diff(previous_domains)
+                del current_domains, previous_domains
+
+                if not added and not removed:
+                    await self.commit_source_state(source)
+                    await self._report_no_changes(source)
+                    logger.info(f"Изменений в источнике {source.name} не обнаружено.")
+                    return run_id
+
+                CHANGES.inc(len(added), action='added')
+                CHANGES.inc(len(removed), action='removed')
+                run_id = await self.database.create_check_run(source.name, trigger, added, removed)
+                logger.info(f"Проверка #{run_id} ({source.name}): добавлено {len(added)}, "
+                            f"удалено {len(removed)} доменов.")
+                await self._resume_run(source, run_id, 'diffed')
+                await self.commit_source_state(source)
+                return run_id
+            except Exception as e:
+                logger.error(f"Критическая ошибка в проверке изменений источника {source.name}: {e}")
+                await self.notifier.send_message_to_admin(
+                    f"Произошла критическая ошибка при проверке изменений источника {source.name}: {e}"
+                )
+                return run_id
+            finally:
+                STAGE_SECONDS.observe(time.perf_counter() - started, stage='total')
+
+    async def _resume_run(self, source: Source, run_id: int, stage: str):
+        """
+        Выполняет запуск проверки начиная с этапа stage.
+
+        Этапы: diffed (разница записана в журнал) -> notified (отчёт без
+        организаций отправлен) -> enriched (организации определены) -> applied
+        (база данных обновлена, изменения записаны в историю) -> done
+        (в отправленные сообщения дописаны организации). Каждый этап
+        фиксируется в журнале, поэтому после сбоя повторяется только
+        незавершённый этап. Сообщения, отправленные до сбоя, сохраняются
+        в базе и дополняются после перезапуска.
+
+        Если для источника включён дайджест, изменения всё равно копятся,
+        поэтому отчёт отправляется один раз после определения организаций.
+        """
+        added, removed = await self.database.get_run_domains(run_id)
+        if stage == 'diffed' and self._notify_first(source):
+            with STAGE_SECONDS.time(stage='notify'):
+                await self._send_bare_report(source, run_id, added, removed)
+            await self.database.set_run_stage(run_id, 'notified')
+            stage = 'notified'
+        if stage in ('diffed', 'notified'):
+            with STAGE_SECONDS.time(stage='enrich'):
+                await self._enrich_run(run_id, added, removed)
+            await self.database.set_run_stage(run_id, 'enriched')
+            stage = 'enriched'
+        if stage == 'enriched':
+            with STAGE_SECONDS.time(stage='apply'):
+                # Версия списка записывается в той же транзакции, что и изменения
+                async with self.snapshots.record(source.name, added, removed, run_id):
+                    await self.database.apply_changes(added, removed, source.name)
+                    await self.database.record_events(added, removed, source.name, run_id)
+                    await self.database.set_run_stage(run_id, 'applied')
+            stage = 'applied'
+        if stage == 'applied':
+            pages = await self.database.get_report_pages(run_id)
+            if pages:
+                with STAGE_SECONDS.time(stage='edit'):
+                    await self._complete_report(source, added, removed, pages)
+            else:
+                with STAGE_SECONDS.time(stage='notify'):
+                    await self.send_report(source, added, removed)
+            await self.database.set_run_stage(run_id, 'done')
+        logger.info(f"Проверка #{run_id} завершена: изменения отправлены администратору и база данных обновлена.")
+
+    @staticmethod
+    def _notify_first(source: Source) -> bool:
+        return Config.NOTIFY_BEFORE_ENRICH and source.digest is None
+
+    async def _send_bare_report(self, source: Source, run_id: int,
+                                added: Dict[str, Optional[str]], removed: Dict[str, Optional[str]]):
+        # Отчёт уходит сразу после сравнения, не дожидаясь WHOIS; полный список
+        # с организациями прикладывается позже, в _complete_report
+        title = self._report_title(source)
+        pages = await self.notifier.send_report_to_admin(
+            build_change_report(added, removed, source=title, attach=False)
+        )
+        pages.extend(await self.notifier.send_changes_to_users(added, removed, source=title))
+        await self.database.store_report_pages(run_id, pages)
+        logger.info(f"Проверка #{run_id}: отчёт отправлен до определения организаций ({len(pages)} сообщений).")
+
+    async def _complete_report(self, source: Source, added: Dict[str, str], removed: Dict[str, str],
+                               pages: List[SentPage]):
+        organizations = dict(added)
+        organizations.update(removed)
+        await self.notifier.fill_organizations(pages, organizations)
+        report = build_change_report(added, removed, source=self._report_title(source))
+        if report.attachment is not None:
+            await self.notifier.send_document_to_admin(report.attachment, report.attachment_name,
+                                                       "Полный список изменений")
+
+    async def _enrich_run(self, run_id: int, added: Dict[str, Optional[str]], removed: Dict[str, Optional[str]]):
+        # Организации определяются пачками, и каждая пачка сразу сохраняется в журнал:
+        # после перезапуска WHOIS запрашивается только для оставшихся доменов
+        pending = [domain for domain, organization in added.items() if organization is None]
+        pending.extend(domain for domain, organization in removed.items() if organization is None)
+        batch_size = Config.CHECK_ENRICH_BATCH
+        for i in range(0, len(pending), batch_size):
+            batch = pending[i:i + batch_size]
+            companies = await self.enrich_domains(
+                {domain for domain in batch if domain in added},
+                {domain for domain in batch if domain in removed}
+            )
+            await self.database.set_run_organizations(run_id, companies)
+            for domain, organization in companies.items():
+                (added if domain in added else removed)[domain] = organization
+            logger.debug(f"Проверка #{run_id}: определены организации для {min(i + batch_size, len(pending))} "
+                         f"из {len(pending)} доменов.")
+
+    def _report_title(self, source: Source) -> Optional[str]:
+        # При одном источнике отчёт выглядит как раньше
+        return source.name if len(self.sources) > 1 else None
+
+    async def send_report(self, source: Source, added: Dict[str, str], removed: Dict[str, str]):
+        """
+        Отправляет отчёт об изменениях источника администраторам и подписчикам.
+
+        Если включён дайджест и изменений немного, они копятся и уходят
+        одним отчётом по истечении интервала дайджеста.
+        """
+        digest = source.digest
+        if digest is not None and digest.accepts(len(added) + len(removed)):
+            digest.add(added, removed)
+            if not digest.due():
+                logger.info(f"Изменения источника {source.name} добавлены в дайджест.")
+                return
+            added, removed = digest.flush()
+        elif digest is not None:
+            # Крупный набор изменений уходит сразу, вместе с накопленным дайджестом
+            digest.add(added, removed)
+            added, removed = digest.flush()
+        if added or removed:
+            title = self._report_title(source)
+            await self.notifier.send_report_to_admin(build_change_report(added, removed, source=title))
+            # Подписчики получают только подходящие их фильтрам изменения
+            await self.notifier.send_changes_to_users(added, removed, source=title)
+
+    async def _report_no_changes(self, source: Source):
+        if source.digest is None:
+            title = self._report_title(source)
+            await self.notifier.send_message_to_admin(
+                f"Изменений в списке доменов {title} не обнаружено." if title
+                else "Изменений в списке доменов не обнаружено."
+            )
+        elif source.digest.due():
+            await self.send_report(source, {}, {})
+
+    async def enrich_domains(self, added: set, removed: set = frozenset()) -> Dict[str, str]:
+        """
+        Определяет организации для изменившихся доменов за один проход.
+
+        Для доменов, уже известных по этому или другому источнику, организация
+        берётся из базы данных, WHOIS запрашивается только для оставшихся.
+        Одновременные запросы одного домена из разных источников объединяет
+        WhoisService.
+        """
+        companies = await self.database.get_domain_organizations(added | removed)
+        pending = (added | removed) - companies.keys()
+        companies.update(await self.whois_service.get_company_names_async(pending))
+        logger.debug(f"Определены организации для {len(companies)} доменов.")
+        return companies
 
     async def test_check_for_changes(self):
         """
         Тестовая проверка: добавление и удаление тестового домена.
         """
+        async with self.primary.lock:
+            await self._test_check_for_changes()
+
+    async def _test_check_for_changes(self):
         test_domain = "test-domain-123456789.com"
         logger.info("Начата тестовая проверка изменений.")
 
-        # Получить текущее состояние доменов
-        current_domains = await self.fetch_domains()
-        previous_domains = await self.database.get_all_domains()
-
-        if test_domain in current_domains:
+        # Наличие домена проверяется по индексу локального списка, без его разбора
+        if await self.source_log.contains(test_domain):
             # Если тестовый домен уже существует, удалить его
-            await self.database.remove_domains({test_domain})
+            await self.remove_stored_domains({test_domain})
             # Удаляем из локального файла
             await self.remove_domain_from_source(test_domain)
             logger.info(f"Тестовый домен {test_domain} удалён.")
             report = f"*Тестовое удаление домена:*\n❌ {test_domain} (Тестовая компания)"
         else:
             # Добавить тестовый домен
-            await self.database.add_domain(test_domain, "Тестовая компания")
+            await self.add_stored_domain(test_domain, "Тестовая компания")
             # Добавляем в локальный файл
             await self.add_domain_to_source(test_domain)
             logger.info(f"Тестовый домен {test_domain} добавлен.")
@@ -129,28 +586,86 @@ class DomainMonitor:
         await self.notifier.send_message_to_admin(report)
         logger.info("Тестовая проверка изменений завершена.")
 
-    async def add_domain_to_source(self, domain: str):
+    @property
+    def source_log(self) -> SourceLog:
+        # Список, который правят /add_domain, /remove_domain и тестовая проверка
+        return self.primary.log if self.primary.local else self._fallback_log
+
+    async def add_domain_to_source(self, domain: str) -> Optional[bool]:
         """
-        Добавляет домен в локальный файл.
+        Добавляет домен в локальный список записью в журнал.
+        Возвращает False, если домен уже есть в списке, и None при ошибке.
         """
         try:
-            async with aiofiles.open(Config.SOURCE_PATH, 'a', encoding='utf-8') as f:
-                await f.write(f"{domain}\n")
-            logger.debug(f"Тестовый домен {domain} добавлен в локальный файл.")
+            added = await self.source_log.add(domain)
         except Exception as e:
-            logger.error(f"Ошибка при добавлении тестового домена {domain} в локальный файл: {e}")
+            logger.error(f"Ошибка при добавлении домена {domain} в локальный файл: {e}")
+            return None
+        if added:
+            logger.debug(f"Домен {domain} добавлен в локальный файл.")
+            self._schedule_compaction()
+        return added
 
-    async def remove_domain_from_source(self, domain: str):
+    async def add_stored_domain(self, domain: str, organization: str):
+        """
+        Сохраняет домен, добавленный администратором, в базу новой версией списка.
         """
-        Удаляет домен из локального файла.
+        # В версию попадает только то, что действительно меняется в базе
+        added = [domain] if not await self.database.get_source_domains(self.primary.name, [domain]) else []
+        async with self.snapshots.record(self.primary.name, added, ()):
+            await self.database.add_domain(domain, organization, self.primary.name)
+
+    async def remove_stored_domains(self, domains: set):
+        """
+        Удаляет домены из базы новой версией списка.
+        """
+        removed = await self.database.get_source_domains(self.primary.name, domains)
+        async with self.snapshots.record(self.primary.name, (), removed):
+            await self.database.remove_domains(domains, self.primary.name)
+
+    async def remove_domain_from_source(self, domain: str) -> Optional[bool]:
+        """
+        Удаляет домен из локального списка записью-надгробием в журнал.
+        Возвращает False, если домена нет в списке, и None при ошибке.
+        """
+        try:
+            removed = await self.source_log.remove(domain)
+        except Exception as e:
+            logger.error(f"Ошибка при удалении домена {domain} из локального файла: {e}")
+            return None
+        if removed:
+            logger.debug(f"Домен {domain} удалён из локального файла.")
+            self._schedule_compaction()
+        return removed
+
+    def _schedule_compaction(self):
+        if self.source_log.records < Config.SOURCE_LOG_COMPACT_RECORDS:
+            return
+        if self._compaction is None or self._compaction.done():
+            self._compaction = asyncio.ensure_future(self.compact_source_log())
+
+    async def compact_source_log(self):
+        """
+        Уплотняет журнал локального списка в фоне.
+
+        Если последняя проверка источника уже учла весь журнал, её состояние
+        переносится на новый файл, и следующая проверка не разбирает его заново.
         """
+        log = self.source_log
+        source = self.primary if self.primary.local else None
         try:
-            async with aiofiles.open(Config.SOURCE_PATH, 'r', encoding='utf-8') as f:
-                lines = await f.readlines()
-            async with aiofiles.open(Config.SOURCE_PATH, 'w', encoding='utf-8') as f:
-                for line in lines:
-                    if line.strip().lower() != domain.lower():
-                        await f.write(line)
-            logger.debug(f"Тестовый домен {domain} удалён из локального файла.")
+            if source is None:
+                await log.compact()
+                return
+            async with source.lock:
+                if source.state is None:
+                    source.state = await self.database.get_source_state(source.name)
+                compacted = await log.compact()
+                if compacted is None:
+                    return
+                stat, offset = compacted
+                if stat == source.state.get('stat') and offset == source.state.get('log_offset', 0):
+                    source.state = {'stat': file_stat(log.path), 'digest': await hash_file(log.path), 'log_offset': 0}
+                    await self.database.set_source_state(source.name, source.state)
         except Exception as e:
-            logger.error(f"Ошибка при удалении тестового домена {domain} из локального файла: {e}")
+            logger.error(f"Ошибка при уплотнении журнала локального файла {log.path}: {e}")
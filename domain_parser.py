@@ -0,0 +1,182 @@
+# domain_parser.py
+
+import codecs
+import hashlib
+import logging
+import zlib
+from typing import AsyncIterator, Callable, List, Optional
+
+import aiofiles
+
+try:
+    import brotli  # Необязательная зависимость для списков, сжатых brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024  # Размер блока при чтении HTTP-ответа
+FILE_CHUNK_SIZE = 1024 * 1024  # Размер блока при чтении локального файла
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+def normalize_domain(line: str) -> Optional[str]:
+    """
+    Приводит строку списка к каноническому виду домена.
+
+    Отбрасывает комментарии и пустые строки, приводит к нижнему регистру
+    и переводит интернационализированные имена в punycode.
+    Возвращает None, если строка не содержит домена.
+    """
+    line = line.split('#', 1)[0].strip()
+    if not line or line.startswith(';'):
+        return None
+    domain = line.lower().rstrip('.')
+    if not domain.isascii():
+        try:
+            domain = domain.encode('idna').decode('ascii')
+        except UnicodeError:
+            logger.debug(f"Не удалось преобразовать домен {domain[:50]} в punycode.")
+            return None
+    return domain or None
+
+
+def normalize_hosts_line(line: str) -> Optional[str]:
+    """
+    Разбирает строку в формате hosts ("0.0.0.0 example.com").
+    """
+    fields = line.split('#', 1)[0].split()
+    if len(fields) < 2 or fields[1] in ('localhost', 'localhost.localdomain', 'broadcasthost'):
+        return None
+    return normalize_domain(fields[1])
+
+
+def normalize_adblock_line(line: str) -> Optional[str]:
+    """
+    Разбирает правило блокировки домена в формате Adblock ("||example.com^").
+    Остальные правила (пути, исключения, косметика) пропускаются.
+    """
+    line = line.strip()
+    if not line.startswith('||') or not line.endswith('^'):
+        return None
+    domain = line[2:-1]
+    if not domain or any(c in domain for c in '/*$'):
+        return None
+    return normalize_domain(domain)
+
+
+# Форматы списков, которые можно указать в настройках источника
+PARSERS = {
+    'list': normalize_domain,
+    'hosts': normalize_hosts_line,
+    'adblock': normalize_adblock_line,
+}
+
+# Запись домена строкой списка в каждом из форматов (обратное к PARSERS)
+LINE_FORMATS = {
+    'list': '{}',
+    'hosts': '0.0.0.0 {}',
+    'adblock': '||{}^',
+}
+
+
+def _make_decompressor(name: str, content_type: str, first_chunk: bytes):
+    # gzip определяем по сигнатуре, brotli - по расширению файла или типу содержимого
+    if first_chunk.startswith(GZIP_MAGIC):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if name.lower().endswith('.br') or 'brotli' in content_type.lower():
+        if brotli is None:
+            raise RuntimeError("Для распаковки brotli установите пакет brotli.")
+        return brotli.Decompressor()
+    return None
+
+
+def _decompress(decompressor, chunk: bytes) -> bytes:
+    if hasattr(decompressor, 'process'):
+        return decompressor.process(chunk)
+    return decompressor.decompress(chunk)
+
+
+async def iter_domain_batches(chunks: AsyncIterator[bytes], name: str = '', content_type: str = '', digest=None,
+                              normalize: Callable[[str], Optional[str]] = normalize_domain
+                              ) -> AsyncIterator[List[str]]:
+    """
+    Потоково разбирает список доменов из последовательности блоков байт.
+
+    Сжатые данные распаковываются на лету, строки нормализуются через
+    normalize (по умолчанию normalize_domain). Домены отдаются пачками по одному входному блоку,
+    поэтому в памяти никогда не находится весь текст списка целиком.
+    Если передан объект hashlib, в него добавляются исходные байты.
+    Сжатие brotli распознаётся по расширению name (путь файла или URL)
+    или по content_type ответа сервера.
+    """
+    decompressor = None
+    started = False
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    tail = ''
+
+    async for chunk in chunks:
+        if not chunk:
+            continue
+        if digest is not None:
+            digest.update(chunk)
+        if not started:
+            decompressor = _make_decompressor(name, content_type, chunk)
+            started = True
+        if decompressor is not None:
+            chunk = _decompress(decompressor, chunk)
+
+        lines = (tail + decoder.decode(chunk)).split('\n')
+        tail = lines.pop()
+        batch = [domain for domain in map(normalize, lines) if domain]
+        if batch:
+            yield batch
+
+    tail += decoder.decode(b'', final=True)
+    domain = normalize(tail)
+    if domain:
+        yield [domain]
+
+
+async def iter_file_chunks(path: str, chunk_size: int = FILE_CHUNK_SIZE) -> AsyncIterator[bytes]:
+    async with aiofiles.open(path, 'rb') as f:
+        while True:
+            chunk = await f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+async def iter_response_chunks(response, chunk_size: int = CHUNK_SIZE) -> AsyncIterator[bytes]:
+    async for chunk in response.content.iter_chunked(chunk_size):
+        yield chunk
+
+
+async def spool_chunks(chunks: AsyncIterator[bytes], path: str) -> str:
+    """
+    Записывает блоки байт в файл, одновременно считая их SHA-256.
+    """
+    digest = hashlib.sha256()
+    async with aiofiles.open(path, 'wb') as f:
+        async for chunk in chunks:
+            digest.update(chunk)
+            await f.write(chunk)
+    return digest.hexdigest()
+
+
+async def hash_file(path: str) -> str:
+    """
+    Считает SHA-256 файла потоково, не разбирая его содержимое.
+    """
+    digest = hashlib.sha256()
+    async for chunk in iter_file_chunks(path):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+async def collect_domains(batches: AsyncIterator[List[str]]) -> set:
+    domains = set()
+    async for batch in batches:
+        domains.update(batch)
+    return domains
@@ -0,0 +1,127 @@
+# domain_search.py
+
+import logging
+from collections import OrderedDict
+from typing import List, NamedTuple, Optional, Tuple
+from config import Config
+from subscriber_filters import SUFFIX, KEYWORD, parse_filter
+
+logger = logging.getLogger(__name__)
+
+SUBDOMAINS = 'subdomains'  # "*.example.com": только поддомены
+SUBSTRING = 'substring'    # "bank": подстрока в любом месте домена
+MIN_SUBSTRING = 3  # Короче триграммы индекс не помогает
+
+
+def reverse_labels(domain: str) -> str:
+    """
+    Метки домена в обратном порядке с точкой на конце: "www.example.com" -> "com.example.www.".
+    Поддомены одного суффикса в таком виде идут в индексе подряд.
+    """
+    return '.'.join(reversed(domain.split('.'))) + '.'
+
+
+def parse_query(text: str) -> Optional[Tuple[str, str]]:
+    """
+    Разбирает запрос /find: "*.example.com" - поддомены, ".example.com" -
+    домен и поддомены, остальное - подстрока. Для суффиксов возвращается
+    обращённый суффикс, для подстроки - она сама. None - запрос неверный.
+    """
+    text = text.strip().lower()
+    kind = SUFFIX
+    if text.startswith('*.'):
+        kind, text = SUBDOMAINS, text[1:]
+    parsed = parse_filter(text)
+    if parsed is None:
+        return None
+    if parsed[0] == KEYWORD:
+        if len(parsed[1]) < MIN_SUBSTRING:
+            return None
+        return SUBSTRING, parsed[1]
+    return kind, reverse_labels(parsed[1].lstrip('.'))
+
+
+class DomainInfo(NamedTuple):
+    domain: str
+    present: bool
+    organization: Optional[str]
+    sources: List[str]
+    last_event: Optional[tuple]  # (event_id, domain, action, source, organization, created_at)
+
+
+class DomainSearch:
+    """
+    Поиск по сохранённому списку доменов для /find и /lookup.
+
+    Суффиксы ищутся диапазоном по индексу обращённых имён, подстроки -
+    по триграммному индексу FTS5, страницы листаются по ключу, а не через
+    OFFSET. Готовые страницы хранятся в небольшом LRU-кэше, который
+    сбрасывается целиком, как только список доменов в базе меняется.
+    """
+
+    def __init__(self, database, page_size: int = Config.SEARCH_PAGE_SIZE,
+                 cache_size: int = Config.SEARCH_CACHE_SIZE):
+        self.database = database
+        self.page_size = page_size
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[tuple, object]" = OrderedDict()
+        self._version = database.domains_version
+
+    def _cached(self, key: tuple):
+        if self._version != self.database.domains_version:
+            self._cache.clear()
+            self._version = self.database.domains_version
+        result = self._cache.get(key)
+        if result is not None:
+            self._cache.move_to_end(key)
+        return result
+
+    def _store(self, key: tuple, result):
+        self._cache[key] = result
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def find(self, kind: str, value: str,
+                   cursor: Optional[str] = None) -> Tuple[List[Tuple[str, Optional[str]]], Optional[str]]:
+        """
+        Страница результатов: домены с организациями и курсор следующей страницы
+        (None - страница последняя). Курсор суффиксного поиска - последний домен
+        страницы, поиска подстроки - номер строки.
+        """
+        key = (kind, value, cursor)
+        result = self._cached(key)
+        if result is not None:
+            return result
+        if kind == SUBSTRING:
+            rows = await self.database.find_domains_by_substring(
+                value, int(cursor) if cursor else 0, self.page_size + 1
+            )
+        else:
+            rows = await self.database.find_domains_by_suffix(
+                value, reverse_labels(cursor) if cursor else None, kind != SUBDOMAINS, self.page_size + 1
+            )
+        next_cursor = None
+        if len(rows) > self.page_size:
+            rows = rows[:self.page_size]
+            next_cursor = str(rows[-1][0]) if kind == SUBSTRING else rows[-1][1]
+        result = ([(domain, organization) for _, domain, organization in rows], next_cursor)
+        self._store(key, result)
+        return result
+
+    async def lookup(self, domain: str) -> DomainInfo:
+        """
+        Есть ли домен в списке, его организация, источники и последнее изменение.
+        """
+        key = ('lookup', domain, None)
+        result = self._cached(key)
+        if result is not None:
+            return result
+        info = await self.database.get_domain_info(domain)
+        history = await self.database.get_domain_history(domain, None, 1)
+        last_event = history[0] if history else None
+        if info is None:
+            result = DomainInfo(domain, False, None, [], last_event)
+        else:
+            result = DomainInfo(domain, True, info[0], info[1], last_event)
+        self._store(key, result)
+        return result
@@ -0,0 +1,172 @@
+# domain_set.py
+
+import bisect
+from array import array
+from itertools import chain
+from typing import AsyncIterator, Callable, Iterable, List, Optional, Set, Tuple
+
+try:
+    import numpy  # Необязательная зависимость: векторные сортировка, поиск и разность отпечатков
+except ImportError:
+    numpy = None
+
+Replay = Callable[[], AsyncIterator[List[str]]]
+
+
+def _sorted_fingerprints(batch: List[str]):
+    # Отпечаток - встроенный hash строки: 64-битный и вычисляется в C; значения
+    # зависят от процесса (PYTHONHASHSEED), поэтому отпечатки нельзя сохранять
+    if numpy is not None:
+        values = numpy.fromiter(map(hash, batch), dtype=numpy.int64, count=len(batch))
+        values.sort()
+        return values
+    return array('q', sorted(map(hash, batch)))
+
+
+def _merge_runs(runs: list) -> Tuple[object, Set[int]]:
+    """
+    Сливает отсортированные пачки отпечатков в один отсортированный массив
+    без повторов. Возвращает массив и множество повторявшихся отпечатков.
+    """
+    if numpy is not None:
+        merged = numpy.concatenate(runs) if runs else numpy.empty(0, dtype=numpy.int64)
+        merged.sort()
+        if not len(merged):
+            return merged, set()
+        repeated = merged[1:] == merged[:-1]
+        duplicates = set(merged[1:][repeated].tolist())
+        return merged[numpy.concatenate(([True], ~repeated))], duplicates
+
+    # Без numpy сортируем всё разом: временный список целых всё равно
+    # в несколько раз меньше множества строк, а sorted быстрее слияния на heapq
+    merged = array('q')
+    duplicates = set()
+    previous = None
+    for value in sorted(chain.from_iterable(runs)):
+        if value == previous:
+            duplicates.add(value)
+            continue
+        merged.append(value)
+        previous = value
+    return merged, duplicates
+
+
+def _difference(left, right) -> Set[int]:
+    """
+    Отпечатки, которые есть в left и отсутствуют в right (оба отсортированы, без повторов).
+    """
+    if numpy is not None:
+        return set(numpy.setdiff1d(left, right, assume_unique=True).tolist())
+
+    result = set()
+    j, size = 0, len(right)
+    for value in left:
+        while j < size and right[j] < value:
+            j += 1
+        if j == size or right[j] != value:
+            result.add(value)
+    return result
+
+
+class DomainSet:
+    """
+    Компактное множество доменов для сравнения больших списков.
+
+    Хранит отсортированные 64-битные отпечатки - 8 байт на домен вместо
+    сотни байт на строку и ячейку хэш-таблицы. Строки сохраняются только
+    для доменов, которых нет в базовом множестве (baseline), то есть для
+    добавленных; строки удалённых доменов восстанавливаются повторным
+    проходом по базовому множеству (replay).
+
+    Совпадение отпечатков разных доменов внутри множества из базы данных
+    (где строки уникальны) обнаруживается при построении, такие домены
+    сравниваются по строкам. Совпадение отпечатка нового домена с отпечатком
+    другого домена из базы не обнаруживается; для списков в несколько
+    миллионов доменов его вероятность порядка 1e-7 на проверку.
+    """
+
+    def __init__(self, fingerprints, collisions: Set[int], replay: Optional[Replay] = None,
+                 baseline: Optional['DomainSet'] = None, kept: Optional[Set[str]] = None):
+        self.fingerprints = fingerprints
+        self.collisions = collisions
+        self.replay = replay
+        self.baseline = baseline
+        self.kept = kept if kept is not None else set()
+
+    @classmethod
+    async def build(cls, batches: AsyncIterator[List[str]], replay: Optional[Replay] = None,
+                    detect_collisions: bool = False, baseline: Optional['DomainSet'] = None) -> 'DomainSet':
+        """
+        Строит множество из пачек доменов.
+
+        :param replay: Функция, заново отдающая пачки доменов (нужна базовому множеству)
+        :param detect_collisions: Считать повторы отпечатков коллизиями; в загруженных
+            списках один домен часто встречается несколько раз, поэтому только для базы данных
+        :param baseline: Множество, с которым будет сравниваться это: строки сохраняются
+            для доменов, отсутствующих в нём или попавших в его коллизии
+        """
+        runs = []
+        kept = set()
+        async for batch in batches:
+            run = _sorted_fingerprints(batch)
+            if baseline is not None:
+                wanted = baseline.absent(run) | baseline.collisions
+                if wanted:
+                    kept.update(domain for domain in batch if hash(domain) in wanted)
+            runs.append(run)
+        fingerprints, duplicates = _merge_runs(runs)
+        return cls(fingerprints, duplicates if detect_collisions else set(), replay, baseline, kept)
+
+    @classmethod
+    def empty(cls) -> 'DomainSet':
+        return cls(_merge_runs([])[0], set())
+
+    def __len__(self) -> int:
+        return len(self.fingerprints)
+
+    def __contains__(self, domain: str) -> bool:
+        return not self.absent(_sorted_fingerprints([domain]))
+
+    def absent(self, run) -> Set[int]:
+        """
+        Отпечатки из отсортированной пачки run, которых нет в множестве.
+        """
+        size = len(self.fingerprints)
+        if numpy is not None:
+            if not size:
+                return set(run.tolist())
+            positions = numpy.minimum(numpy.searchsorted(self.fingerprints, run), size - 1)
+            return set(run[self.fingerprints[positions] != run].tolist())
+        result = set()
+        lo = 0
+        for value in run:
+            lo = bisect.bisect_left(self.fingerprints, value, lo)
+            if lo == size or self.fingerprints[lo] != value:
+                result.add(value)
+        return result
+
+    async def select(self, wanted: Iterable[int]) -> Set[str]:
+        """
+        Возвращает домены множества с указанными отпечатками повторным проходом по данным.
+        """
+        wanted = set(wanted)
+        result = set()
+        if not wanted:
+            return result
+        async for batch in self.replay():
+            result.update(domain for domain in batch if hash(domain) in wanted)
+        return result
+
+    async def diff(self, previous: 'DomainSet') -> Tuple[Set[str], Set[str]]:
+        """
+        Возвращает (добавленные, удалённые) домены относительно previous.
+
+        Множество должно быть построено с baseline=previous. Разность считается
+        по отпечаткам; в строки превращаются только изменившиеся домены
+        и домены с совпавшими отпечатками.
+        """
+        if self.baseline is not previous:
+            raise ValueError("Множество построено не относительно сравниваемого множества.")
+        removed = _difference(previous.fingerprints, self.fingerprints)
+        previous_domains = await previous.select(removed | previous.collisions)
+        return self.kept - previous_domains, previous_domains - self.kept
@@ -2,15 +2,24 @@
 
 import asyncio
 import logging
+import os
+import tempfile
 from pyrogram import Client, filters
 from config import Config
 from database import Database
 from whois_service import WhoisService
+from whois_queue import WhoisQueue
+from whois_worker import WorkerPool
 from notifier import Notifier
 from domain_monitor import DomainMonitor
 from user_manager import UserManager
+from metrics import format_stats, start_metrics_server
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from ratelimit import rate_limit  # Импорт декоратора
+from subscriber_filters import SUFFIX, parse_filter
+from domain_parser import normalize_domain
+from report import build_events_page, build_lookup_text, build_search_page, build_versions_page, parse_since
+from domain_search import SUBSTRING, DomainSearch, parse_query
 
 # Настройка логирования
 logging.basicConfig(
@@ -27,8 +36,16 @@ async def main():
     database = Database()
     await database.connect()
 
-    # Инициализация сервисов
-    whois_service = WhoisService(database=database)
+    # Инициализация сервисов. С WHOIS_WORKERS запросы WHOIS выполняют отдельные
+    # процессы через очередь в базе, а бот только ставит задания и ждёт результатов
+    worker_pool = None
+    whois_queue = None
+    if Config.WHOIS_WORKERS > 0:
+        whois_queue = WhoisQueue(database)
+        await whois_queue.clear()
+        worker_pool = WorkerPool(Config.WHOIS_WORKERS)
+        worker_pool.start()
+    whois_service = WhoisService(database=database, queue=whois_queue)
     app = Client(
         "domain_monitor_bot",
         api_id=Config.API_ID,
@@ -36,34 +53,39 @@ async def main():
         bot_token=Config.BOT_TOKEN
     )
 
-    user_manager = UserManager()
+    user_manager = UserManager(database)
+    await user_manager.load()
 
-    notifier = Notifier(app)
+    notifier = Notifier(app, user_manager)
     monitor = DomainMonitor(notifier, database, whois_service)
+    search = DomainSearch(database)
+
+    metrics_runner = None
+    if Config.METRICS_PORT:
+        metrics_runner = await start_metrics_server(Config.METRICS_PORT, Config.METRICS_HOST)
 
     # Запуск клиента Pyrogram
     await app.start()
     logger.info("Клиент Pyrogram запущен.")
 
-    # Инициализация начального списка доменов, если необходимо
-    existing_domains = await database.get_all_domains()
-    if not existing_domains:
-        logger.info("Инициализация списка доменов.")
-        current_domains = await monitor.fetch_domains()
-        for domain in current_domains:
-            company = await whois_service.get_company_name_async(domain)
-            await database.add_domain(domain, company)
-        logger.info("Начальный список доменов сохранён в базу данных.")
-
-    # Настройка планировщика задач
+    # Начальное заполнение базы, продолжение прерванных проверок и определение
+    # организаций идут в фоне: бот отвечает на команды сразу после запуска
+    monitor.start_background()
+
+    # Настройка планировщика задач: у каждого источника свой интервал
     scheduler = AsyncIOScheduler()
-    scheduler.add_job(
-        monitor.check_for_changes,
-        'interval',
-        minutes=Config.CHECK_INTERVAL
-    )
+    for source in monitor.sources.values():
+        scheduler.add_job(
+            monitor.check_source,
+            'interval',
+            minutes=source.interval,
+            args=[source.name]
+        )
+        logger.info(f"Источник {source.name} проверяется каждые {source.interval} минут.")
+    if worker_pool is not None:
+        scheduler.add_job(worker_pool.check, 'interval', seconds=30)
     scheduler.start()
-    logger.info(f"Планировщик запущен с интервалом {Config.CHECK_INTERVAL} минут.")
+    logger.info("Планировщик запущен.")
 
     # Обработка команд бота
     @app.on_message(filters.command("start") & filters.private)
@@ -86,12 +108,297 @@ async def main():
         else:
             await message.reply_text("Вы не были подписаны на уведомления.")
 
+    # Фильтры уведомлений: ".ru" - домены зоны или поддомены, "bank" - домены с этим словом
+    @app.on_message(filters.command("filter") & filters.private)
+    @rate_limit(calls=10, period=60)
+    async def filter_command(_, message):
+        user_id = message.from_user.id
+        if len(message.command) < 2:
+            current = user_manager.get_filters(user_id)
+            if not current:
+                await message.reply_text(
+                    "Фильтров нет, вы получаете все изменения.\n"
+                    "Использование: /filter .ru (зона или суффикс) или /filter bank (слово в домене)."
+                )
+            else:
+                await message.reply_text("Ваши фильтры: " + ", ".join(sorted(pattern for _, pattern in current)))
+            return
+
+        if user_id not in user_manager.users:
+            await message.reply_text("Сначала подпишитесь на уведомления командой /start.")
+            return
+        parsed = parse_filter(message.command[1])
+        if parsed is None:
+            await message.reply_text("Неверный фильтр. Суффикс начинается с точки (.ru), ключевое слово - латиницей (bank).")
+            return
+        if len(user_manager.get_filters(user_id)) >= Config.MAX_FILTERS_PER_USER:
+            await message.reply_text(f"Можно задать не больше {Config.MAX_FILTERS_PER_USER} фильтров.")
+            return
+        kind, pattern = parsed
+        if await user_manager.add_filter(user_id, kind, pattern):
+            what = "доменах зоны" if kind == SUFFIX else "доменах, содержащих"
+            await message.reply_text(f"Теперь вы получаете уведомления только о {what} {pattern} и других ваших фильтрах.")
+        else:
+            await message.reply_text(f"Фильтр {pattern} уже задан.")
+
+    @app.on_message(filters.command("unfilter") & filters.private)
+    @rate_limit(calls=10, period=60)
+    async def unfilter_command(_, message):
+        user_id = message.from_user.id
+        if len(message.command) < 2:
+            if await user_manager.remove_filter(user_id):
+                await message.reply_text("Все фильтры удалены, вы снова получаете все изменения.")
+            else:
+                await message.reply_text("У вас нет фильтров.")
+            return
+
+        parsed = parse_filter(message.command[1])
+        if parsed is None or not await user_manager.remove_filter(user_id, *parsed):
+            await message.reply_text("Такого фильтра нет.")
+        else:
+            await message.reply_text(f"Фильтр {parsed[1]} удалён.")
+
     @app.on_message(filters.command("status") & filters.private)
     async def status_command(_, message):
-        users = await notifier.get_users()
-        count = len(users)
+        count = user_manager.count()
         await message.reply_text(f"Бот активно следит за {count} пользователями.")
 
+    # Команда /stats со сводкой метрик (доступна только администраторам)
+    @app.on_message(filters.command("stats") & filters.private)
+    async def stats_command(_, message):
+        user_id = message.from_user.id
+        if user_id not in Config.ADMIN_USER_IDS:
+            await message.reply_text("У вас нет прав для выполнения этой команды.")
+            return
+
+        cache = whois_service.cache_stats()
+        text = format_stats() + (
+            f"\n\nКэш WHOIS в памяти: {cache['memory_size']} записей, "
+            f"вытеснено {cache['memory_evictions']}, объединено запросов {cache['coalesced']}."
+        )
+        for server, stats in sorted(whois_service.server_stats().items()):
+            if stats['open']:
+                text += f"\n{server}: отключён предохранителем"
+        if whois_queue is not None:
+            queue = await whois_queue.stats()
+            text += (
+                f"\nОчередь WHOIS: ожидают {queue.get('queued', 0)}, выполняются {queue.get('leased', 0)}; "
+                f"процессов {worker_pool.alive()} из {worker_pool.count}, перезапусков {worker_pool.restarts}."
+            )
+        await message.reply_text(text)
+
+    # Есть ли домен в списке и с какого момента
+    @app.on_message(filters.command("lookup") & filters.private)
+    @rate_limit(calls=10, period=60)
+    async def lookup_command(_, message):
+        if len(message.command) != 2:
+            await message.reply_text("Использование: /lookup <домен>")
+            return
+        domain = normalize_domain(message.command[1])
+        if domain is None:
+            await message.reply_text("Неверный формат домена.")
+            return
+        try:
+            info = await search.lookup(domain)
+        except Exception as e:
+            logger.error(f"Ошибка при поиске домена {domain}: {e}")
+            await message.reply_text("Не удалось выполнить поиск, попробуйте позже.")
+            return
+        await message.reply_text(build_lookup_text(info))
+
+    # Поиск по списку: "*.example.com" - поддомены, ".example.com" - домен и поддомены, "bank" - подстрока
+    @app.on_message(filters.command("find") & filters.private)
+    @rate_limit(calls=10, period=60)
+    async def find_command(_, message):
+        usage = "Использование: /find <*.example.com | .example.com | слово не короче 3 символов>"
+        if len(message.command) not in (2, 3):
+            await message.reply_text(usage)
+            return
+        parsed = parse_query(message.command[1])
+        if parsed is None:
+            await message.reply_text(usage)
+            return
+        kind, value = parsed
+        cursor = message.command[2] if len(message.command) == 3 else None
+        # Курсор поиска подстроки - номер строки, суффиксного поиска - последний показанный домен
+        if cursor is not None and kind != SUBSTRING:
+            cursor = normalize_domain(cursor)
+        if len(message.command) == 3 and (cursor is None or (kind == SUBSTRING and not cursor.isdigit())):
+            await message.reply_text(usage)
+            return
+        try:
+            domains, next_cursor = await search.find(kind, value, cursor)
+        except Exception as e:
+            logger.error(f"Ошибка при поиске доменов по запросу {message.command[1]}: {e}")
+            await message.reply_text("Не удалось выполнить поиск, попробуйте позже.")
+            return
+        if not domains:
+            await message.reply_text("Ничего не найдено.")
+            return
+        next_command = f"/find {message.command[1]} {next_cursor}" if next_cursor else None
+        for chunk in build_search_page(domains, f"Найдено по запросу {message.command[1]}:", next_command):
+            await message.reply_text(chunk)
+
+    # История изменений домена, от новых событий к старым (доступна только администраторам)
+    @app.on_message(filters.command("history") & filters.private)
+    async def history_command(_, message):
+        user_id = message.from_user.id
+        if user_id not in Config.ADMIN_USER_IDS:
+            await message.reply_text("У вас нет прав для выполнения этой команды.")
+            return
+
+        if len(message.command) not in (2, 3) or (len(message.command) == 3 and not message.command[2].isdigit()):
+            await message.reply_text("Использование: /history <домен>")
+            return
+        domain = normalize_domain(message.command[1])
+        if domain is None:
+            await message.reply_text("Неверный формат домена.")
+            return
+        before = int(message.command[2]) if len(message.command) == 3 else None
+
+        events = await database.get_domain_history(domain, before, Config.HISTORY_PAGE_SIZE + 1)
+        if not events:
+            await message.reply_text(f"Изменений домена {domain} не найдено.")
+            return
+        more = len(events) > Config.HISTORY_PAGE_SIZE
+        events = events[:Config.HISTORY_PAGE_SIZE]
+        next_command = f"/history {domain} {events[-1][0]}" if more else None
+        for chunk in build_events_page(events, f"История {domain}:", next_command):
+            await message.reply_text(chunk)
+
+    # Изменения за период в хронологическом порядке (доступна только администраторам)
+    @app.on_message(filters.command("changes") & filters.private)
+    async def changes_command(_, message):
+        user_id = message.from_user.id
+        if user_id not in Config.ADMIN_USER_IDS:
+            await message.reply_text("У вас нет прав для выполнения этой команды.")
+            return
+
+        since = parse_since(message.command[1]) if len(message.command) in (2, 3) else None
+        if since is None or (len(message.command) == 3 and not message.command[2].isdigit()):
+            await message.reply_text("Использование: /changes <24h | 7d | 2024-05-01>")
+            return
+        after = int(message.command[2]) if len(message.command) == 3 else None
+
+        events = await database.get_events_since(since, after, Config.HISTORY_PAGE_SIZE + 1)
+        if not events:
+            await message.reply_text("Изменений за этот период нет.")
+            return
+        more = len(events) > Config.HISTORY_PAGE_SIZE
+        events = events[:Config.HISTORY_PAGE_SIZE]
+        next_command = f"/changes {message.command[1]} {events[-1][0]}" if more else None
+        for chunk in build_events_page(events, f"Изменения с {message.command[1]}:", next_command):
+            await message.reply_text(chunk)
+
+    def parse_version_args(args):
+        # Последний аргумент может быть именем источника, по умолчанию - первый источник
+        if args and args[-1] in monitor.sources:
+            return args[:-1], args[-1]
+        return args, monitor.primary.name
+
+    async def resolve_version(source, text):
+        # Номер версии или момент времени (24h, 7d, 2024-05-01): версия, действовавшая тогда
+        if text.isdigit():
+            return int(text)
+        moment = parse_since(text)
+        return await monitor.snapshots.resolve(source, moment) if moment is not None else None
+
+    async def reply_file(message, build, file_name, caption):
+        # Версии бывают большими: файл собирается на диске, а не в памяти
+        fd, path = tempfile.mkstemp(suffix='.gz')
+        os.close(fd)
+        try:
+            result = await build(path)
+            if result is not None:
+                await message.reply_document(path, file_name=file_name, caption=caption(result))
+            return result
+        finally:
+            os.remove(path)
+
+    # Версии списка источника (доступна только администраторам)
+    @app.on_message(filters.command("versions") & filters.private)
+    async def versions_command(_, message):
+        user_id = message.from_user.id
+        if user_id not in Config.ADMIN_USER_IDS:
+            await message.reply_text("У вас нет прав для выполнения этой команды.")
+            return
+
+        args, source = parse_version_args(message.command[1:])
+        if args:
+            await message.reply_text("Использование: /versions [источник]")
+            return
+        snapshots = await database.get_snapshots(source)
+        if not snapshots:
+            await message.reply_text(f"Версий списка {source} пока нет.")
+            return
+        recent = {row[0] for row in snapshots[-2 * Config.HISTORY_PAGE_SIZE:]}
+        snapshots = [row for row in snapshots if row[0] in recent]
+        for chunk in build_versions_page(snapshots, f"Версии списка {source}:"):
+            await message.reply_text(chunk)
+
+    # Разница двух версий списка файлом (доступна только администраторам)
+    @app.on_message(filters.command("diff") & filters.private)
+    async def diff_command(_, message):
+        user_id = message.from_user.id
+        if user_id not in Config.ADMIN_USER_IDS:
+            await message.reply_text("У вас нет прав для выполнения этой команды.")
+            return
+
+        args, source = parse_version_args(message.command[1:])
+        if len(args) not in (1, 2):
+            await message.reply_text("Использование: /diff <версия | 7d | 2024-05-01> [версия] [источник]")
+            return
+        old = await resolve_version(source, args[0])
+        if len(args) == 2:
+            new = await resolve_version(source, args[1])
+        else:
+            latest = await monitor.snapshots.latest(source)
+            new = latest[0] if latest else None
+        if old is None or new is None:
+            await message.reply_text("Такой версии нет.")
+            return
+        try:
+            result = await reply_file(
+                message, lambda path: monitor.snapshots.diff(source, old, new, path),
+                f"{source}-v{old}-v{new}.diff.gz",
+                lambda counts: f"{source}: v{old} → v{new}, добавлено {counts[0]}, удалено {counts[1]}."
+            )
+        except Exception as e:
+            logger.error(f"Ошибка при сравнении версий {old} и {new} источника {source}: {e}")
+            await message.reply_text("Не удалось сравнить версии.")
+            return
+        if result is None:
+            await message.reply_text("Версия удалена или не может быть собрана.")
+
+    # Список доменов в одной из версий файлом (доступна только администраторам)
+    @app.on_message(filters.command("snapshot") & filters.private)
+    async def snapshot_command(_, message):
+        user_id = message.from_user.id
+        if user_id not in Config.ADMIN_USER_IDS:
+            await message.reply_text("У вас нет прав для выполнения этой команды.")
+            return
+
+        args, source = parse_version_args(message.command[1:])
+        if len(args) != 1:
+            await message.reply_text("Использование: /snapshot <версия | 7d | 2024-05-01> [источник]")
+            return
+        version = await resolve_version(source, args[0])
+        if version is None:
+            await message.reply_text("Такой версии нет.")
+            return
+        try:
+            result = await reply_file(
+                message, lambda path: monitor.snapshots.export(source, version, path),
+                f"{source}-v{version}.lst.gz",
+                lambda count: f"{source}: версия {version}, {count} доменов."
+            )
+        except Exception as e:
+            logger.error(f"Ошибка при сборке версии {version} источника {source}: {e}")
+            await message.reply_text("Не удалось собрать версию.")
+            return
+        if result is None:
+            await message.reply_text("Версия удалена или не может быть собрана.")
+
     # Новая команда /check для ручной проверки изменений с детализированным выводом
     @app.on_message(filters.command("check") & filters.private)
     async def check_command(_, message):
@@ -102,8 +409,12 @@ async def main():
             return
 
         await message.reply_text("Проверка изменений начата...")
-        await monitor.check_for_changes()
-        await message.reply_text("Проверка изменений завершена.")
+        run_ids = await monitor.check_for_changes(trigger='command')
+        runs = ", ".join(f"{name} #{run_id}" for name, run_id in run_ids.items() if run_id is not None)
+        if not runs:
+            await message.reply_text("Проверка изменений завершена.")
+        else:
+            await message.reply_text(f"Проверка изменений завершена (запуски: {runs}).")
 
     # Новая команда /check_test для тестирования системы оповещений
     @app.on_message(filters.command("check_test") & filters.private)
@@ -137,13 +448,17 @@ async def main():
             return
 
         # Добавление домена в локальный файл
-        await monitor.add_domain_to_source(domain)
+        added = await monitor.add_domain_to_source(domain)
+        if not added:
+            await message.reply_text(f"Домен {domain} уже есть в списке." if added is False
+                                     else "Не удалось изменить локальный список доменов.")
+            return
         # Обновление базы данных
         company = "Добавленный администратором"
-        await database.add_domain(domain, company)
+        await monitor.add_stored_domain(domain, company)
         # Отправка уведомления пользователям
         notification = f"*Новый домен добавлен:*\n✅ {domain} ({company})"
-        await notifier.send_message_to_users(notification)
+        await notifier.send_message_to_users(notification, domains=[domain])
         await message.reply_text(f"Домен {domain} успешно добавлен и пользователям отправлены уведомления.")
 
     # Новая команда /remove_domain для удаления домена (доступна только администраторам)
@@ -165,18 +480,29 @@ async def main():
             return
 
         # Удаление домена из локального файла
-        await monitor.remove_domain_from_source(domain)
+        removed = await monitor.remove_domain_from_source(domain)
+        if not removed:
+            await message.reply_text(f"Домена {domain} нет в списке." if removed is False
+                                     else "Не удалось изменить локальный список доменов.")
+            return
         # Обновление базы данных
-        await database.remove_domains({domain})
+        await monitor.remove_stored_domains({domain})
         # Отправка уведомления пользователям
         notification = f"*Домен удалён:*\n❌ {domain}"
-        await notifier.send_message_to_users(notification)
+        await notifier.send_message_to_users(notification, domains=[domain])
         await message.reply_text(f"Домен {domain} успешно удалён и пользователям отправлены уведомления.")
 
     logger.info("Бот готов к работе и обрабатывает команды.")
 
     # Удержание приложения активным
-    await asyncio.Event().wait()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await monitor.close()
+        if worker_pool is not None:
+            worker_pool.stop()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
 
 
 if __name__ == '__main__':
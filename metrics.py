@@ -0,0 +1,252 @@
+# metrics.py
+
+import bisect
+import logging
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _label_key(labels: Dict[str, str]) -> LabelKey:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format_labels(key: LabelKey) -> str:
+    if not key:
+        return ""
+    body = ",".join('{}="{}"'.format(name, value.replace('\\', '\\\\').replace('"', '\\"')) for name, value in key)
+    return "{" + body + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self.values: Dict[LabelKey, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, key, value
+
+
+class Gauge:
+    """
+    Текущее значение. Если передана функция, значение вычисляется при сборе
+    метрик и может зависеть от меток: функция возвращает словарь {метки: значение}.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str,
+                 func: Optional[Callable[[], Dict[LabelKey, float]]] = None):
+        self.name = name
+        self.documentation = documentation
+        self.func = func
+        self.values: Dict[LabelKey, float] = {}
+
+    def set(self, value: float, **labels):
+        self.values[_label_key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        values = self.func() if self.func is not None else self.values
+        for key, value in values.items():
+            yield self.name, key, value
+
+
+class _Timer:
+    def __init__(self, histogram: "Histogram", labels: Dict[str, str]):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        # Для каждого набора меток: счётчики по корзинам (без накопления), сумма и количество
+        self.values: Dict[LabelKey, List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels)
+        data = self.values.get(key)
+        if data is None:
+            data = self.values[key] = [0] * (len(self.buckets) + 3)
+        data[bisect.bisect_left(self.buckets, value)] += 1
+        data[-2] += value
+        data[-1] += 1
+
+    def time(self, **labels) -> _Timer:
+        """
+        Контекстный менеджер, замеряющий длительность блока.
+        """
+        return _Timer(self, labels)
+
+    def summary(self, **labels) -> Optional[Dict[str, float]]:
+        data = self.values.get(_label_key(labels))
+        if not data or not data[-1]:
+            return None
+        count = data[-1]
+        return {
+            "count": count,
+            "avg": data[-2] / count,
+            "p50": self._quantile(data, 0.5),
+            "p95": self._quantile(data, 0.95),
+        }
+
+    def _quantile(self, data: List[float], q: float) -> float:
+        # Верхняя граница корзины, в которую попадает квантиль
+        target = q * data[-1]
+        cumulative = 0
+        for i, bound in enumerate(self.buckets):
+            cumulative += data[i]
+            if cumulative >= target:
+                return bound
+        return float('inf')
+
+    def samples(self):
+        for key, data in self.values.items():
+            cumulative = 0
+            for i, bound in enumerate(self.buckets):
+                cumulative += data[i]
+                yield self.name + "_bucket", key + (("le", repr(float(bound))),), cumulative
+            yield self.name + "_bucket", key + (("le", "+Inf"),), data[-1]
+            yield self.name + "_sum", key, data[-2]
+            yield self.name + "_count", key, data[-1]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str) -> Counter:
+        return self.register(Counter(name, documentation))
+
+    def gauge(self, name: str, documentation: str, func=None) -> Gauge:
+        return self.register(Gauge(name, documentation, func))
+
+    def histogram(self, name: str, documentation: str, buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, buckets))
+
+    def render(self) -> str:
+        """
+        Возвращает все метрики в текстовом формате Prometheus.
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, key, value in metric.samples():
+                lines.append(f"{name}{_format_labels(key)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "domainsentinel_stage_seconds", "Длительность этапов проверки изменений")
+CHANGES = REGISTRY.counter(
+    "domainsentinel_changes_total", "Обнаруженные изменения списка доменов")
+WHOIS_CACHE = REGISTRY.counter(
+    "domainsentinel_whois_cache_total", "Результаты поиска в кэше WHOIS")
+WHOIS_LOOKUP_SECONDS = REGISTRY.histogram(
+    "domainsentinel_whois_lookup_seconds", "Длительность WHOIS-запросов без учёта кэша")
+WHOIS_IN_FLIGHT = REGISTRY.gauge(
+    "domainsentinel_whois_in_flight", "Выполняющиеся WHOIS-запросы")
+WHOIS_QUEUE_DEPTH = REGISTRY.gauge(
+    "domainsentinel_whois_queue_depth", "WHOIS-запросы, ожидающие своей очереди к серверу")
+WHOIS_SERVER_REQUESTS = REGISTRY.counter(
+    "domainsentinel_whois_server_requests_total", "Запросы к WHOIS-серверам по результату")
+DB_SECONDS = REGISTRY.histogram(
+    "domainsentinel_db_seconds", "Длительность операций с базой данных")
+DB_ROWS = REGISTRY.counter(
+    "domainsentinel_db_rows_total", "Строки, записанные в базу данных")
+MESSAGES = REGISTRY.counter(
+    "domainsentinel_messages_total", "Сообщения Telegram по результату отправки")
+
+
+def format_stats() -> str:
+    """
+    Краткая сводка метрик для команды /stats.
+    """
+    lines = ["**Этапы проверки:**"]
+    for key in sorted(STAGE_SECONDS.values):
+        summary = STAGE_SECONDS.summary(**dict(key))
+        lines.append(f"{dict(key).get('stage', '?')}: {summary['count']} раз, "
+                     f"среднее {summary['avg']:.3f} с, p95 ≤ {summary['p95']} с")
+
+    cache = {dict(key).get('result'): value for key, value in WHOIS_CACHE.values.items()}
+    total = sum(cache.values())
+    hits = cache.get('memory_hit', 0) + cache.get('db_hit', 0)
+    lines.append("")
+    lines.append("**WHOIS:**")
+    lines.append(f"Кэш: {hits:.0f} попаданий из {total:.0f} ({hits / total:.0%})" if total else "Кэш: нет обращений")
+    lines.append(f"Выполняется запросов: {sum(WHOIS_IN_FLIGHT.values.values()):.0f}")
+    lookup = WHOIS_LOOKUP_SECONDS.summary()
+    if lookup:
+        lines.append(f"Запросы: {lookup['count']}, среднее {lookup['avg']:.2f} с")
+    for _, key, value in WHOIS_QUEUE_DEPTH.samples():
+        lines.append(f"Очередь {dict(key).get('server')}: {value:.0f}")
+
+    servers: Dict[str, Dict[str, float]] = {}
+    for key, value in WHOIS_SERVER_REQUESTS.values.items():
+        labels = dict(key)
+        servers.setdefault(labels['server'], {})[labels['outcome']] = value
+    for server, outcomes in sorted(servers.items()):
+        requests = sum(outcomes.values())
+        lines.append(f"{server}: {requests:.0f} запросов, ошибок {outcomes.get('error', 0) / requests:.0%}")
+
+    messages = {dict(key).get('result'): value for key, value in MESSAGES.values.items()}
+    lines.append("")
+    lines.append("**Telegram:** " + (", ".join(f"{name} {value:.0f}" for name, value in sorted(messages.items()))
+                                     or "сообщений не было"))
+    return "\n".join(lines)
+
+
+async def start_metrics_server(port: int, host: str = "127.0.0.1") -> web.AppRunner:
+    """
+    Запускает HTTP-эндпоинт /metrics в формате Prometheus.
+    """
+    async def handle(request):
+        return web.Response(text=REGISTRY.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return runner
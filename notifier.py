@@ -1,60 +1,139 @@
 # notifier.py
 
-import json
+import asyncio
+import io
+from itertools import chain
+from typing import Dict, Iterable, List, Optional, Tuple
 from pyrogram import Client
-from pyrogram.enums import ParseMode
 
+from broadcaster import Broadcaster, BroadcastResult
 from config import Config
+from report import Report, build_change_report, fill_organizations
 import logging
-import aiofiles
 
 logger = logging.getLogger(__name__)
 
+# Отправленное сообщение отчёта: текст и его копии по чатам {chat_id: message_id}
+SentPage = Tuple[str, Dict[int, int]]
+
 
 class Notifier:
-    def __init__(self, app: Client):
+    def __init__(self, app: Client, user_manager=None):
         self.app = app
+        self.user_manager = user_manager
+        self.broadcaster = Broadcaster(
+            app, on_blocked=user_manager.remove_user if user_manager is not None else None
+        )
+
+    async def send_message_to_users(self, message: str, domains: Optional[Iterable[str]] = None) -> BroadcastResult:
+        """
+        Рассылает сообщение подписчикам. Если переданы домены, о которых сообщение,
+        пользователи с фильтрами получают его, только когда им подходит хотя бы один домен.
+        """
+        users = await self.get_users()
+        if domains is not None and users:
+            index = self.user_manager.filter_index
+            matched = set()
+            for domain in domains:
+                matched |= index.match(domain)
+            users = [user_id for user_id in users if user_id not in index.users or user_id in matched]
+        result = await self.broadcaster.broadcast(users, message, progress=self._report_progress)
+        # Итог долгих или неудачных рассылок отправляем администраторам
+        if result.elapsed >= Config.BROADCAST_PROGRESS_INTERVAL or result.failed:
+            await self.send_message_to_admin(result.summary())
+        return result
+
+    async def send_changes_to_users(self, added: Dict[str, str], removed: Dict[str, str],
+                                    source: Optional[str] = None) -> List[SentPage]:
+        """
+        Рассылает подписчикам изменения с учётом их фильтров.
+        Возвращает отправленные сообщения, чтобы их можно было дополнить правками.
 
-    async def send_message_to_users(self, message: str):
+        Пользователи без фильтров получают все изменения, остальные - только
+        подходящие им домены. Изменения раскладываются по пользователям одним
+        проходом по общему индексу фильтров, пользователи с одинаковым набором
+        доменов получают одну общую рассылку.
+        """
         users = await self.get_users()
+        if not users or not (added or removed):
+            return []
+        index = self.user_manager.filter_index
+        slices = index.route(chain(added, removed))
+        everyone: List[int] = []
+        groups: Dict[frozenset, List[int]] = {}
         for user_id in users:
-            print(user_id)
-            try:
-                await self.app.send_message(
-                    chat_id=user_id,
-                    text=message,
-                    parse_mode=ParseMode("markdown")
-                )
-                logger.info(f"Уведомление отправлено пользователю {user_id}.")
-            except Exception as e:
-                logger.error(f"Не удалось отправить сообщение пользователю {user_id}: {e}")
+            if user_id not in index.users:
+                everyone.append(user_id)
+            elif user_id in slices:
+                groups.setdefault(frozenset(slices[user_id]), []).append(user_id)
+
+        jobs = [(everyone, added, removed)] if everyone else []
+        for domains, chat_ids in groups.items():
+            jobs.append((chat_ids,
+                         {domain: added[domain] for domain in domains if domain in added},
+                         {domain: removed[domain] for domain in domains if domain in removed}))
+        logger.info(f"Изменения отправляются {len(everyone) + sum(map(len, groups.values()))} "
+                    f"подписчикам ({len(jobs)} вариантов отчёта).")
+        sent = await asyncio.gather(*(self._send_changes(chat_ids, job_added, job_removed, source)
+                                      for chat_ids, job_added, job_removed in jobs))
+        return [page for pages in sent for page in pages]
 
-    async def send_message_to_admin(self, message: str):
+    async def _send_changes(self, chat_ids: List[int], added: Dict[str, str], removed: Dict[str, str],
+                            source: Optional[str]) -> List[SentPage]:
+        report = build_change_report(added, removed, max_entries=Config.USER_REPORT_MAX_ENTRIES,
+                                     source=source, attach=False)
+        sent = []
+        for chunk in report.chunks:
+            result = await self.broadcaster.broadcast(chat_ids, chunk)
+            sent.append((chunk, result.messages))
+        return sent
+
+    async def fill_organizations(self, pages: List[SentPage], organizations: Dict[str, str]):
+        """
+        Дописывает организации в сообщения, отправленные до их определения.
+        Правки всех сообщений идут одной пачкой через общий ограничитель скорости;
+        сообщения, которые не изменились, не трогаются.
+        """
+        edits = []
+        for text, messages in pages:
+            filled = fill_organizations(text, organizations)
+            if filled != text and messages:
+                edits.append(self.broadcaster.edit(messages, filled))
+        if edits:
+            results = await asyncio.gather(*edits)
+            logger.info(f"Изменено {sum(result.sent for result in results)} сообщений отчёта.")
+
+    async def _report_progress(self, result: BroadcastResult):
+        await self.send_message_to_admin(
+            f"Рассылка: отправлено {result.sent} из {result.total} ({result.throughput:.1f} сообщ./с)."
+        )
+
+    async def send_message_to_admin(self, message: str) -> BroadcastResult:
         admins = Config.ADMIN_USER_IDS
         # admins.extend([961097940, 1343588659,  865871473, 1109901724])
-        for admin_id in admins:
+        return await self.broadcaster.broadcast(admins, message, unsubscribe=False)
+
+    async def send_report_to_admin(self, report: Report) -> List[SentPage]:
+        sent = []
+        for chunk in report.chunks:
+            result = await self.send_message_to_admin(chunk)
+            sent.append((chunk, result.messages))
+        if report.attachment is not None:
+            await self.send_document_to_admin(report.attachment, report.attachment_name,
+                                              "Полный список изменений")
+        return sent
+
+    async def send_document_to_admin(self, content: bytes, file_name: str, caption: str = ""):
+        for admin_id in Config.ADMIN_USER_IDS:
+            document = io.BytesIO(content)
+            document.name = file_name
             try:
-                await self.app.send_message(
-                    chat_id=admin_id,
-                    text=message,
-                    parse_mode=ParseMode("markdown")
-                )
-                logger.info(f"Уведомление отправлено администратору {admin_id}.")
+                await self.app.send_document(chat_id=admin_id, document=document, caption=caption)
+                logger.info(f"Файл {file_name} отправлен администратору {admin_id}.")
             except Exception as e:
-                logger.error(f"Не удалось отправить сообщение администратору {admin_id}: {e}")
+                logger.error(f"Не удалось отправить файл администратору {admin_id}: {e}")
 
     async def get_users(self) -> list:
-        try:
-            async with aiofiles.open(Config.USERS_FILE, 'r', encoding='utf-8') as f:
-                content = await f.read()
-                data = json.loads(content)
-                return data.get("users", [])
-        except json.JSONDecodeError as e:
-            logger.error(f"Ошибка декодирования JSON в файле {Config.USERS_FILE}: {e}")
-            return []
-        except FileNotFoundError:
-            logger.warning(f"Файл {Config.USERS_FILE} не найден. Создаётся новый файл.")
-            return []
-        except Exception as e:
-            logger.error(f"Ошибка при загрузке пользователей: {e}")
+        if self.user_manager is None:
             return []
+        return self.user_manager.get_users()
@@ -0,0 +1,113 @@
+# public_suffix.py
+
+import logging
+import os
+from typing import Dict, Iterable, List, Optional
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+_TERMINAL = '$'   # На этом узле заканчивается правило
+_EXCEPTION = '!'  # Правило-исключение: публичный суффикс - родительский узел
+_WILDCARD = '*'
+
+
+def _encode_label(label: str) -> str:
+    # Домены в базе хранятся в punycode, поэтому и правила переводим в него
+    if label.isascii():
+        return label
+    return label.encode('idna').decode('ascii')
+
+
+class PublicSuffixList:
+    """
+    Индекс Public Suffix List для определения регистрируемого домена (eTLD+1).
+
+    Правила собираются в префиксное дерево по меткам справа налево,
+    поэтому поиск занимает по одному обращению к словарю на метку домена.
+    По умолчанию используется только раздел ICANN: WHOIS отвечает за
+    домены, зарегистрированные в реестрах, а не за поддомены частных
+    сервисов вроде github.io.
+    """
+
+    def __init__(self, rules: Iterable[str] = ()):
+        self._trie: Dict[str, dict] = {}
+        self.size = 0
+        for rule in rules:
+            self.add_rule(rule)
+
+    @classmethod
+    def load(cls, path: str = Config.PUBLIC_SUFFIX_FILE, private: bool = False) -> 'PublicSuffixList':
+        """
+        Загружает список из файла в формате publicsuffix.org. Если файла нет,
+        действует только правило по умолчанию: суффикс - последняя метка.
+        """
+        psl = cls()
+        if not os.path.exists(path):
+            logger.warning(f"Файл Public Suffix List {path} не найден, домены группируются по двум последним меткам.")
+            return psl
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line.startswith('// ===BEGIN PRIVATE DOMAINS===') and not private:
+                    break
+                if not line or line.startswith('//'):
+                    continue
+                psl.add_rule(line.split()[0])
+        logger.info(f"Загружено правил Public Suffix List: {psl.size}.")
+        return psl
+
+    def add_rule(self, rule: str):
+        exception = rule.startswith(_EXCEPTION)
+        labels = rule.lstrip(_EXCEPTION).lower().split('.')
+        node = self._trie
+        for label in reversed(labels):
+            node = node.setdefault(_encode_label(label), {})
+        node[_EXCEPTION if exception else _TERMINAL] = True
+        self.size += 1
+
+    def suffix_length(self, labels: List[str]) -> int:
+        """
+        Число меток публичного суффикса для домена, заданного метками справа налево.
+        """
+        best = 1  # Правило по умолчанию "*": суффиксом считается последняя метка
+        node = self._trie
+        for i, label in enumerate(labels):
+            child = node.get(label)
+            if child is not None:
+                if child.get(_EXCEPTION):
+                    return i
+            else:
+                child = node.get(_WILDCARD)
+                if child is None:
+                    break
+            if child.get(_TERMINAL):
+                best = i + 1
+            node = child
+        return best
+
+    def registrable_domain(self, domain: str) -> Optional[str]:
+        """
+        Возвращает регистрируемый домен (например, example.co.uk для a.b.example.co.uk)
+        или None, если домен сам является публичным суффиксом.
+        """
+        labels = domain.split('.')
+        labels.reverse()
+        length = self.suffix_length(labels) + 1
+        if len(labels) < length:
+            return None
+        return '.'.join(reversed(labels[:length]))
+
+
+_default: Optional[PublicSuffixList] = None
+
+
+def get_public_suffix_list() -> PublicSuffixList:
+    """
+    Общий для процесса индекс, загружаемый из встроенного файла при первом обращении.
+    """
+    global _default
+    if _default is None:
+        _default = PublicSuffixList.load()
+    return _default
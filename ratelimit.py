@@ -1,26 +1,150 @@
 # ratelimit.py
 
 import asyncio
+import logging
+import math
 import time
+from collections import OrderedDict, deque
 from functools import wraps
-from typing import Callable, Dict
+from typing import Callable, Deque, Tuple
 from config import Config
 
+logger = logging.getLogger(__name__)
+
 RATE_LIMIT_CALLS = 1  # Максимальное количество вызовов
 RATE_LIMIT_PERIOD = 60  # Период в секундах
 
-# Словарь для хранения времени последнего вызова команды для каждого пользователя
-user_call_times: Dict[int, float] = {}
+
+class TokenBucket:
+    """
+    Асинхронное ведро токенов: пополняется со скоростью rate токенов в секунду
+    и хранит не больше capacity токенов про запас.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        self._refill()
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+    async def acquire(self, tokens: float = 1):
+        while not self.try_acquire(tokens):
+            await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+
+class SlidingWindowPolicy:
+    """
+    Не больше calls вызовов за любые period секунд для каждого ключа.
+
+    Записи ключей, не обращавшихся дольше period, удаляются,
+    поэтому память растёт только с числом активных пользователей.
+    """
+
+    def __init__(self, calls: int, period: float, max_keys: int = 100000):
+        self.calls = calls
+        self.period = period
+        self.max_keys = max_keys
+        self._calls: "OrderedDict[int, Deque[float]]" = OrderedDict()
+
+    def hit(self, key: int, now: float) -> float:
+        """
+        Регистрирует вызов. Возвращает 0, если вызов разрешён, иначе время ожидания в секундах.
+        """
+        self._evict(now)
+        calls = self._calls.get(key)
+        if calls is None:
+            calls = self._calls[key] = deque()
+        else:
+            self._calls.move_to_end(key)
+        while calls and now - calls[0] >= self.period:
+            calls.popleft()
+        if len(calls) >= self.calls:
+            return self.period - (now - calls[0])
+        calls.append(now)
+        return 0.0
+
+    def _evict(self, now: float):
+        # Ключи упорядочены по последнему обращению: проверяем только самые старые
+        while self._calls:
+            key, calls = next(iter(self._calls.items()))
+            if len(self._calls) <= self.max_keys and calls and now - calls[-1] < self.period:
+                break
+            del self._calls[key]
+
+    def __len__(self) -> int:
+        return len(self._calls)
 
 
-def rate_limit(calls: int = RATE_LIMIT_CALLS, period: int = RATE_LIMIT_PERIOD):
+class TokenBucketPolicy:
+    """
+    Ведро токенов на ключ: calls вызовов подряд, затем calls за каждые period секунд.
+
+    Ведро, наполнившееся до краёв, ничем не отличается от нового,
+    поэтому такие записи удаляются.
+    """
+
+    def __init__(self, calls: int, period: float, max_keys: int = 100000):
+        self.capacity = calls
+        self.rate = calls / period
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[int, Tuple[float, float]]" = OrderedDict()
+
+    def hit(self, key: int, now: float) -> float:
+        self._evict(now)
+        tokens, updated = self._buckets.pop(key, (self.capacity, now))
+        tokens = min(self.capacity, tokens + (now - updated) * self.rate)
+        if tokens < 1:
+            self._buckets[key] = (tokens, now)
+            return (1 - tokens) / self.rate
+        self._buckets[key] = (tokens - 1, now)
+        return 0.0
+
+    def _evict(self, now: float):
+        refill_time = self.capacity / self.rate
+        while self._buckets:
+            key, (tokens, updated) = next(iter(self._buckets.items()))
+            if len(self._buckets) <= self.max_keys and now - updated < refill_time:
+                break
+            del self._buckets[key]
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+POLICIES = {
+    'sliding': SlidingWindowPolicy,
+    'bucket': TokenBucketPolicy,
+}
+
+# Общий лимит на все команды бота, чтобы волна спама не съела бюджет Telegram API
+global_limiter = TokenBucket(Config.COMMAND_GLOBAL_RATE) if Config.COMMAND_GLOBAL_RATE > 0 else None
+
+
+def rate_limit(calls: int = RATE_LIMIT_CALLS, period: int = RATE_LIMIT_PERIOD, policy: str = 'sliding'):
     """
     Декоратор для ограничения количества вызовов команды пользователем.
 
+    Каждая декорированная команда получает собственный лимит.
+
     :param calls: Максимальное количество вызовов
     :param period: Период в секундах
+    :param policy: 'sliding' - скользящее окно, 'bucket' - ведро токенов
     """
     def decorator(func: Callable) -> Callable:
+        limiter = POLICIES[policy](calls, period)
+
         @wraps(func)
         async def wrapper(client, message, *args, **kwargs):
             user_id = message.from_user.id
@@ -29,19 +153,20 @@ def rate_limit(calls: int = RATE_LIMIT_CALLS, period: int = RATE_LIMIT_PERIOD):
             if user_id in Config.ADMIN_USER_IDS:
                 return await func(client, message, *args, **kwargs)
 
-            current_time = time.time()
-            last_call = user_call_times.get(user_id, 0)
+            if global_limiter is not None and not global_limiter.try_acquire():
+                # Бот перегружен: молча пропускаем команду, чтобы не тратить запросы на ответы
+                logger.debug(f"Команда {func.__name__} от {user_id} отброшена общим лимитом.")
+                return
 
-            if current_time - last_call < period:
-                wait_time = int(period - (current_time - last_call))
+            wait_time = limiter.hit(user_id, time.monotonic())
+            if wait_time > 0:
                 await message.reply_text(
-                    f"Пожалуйста, подождите {wait_time} секунд перед повторным использованием этой команды."
+                    f"Пожалуйста, подождите {math.ceil(wait_time)} секунд перед повторным использованием этой команды."
                 )
                 return
-            else:
-                user_call_times[user_id] = current_time
-                return await func(client, message, *args, **kwargs)
+            return await func(client, message, *args, **kwargs)
 
+        wrapper.limiter = limiter
         return wrapper
 
     return decorator
@@ -0,0 +1,321 @@
+# report.py
+
+import gzip
+import html
+import re
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from config import Config
+
+MAX_MESSAGE_LENGTH = 4096  # Ограничение Telegram на длину сообщения
+# Место под " (организация)" в строке отчёта, отправленного до определения организаций:
+# при последующей правке сообщение не выйдет за лимит и не сдвинет границы сообщений
+ORGANIZATION_RESERVE = 48
+MARKS = ("✅", "❌")
+
+# Символы разметки Pyrogram (**, __, --, ~~, ||, `, [..](..)) заменяем HTML-сущностями:
+# парсер Markdown их не видит, а HTML-парсер Pyrogram превращает обратно в символы
+_MARKDOWN_ESCAPES = str.maketrans({
+    '*': '&#42;',
+    '_': '&#95;',
+    '-': '&#45;',
+    '~': '&#126;',
+    '|': '&#124;',
+    '`': '&#96;',
+    '[': '&#91;',
+})
+
+
+def escape_markdown(text: str) -> str:
+    """
+    Экранирует произвольный текст (домен, название организации) для ParseMode.MARKDOWN.
+    """
+    return html.escape(text, quote=False).translate(_MARKDOWN_ESCAPES)
+
+
+def _truncate_escaped(text: str, size: int) -> str:
+    """
+    Обрезает экранированный текст до size символов, не разрывая HTML-сущность.
+    """
+    if len(text) <= size:
+        return text
+    text = text[:size]
+    amp = text.rfind('&')
+    if amp != -1 and ';' not in text[amp:]:
+        text = text[:amp]
+    return text
+
+
+class ReportBuilder:
+    """
+    Собирает отчёт из строк в сообщения не длиннее limit символов.
+
+    Строки накапливаются в списке и склеиваются один раз на сообщение,
+    поэтому сборка линейна по числу строк. Если раздел не помещается
+    в одно сообщение, его заголовок повторяется в начале следующего.
+    """
+
+    def __init__(self, limit: int = MAX_MESSAGE_LENGTH):
+        self.limit = limit
+        self.chunks: List[str] = []
+        self._lines: List[str] = []
+        self._size = 0
+        self._title: Optional[str] = None
+
+    def section(self, title: str):
+        if self._lines:
+            self._append("")
+        self._title = title
+        self._append(f"**{escape_markdown(title)}**")
+
+    def add(self, line: str, escape: bool = True, reserve: int = 0):
+        """
+        :param reserve: Сколько символов оставить в сообщении под дополнение строки
+        """
+        self._append(escape_markdown(line) if escape else line, reserve)
+
+    def _append(self, line: str, reserve: int = 0):
+        size = len(line) + 1 + reserve
+        if self._lines and self._size + size > self.limit:
+            self._flush()
+            if self._title is not None and line:
+                header = f"**{escape_markdown(self._title)} (продолжение)**"
+                self._lines.append(header)
+                self._size = len(header) + 1
+        self._lines.append(_truncate_escaped(line, self.limit - reserve))
+        self._size += size
+
+    def _flush(self):
+        if self._lines:
+            self.chunks.append("\n".join(self._lines))
+        self._lines = []
+        self._size = 0
+
+    def build(self) -> List[str]:
+        self._flush()
+        return self.chunks
+
+
+class Report:
+    def __init__(self, chunks: List[str], attachment: Optional[bytes] = None, attachment_name: str = ""):
+        self.chunks = chunks
+        self.attachment = attachment
+        self.attachment_name = attachment_name
+
+
+def build_change_report(added: Dict[str, str], removed: Dict[str, str],
+                        max_entries: int = Config.REPORT_MAX_ENTRIES,
+                        limit: int = MAX_MESSAGE_LENGTH, source: Optional[str] = None,
+                        attach: bool = True) -> Report:
+    """
+    Формирует отчёт об изменениях.
+
+    Домены с организацией None выводятся без неё, с запасом места, чтобы
+    позже дополнить отправленные сообщения через fill_organizations.
+    В сообщения попадает не больше max_entries строк на раздел; если изменений
+    больше, полный список прикладывается сжатым файлом (при attach=False
+    остаток только упоминается). Если указан источник, его имя добавляется
+    в заголовки разделов.
+    """
+    builder = ReportBuilder(limit)
+    truncated = False
+    for title, mark, domains in (("Добавлены новые домены", "✅", added),
+                                 ("Удалены домены", "❌", removed)):
+        if not domains:
+            continue
+        builder.section(f"{title} ({source}):" if source else f"{title}:")
+        for i, domain in enumerate(sorted(domains)):
+            if i == max_entries:
+                builder.add(f"... и ещё {len(domains) - max_entries}" + (", полный список во вложении" if attach else ""))
+                truncated = True
+                break
+            organization = domains[domain]
+            if organization is None:
+                # Организация ещё не определена: строка дополнится правкой сообщения
+                builder.add(f"{mark} {domain}", reserve=ORGANIZATION_RESERVE)
+            else:
+                builder.add(f"{mark} {domain} ({organization})")
+
+    if not truncated or not attach:
+        return Report(builder.build())
+    prefix = f"{source}-" if source else ""
+    return Report(builder.build(), build_diff_file(added, removed),
+                  time.strftime(f"{prefix}changes-%Y%m%d-%H%M%S.txt.gz"))
+
+
+def fill_organizations(text: str, organizations: Dict[str, str]) -> str:
+    """
+    Дополняет сообщение отчёта, отправленное без организаций, названиями организаций.
+
+    Слишком длинные названия сокращаются до места, зарезервированного
+    при сборке отчёта, поэтому сообщение остаётся в пределах лимита.
+    """
+    lines = text.split("\n")
+    for i, line in enumerate(lines):
+        mark, _, rest = line.partition(" ")
+        if mark not in MARKS or " " in rest:
+            continue
+        organization = organizations.get(html.unescape(rest))
+        if organization is None:
+            continue
+        suffix = f" ({escape_markdown(organization)})"
+        while len(suffix) > ORGANIZATION_RESERVE:
+            organization = organization[:-1]
+            suffix = f" ({escape_markdown(organization)}…)"
+        lines[i] = line + suffix
+    return "\n".join(lines)
+
+
+def build_diff_file(added: Dict[str, str], removed: Dict[str, str]) -> bytes:
+    lines = [f"+ {domain}\t{added[domain]}" for domain in sorted(added)]
+    lines.extend(f"- {domain}\t{removed[domain]}" for domain in sorted(removed))
+    return gzip.compress(("\n".join(lines) + "\n").encode('utf-8'))
+
+
+_RELATIVE_SINCE = re.compile(r'^(\d+)([mhdw])$')
+_UNITS = {'m': 60, 'h': 3600, 'd': 86400, 'w': 7 * 86400}
+
+
+def parse_since(text: str, now: Optional[float] = None) -> Optional[float]:
+    """
+    Разбирает начало периода: относительное ("30m", "24h", "7d", "2w")
+    или дату в формате ISO ("2024-05-01", "2024-05-01T12:00") по местному времени.
+    """
+    text = text.strip().lower()
+    match = _RELATIVE_SINCE.match(text)
+    if match:
+        return (now if now is not None else time.time()) - int(match.group(1)) * _UNITS[match.group(2)]
+    try:
+        return datetime.fromisoformat(text).timestamp()
+    except ValueError:
+        return None
+
+
+def build_events_page(events: List[tuple], title: str, next_command: Optional[str] = None,
+                      limit: int = MAX_MESSAGE_LENGTH) -> List[str]:
+    """
+    Форматирует страницу истории изменений: строки (event_id, domain, action,
+    source, organization, created_at). Если есть следующая страница,
+    в конце указывается команда для её получения.
+    """
+    builder = ReportBuilder(limit)
+    builder.section(title)
+    for _, domain, action, source, organization, created_at in events:
+        mark = "✅" if action == 'added' else "❌"
+        moment = time.strftime('%Y-%m-%d %H:%M', time.localtime(created_at))
+        builder.add(f"{moment} {mark} {domain} ({organization or 'Неизвестно'}), {source}")
+    if next_command:
+        builder.add("")
+        builder.add(f"Дальше: {next_command}")
+    return builder.build()
+
+
+def build_search_page(domains: List[Tuple[str, Optional[str]]], title: str, next_command: Optional[str] = None,
+                      limit: int = MAX_MESSAGE_LENGTH) -> List[str]:
+    """
+    Форматирует страницу результатов поиска: домены с организациями.
+    Если есть следующая страница, в конце указывается команда для её получения.
+    """
+    builder = ReportBuilder(limit)
+    builder.section(title)
+    for domain, organization in domains:
+        builder.add(f"{domain} ({organization or 'Неизвестно'})")
+    if next_command:
+        builder.add("")
+        builder.add(f"Дальше: {next_command}")
+    return builder.build()
+
+
+def build_lookup_text(info) -> str:
+    """
+    Ответ /lookup по DomainInfo: есть ли домен в списке, организация, источники и с какого момента.
+    """
+    domain = escape_markdown(info.domain)
+    event = info.last_event
+    moment = time.strftime('%Y-%m-%d %H:%M', time.localtime(event[5])) if event else None
+    if not info.present:
+        lines = [f"❌ Домена {domain} нет в списке."]
+        if event and event[2] == 'removed':
+            lines.append(f"Удалён {moment} из источника {escape_markdown(event[3])}.")
+        return "\n".join(lines)
+    lines = [
+        f"✅ Домен {domain} в списке.",
+        f"Организация: {escape_markdown(info.organization or 'Неизвестно')}",
+        f"Источники: {escape_markdown(', '.join(info.sources))}",
+    ]
+    if event is None:
+        lines.append("Дата добавления неизвестна: домен загружен до начала ведения истории.")
+    elif event[2] == 'added':
+        lines.append(f"В списке с {moment} (источник {escape_markdown(event[3])}).")
+    else:
+        lines.append(f"Последнее изменение: {moment} удалён из источника {escape_markdown(event[3])}.")
+    return "\n".join(lines)
+
+
+def build_versions_page(snapshots: List[tuple], title: str, limit: int = MAX_MESSAGE_LENGTH) -> List[str]:
+    """
+    Форматирует список версий из строк snapshots (version, kind, run_id,
+    domains, added, removed, created_at, digest), от новых к старым.
+    """
+    versions: Dict[int, dict] = {}
+    for version, kind, run_id, domains, added, removed, created_at, _ in snapshots:
+        entry = versions.setdefault(version, {'kinds': set(), 'created_at': created_at})
+        entry['kinds'].add(kind)
+        entry['domains'] = domains
+        if kind == 'delta':
+            entry.update(run_id=run_id, added=added, removed=removed)
+    builder = ReportBuilder(limit)
+    builder.section(title)
+    for version in sorted(versions, reverse=True):
+        entry = versions[version]
+        moment = time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['created_at']))
+        line = f"v{version} {moment}: {entry['domains']} доменов"
+        if 'added' in entry:
+            line += f", +{entry['added']} -{entry['removed']}"
+            if entry['run_id'] is not None:
+                line += f" (проверка #{entry['run_id']})"
+        if 'base' in entry['kinds']:
+            line += ", полный снимок"
+        builder.add(line)
+    return builder.build()
+
+
+class ReportDigest:
+    """
+    Копит небольшие изменения нескольких проверок и отдаёт их одним отчётом
+    раз в interval секунд. Домен, добавленный и удалённый в пределах
+    одного дайджеста, в отчёт не попадает.
+
+    Накопленные изменения хранятся только в памяти: при перезапуске бота
+    несостоявшийся дайджест теряется, хотя база данных уже обновлена.
+    """
+
+    def __init__(self, interval: float, max_entries: int):
+        self.interval = interval
+        self.max_entries = max_entries
+        self.added: Dict[str, str] = {}
+        self.removed: Dict[str, str] = {}
+        self.started: Optional[float] = None
+
+    def accepts(self, changes: int) -> bool:
+        return changes + len(self.added) + len(self.removed) <= self.max_entries
+
+    def add(self, added: Dict[str, str], removed: Dict[str, str]):
+        if self.started is None:
+            self.started = time.monotonic()
+        for domain, organization in added.items():
+            if self.removed.pop(domain, None) is None:
+                self.added[domain] = organization
+        for domain, organization in removed.items():
+            if self.added.pop(domain, None) is None:
+                self.removed[domain] = organization
+
+    def due(self) -> bool:
+        return self.started is not None and time.monotonic() - self.started >= self.interval
+
+    def flush(self) -> Tuple[Dict[str, str], Dict[str, str]]:
+        added, removed = self.added, self.removed
+        self.added, self.removed, self.started = {}, {}, None
+        return added, removed
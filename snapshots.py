@@ -0,0 +1,431 @@
+# snapshots.py
+
+import asyncio
+import gzip
+import heapq
+import itertools
+import logging
+import os
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from config import Config
+from database import domains_digest
+
+logger = logging.getLogger(__name__)
+
+BASE = 'base'    # Полный список версии: домены по возрастанию, по одному на строку
+DELTA = 'delta'  # Переход от предыдущей версии: "+домен" и "-домен" по возрастанию домена
+CHUNK_SIZE = 1024 * 1024
+BATCH_SIZE = 50000
+
+Change = Tuple[str, bool]  # (домен, есть ли он после изменения)
+
+
+def _read_batches(path: str) -> Iterator[List[str]]:
+    # Сжатый файл читается блоками по мегабайту и режется на строки целиком:
+    # в разы быстрее построчного чтения через текстовую обёртку
+    with gzip.open(path, 'rb') as f:
+        rest = b''
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            chunk = rest + chunk
+            end = chunk.rfind(b'\n') + 1
+            rest = chunk[end:]
+            if end:
+                yield chunk[:end].decode('utf-8').splitlines()
+        if rest:
+            yield [rest.decode('utf-8')]
+
+
+def _iter_lines(path: str) -> Iterator[str]:
+    for batch in _read_batches(path):
+        yield from batch
+
+
+def _fold(paths: List[str]) -> Iterator[Tuple[str, bool, bool]]:
+    """
+    Сливает файлы изменений подряд идущих версий в один поток по возрастанию
+    домена: (домен, был ли он до первого изменения, есть ли после последнего).
+    """
+    def stream(index: int, path: str) -> Iterator[Tuple[str, int, bool]]:
+        for line in _iter_lines(path):
+            yield line[1:], index, line[0] == '+'
+
+    streams = [stream(index, path) for index, path in enumerate(paths)]
+    # При равных доменах heapq.merge отдаёт изменения в порядке версий
+    for domain, group in itertools.groupby(heapq.merge(*streams), key=lambda item: item[0]):
+        first = last = next(group)
+        for last in group:
+            pass
+        # Запись "+" появляется, только если домена не было, "-" - только если был
+        yield domain, not first[2], last[2]
+
+
+def _apply(domains: Iterator[str], changes: Iterator[Tuple[str, bool, bool]]) -> Iterator[str]:
+    """
+    Накладывает слитые изменения на отсортированный список слиянием двух потоков.
+    """
+    change = next(changes, None)
+    for domain in domains:
+        while change is not None and change[0] < domain:
+            if change[2]:
+                yield change[0]
+            change = next(changes, None)
+        if change is not None and change[0] == domain:
+            if change[2]:
+                yield domain
+            change = next(changes, None)
+        else:
+            yield domain
+    while change is not None:
+        if change[2]:
+            yield change[0]
+        change = next(changes, None)
+
+
+def _net(changes: Iterator[Tuple[str, bool, bool]]) -> Iterator[Change]:
+    # Домен, который добавили и снова удалили (или наоборот), в итоговую разницу не попадает
+    for domain, before, after in changes:
+        if before != after:
+            yield domain, after
+
+
+def _compare(old: Iterator[str], new: Iterator[str]) -> Iterator[Change]:
+    """
+    Разница двух отсортированных списков слиянием, без загрузки их в память.
+    """
+    old_domain = next(old, None)
+    new_domain = next(new, None)
+    while old_domain is not None or new_domain is not None:
+        if new_domain is None or (old_domain is not None and old_domain < new_domain):
+            yield old_domain, False
+            old_domain = next(old, None)
+        elif old_domain is None or new_domain < old_domain:
+            yield new_domain, True
+            new_domain = next(new, None)
+        else:
+            old_domain = next(old, None)
+            new_domain = next(new, None)
+
+
+def _write_lines(path: str, lines: Iterable[str]) -> int:
+    """
+    Записывает строки в сжатый файл атомарно: рядом, с fsync, затем rename.
+    Возвращает число строк.
+    """
+    tmp_path = path + '.tmp'
+    count = 0
+    with open(tmp_path, 'wb') as raw:
+        with gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=6) as f:
+            for batch in iter(lambda: list(itertools.islice(lines, BATCH_SIZE)), []):
+                f.write(('\n'.join(batch) + '\n').encode('utf-8'))
+                count += len(batch)
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(tmp_path, path)
+    return count
+
+
+def _write_changes(path: str, changes: Iterable[Change]) -> Tuple[int, int]:
+    counts = [0, 0]
+
+    def lines():
+        for domain, present in changes:
+            counts[0 if present else 1] += 1
+            yield ('+' if present else '-') + domain
+
+    _write_lines(path, lines())
+    return counts[0], counts[1]
+
+
+class SnapshotStore:
+    """
+    Версии списков доменов источников: периодические полные снимки и файлы
+    изменений каждого применённого запуска.
+
+    Версия появляется вместе с изменением source_domains: файл изменений
+    пишется заранее, а строка версии в таблице snapshots добавляется в той же
+    транзакции, что и изменения базы. Поэтому версии в базе всегда совпадают
+    с тем, что в ней хранится, а файл прерванного запуска просто перезаписывается.
+
+    Каждые base_every версий изменения сливаются с последним полным снимком
+    в новый. Любая версия собирается из ближайшего полного снимка
+    и следующих за ним изменений, разница двух версий - из изменений между
+    ними; всё это потоковые слияния отсортированных файлов. Хранятся
+    keep_bases последних полных снимков и изменения после самого старого из них.
+    """
+
+    def __init__(self, database, directory: str = Config.SNAPSHOT_DIR,
+                 base_every: int = Config.SNAPSHOT_BASE_EVERY, keep_bases: int = Config.SNAPSHOT_KEEP_BASES):
+        self.database = database
+        self.directory = directory
+        self.base_every = max(1, base_every)
+        # Текущую версию читают из последнего и предпоследнего снимка, пока создаётся новый
+        self.keep_bases = max(2, keep_bases)
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._compactions: Dict[str, asyncio.Future] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.directory)
+
+    def _lock(self, source: str) -> asyncio.Lock:
+        return self._locks.setdefault(source, asyncio.Lock())
+
+    def path(self, source: str, version: int, kind: str) -> str:
+        return os.path.join(self.directory, source, f"{kind}-{version:08d}.gz")
+
+    @staticmethod
+    async def _run(func: Callable, *args):
+        return await asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+    async def _versions(self, source: str) -> Dict[int, Dict[str, tuple]]:
+        versions: Dict[int, Dict[str, tuple]] = {}
+        for row in await self.database.get_snapshots(source):
+            versions.setdefault(row[0], {})[row[1]] = row
+        return versions
+
+    def _chain(self, versions: Dict[int, Dict[str, tuple]], version: int) -> Optional[Tuple[int, List[int]]]:
+        # Ближайший полный снимок не новее version и все изменения после него
+        bases = [v for v, kinds in versions.items() if BASE in kinds and v <= version]
+        if not bases or version not in versions:
+            return None
+        base = max(bases)
+        deltas = list(range(base + 1, version + 1))
+        if any(DELTA not in versions.get(v, {}) for v in deltas):
+            return None
+        return base, deltas
+
+    def _rebuild(self, source: str, chain: Tuple[int, List[int]]) -> Iterator[str]:
+        base, deltas = chain
+        lines = _iter_lines(self.path(source, base, BASE))
+        if not deltas:
+            return lines
+        return _apply(lines, _fold([self.path(source, v, DELTA) for v in deltas]))
+
+    async def latest(self, source: str) -> Optional[Tuple[int, int, Optional[int]]]:
+        """
+        Последняя версия источника, число доменов в ней и её отпечаток (domains_digest).
+        """
+        versions = await self._versions(source)
+        if not versions:
+            return None
+        version = max(versions)
+        row = next(iter(versions[version].values()))
+        return version, row[3], row[7]
+
+    @asynccontextmanager
+    async def record(self, source: str, added: Iterable[str], removed: Iterable[str],
+                     run_id: Optional[int] = None):
+        """
+        Записывает изменения источника новой версией. Изменения базы
+        выполняются внутри блока, в той же транзакции, что и запись версии.
+
+        Пока у источника нет ни одной версии (первый снимок записывает resync
+        при чтении списка из базы), изменения только применяются к базе.
+        """
+        async with self._lock(source):
+            delta = None
+            if self.enabled:
+                try:
+                    delta = await self._write_delta(source, added, removed)
+                except Exception as e:
+                    logger.error(f"Не удалось записать изменения источника {source} в снимок: {e}")
+            async with self.database.transaction():
+                yield
+                if delta is not None:
+                    version, domains, counts, digest = delta
+                    await self.database.add_snapshot(source, version, DELTA, run_id, domains, *counts, digest)
+        if delta is not None:
+            logger.debug(f"Записана версия {delta[0]} списка источника {source}.")
+            self._schedule_compaction(source)
+
+    async def _write_delta(self, source: str, added: Iterable[str],
+                           removed: Iterable[str]) -> Optional[Tuple[int, int, Tuple[int, int], Optional[int]]]:
+        # Новая версия, число доменов в ней, число добавленных и удалённых и отпечаток
+        changes = sorted([(domain, True) for domain in added] + [(domain, False) for domain in removed])
+        latest = await self.latest(source)
+        if latest is None or not changes:
+            return None
+        version, domains, digest = latest
+        counts = await self._run(_write_changes, self.path(source, version + 1, DELTA), iter(changes))
+        if digest is not None:
+            digest = domains_digest((domain for domain, present in changes if present), digest)
+            digest = domains_digest((domain for domain, present in changes if not present), digest, sign=-1)
+        return version + 1, domains + counts[0] - counts[1], counts, digest
+
+    async def resync(self, source: str, batches: Callable[[], AsyncIterator[List[str]]]):
+        """
+        Записывает содержимое базы новой версией: полным снимком и, если
+        предыдущая версия есть, изменениями относительно неё. Нужно, когда
+        база изменилась в обход снимков.
+        """
+        async with self._lock(source):
+            os.makedirs(os.path.join(self.directory, source), exist_ok=True)
+            versions = await self._versions(source)
+            version = max(versions) + 1 if versions else 1
+            base_path = self.path(source, version, BASE)
+            count, digest = await self._write_batches(base_path, batches())
+            counts = None
+            chain = self._chain(versions, version - 1) if versions else None
+            if chain is not None:
+                counts = await self._run(_write_changes, self.path(source, version, DELTA),
+                                         _compare(self._rebuild(source, chain), _iter_lines(base_path)))
+            async with self.database.transaction():
+                # Отпечаток в базе ведётся по изменениям и не видит правок таблицы
+                # в обход бота: после полного прохода он заменяется точным
+                await self.database.set_source_digest(source, digest)
+                await self.database.add_snapshot(source, version, BASE, None, count, 0, 0, digest)
+                if counts is not None:
+                    await self.database.add_snapshot(source, version, DELTA, None, count, *counts, digest)
+        logger.info(f"Создан полный снимок источника {source}: версия {version}, {count} доменов.")
+
+    async def _write_batches(self, path: str, batches: AsyncIterator[List[str]]) -> Tuple[int, int]:
+        # Пачки приходят из базы асинхронно, поэтому сжатие, запись и подсчёт
+        # отпечатка идут в пуле по пачке. Возвращает число доменов и отпечаток
+        tmp_path = path + '.tmp'
+        count = digest = 0
+        raw = open(tmp_path, 'wb')
+
+        def write(batch: List[str], digest: int) -> int:
+            f.write(('\n'.join(batch) + '\n').encode('utf-8'))
+            return domains_digest(batch, digest)
+
+        try:
+            with gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=6) as f:
+                async for batch in batches:
+                    if batch:
+                        digest = await self._run(write, batch, digest)
+                        count += len(batch)
+            raw.flush()
+            await self._run(os.fsync, raw.fileno())
+        finally:
+            raw.close()
+        os.replace(tmp_path, path)
+        return count, digest
+
+    async def current(self, source: str, expected: int,
+                      expected_digest: int) -> Optional[Callable[[], AsyncIterator[List[str]]]]:
+        """
+        Пачки последней версии источника для тёплого старта вместо чтения базы
+        или None, если снимков нет или число доменов либо отпечаток не совпадают с базой.
+        """
+        if not self.enabled:
+            return None
+        versions = await self._versions(source)
+        if not versions:
+            return None
+        version = max(versions)
+        row = next(iter(versions[version].values()))
+        domains, digest = row[3], row[7]
+        chain = self._chain(versions, version)
+        if chain is None or domains != expected or digest != expected_digest:
+            logger.warning(f"Снимок источника {source} (версия {version}, {domains} доменов) "
+                           f"не совпадает с базой ({expected} доменов) или отпечатком списка.")
+            return None
+
+        async def batches() -> AsyncIterator[List[str]]:
+            base, deltas = chain
+            if deltas:
+                lines = self._rebuild(source, chain)
+                reader = iter(lambda: list(itertools.islice(lines, BATCH_SIZE)), [])
+            else:
+                reader = _read_batches(self.path(source, base, BASE))
+            while True:
+                batch = await self._run(next, reader, None)
+                if batch is None:
+                    break
+                yield batch
+
+        return batches
+
+    async def resolve(self, source: str, moment: float) -> Optional[int]:
+        """
+        Версия, действовавшая в момент moment.
+        """
+        return await self.database.get_snapshot_version_at(source, moment)
+
+    async def export(self, source: str, version: int, path: str) -> Optional[int]:
+        """
+        Собирает версию в сжатый файл со списком доменов. None - версии нет или она удалена.
+        """
+        async with self._lock(source):
+            chain = self._chain(await self._versions(source), version)
+            if chain is None:
+                return None
+            return await self._run(_write_lines, path, self._rebuild(source, chain))
+
+    async def diff(self, source: str, old: int, new: int, path: str) -> Optional[Tuple[int, int]]:
+        """
+        Разница версий old и new в сжатый файл строками "+домен" и "-домен".
+        Возвращает число добавленных и удалённых доменов или None, если версий нет.
+
+        Между соседними по журналу версиями сливаются только файлы изменений;
+        если цепочка изменений прерывается, сравниваются две собранные версии.
+        """
+        async with self._lock(source):
+            versions = await self._versions(source)
+            low, high = sorted((old, new))
+            if low not in versions or high not in versions:
+                return None
+            deltas = list(range(low + 1, high + 1))
+            if all(DELTA in versions.get(v, {}) for v in deltas):
+                changes = _net(_fold([self.path(source, v, DELTA) for v in deltas]))
+            else:
+                low_chain, high_chain = self._chain(versions, low), self._chain(versions, high)
+                if low_chain is None or high_chain is None:
+                    return None
+                changes = _compare(self._rebuild(source, low_chain), self._rebuild(source, high_chain))
+            if old > new:
+                changes = ((domain, not present) for domain, present in changes)
+            return await self._run(_write_changes, path, changes)
+
+    def _schedule_compaction(self, source: str):
+        task = self._compactions.get(source)
+        if task is None or task.done():
+            self._compactions[source] = asyncio.ensure_future(self.compact(source))
+
+    async def compact(self, source: str):
+        """
+        Сливает изменения с последним полным снимком, когда их набралось
+        base_every, и удаляет версии старше keep_bases последних снимков.
+        """
+        try:
+            async with self._lock(source):
+                versions = await self._versions(source)
+                version = max(versions)
+                bases = sorted(v for v, kinds in versions.items() if BASE in kinds)
+                if not bases or version - bases[-1] < self.base_every:
+                    return
+                chain = self._chain(versions, version)
+                if chain is None:
+                    return
+                count = await self._run(_write_lines, self.path(source, version, BASE),
+                                        self._rebuild(source, chain))
+                # Полный снимок той же версии: отпечаток тот же, что у её изменений
+                digest = versions[version][DELTA][7]
+                async with self.database.transaction():
+                    await self.database.add_snapshot(source, version, BASE, None, count, 0, 0, digest)
+                bases.append(version)
+                if len(bases) > self.keep_bases:
+                    oldest = bases[-self.keep_bases]
+                    # Изменение самой старой оставшейся версии ссылается на удаляемую предыдущую
+                    await self.database.delete_snapshots(source, oldest)
+                    for v, kinds in versions.items():
+                        for kind in kinds:
+                            if v < oldest or (v == oldest and kind == DELTA):
+                                try:
+                                    os.remove(self.path(source, v, kind))
+                                except FileNotFoundError:
+                                    pass
+                logger.info(f"Создан полный снимок источника {source}: версия {version}, {count} доменов.")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка при уплотнении снимков источника {source}: {e}")
+
+    async def close(self):
+        for task in self._compactions.values():
+            task.cancel()
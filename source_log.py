@@ -0,0 +1,238 @@
+# source_log.py
+
+import asyncio
+import logging
+import os
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+import aiofiles
+
+from domain_parser import GZIP_MAGIC, LINE_FORMATS, PARSERS, iter_domain_batches, iter_file_chunks, normalize_domain
+from domain_set import DomainSet
+
+logger = logging.getLogger(__name__)
+
+
+def file_stat(path: str) -> list:
+    """
+    Размер и время изменения файла - ключ, по которому видно, что файл не менялся.
+    Список, а не кортеж: ключ хранится в состоянии источника в JSON.
+    """
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+class LogTail:
+    """
+    Изменения локального списка, найденные по хвосту журнала.
+
+    Повторяет интерфейс DomainSet.diff, поэтому проверка обрабатывает
+    его так же, как множество, построенное полным разбором файла.
+    """
+
+    def __init__(self, added: set, removed: set):
+        self.added = added
+        self.removed = removed
+
+    def __len__(self) -> int:
+        return len(self.added) + len(self.removed)
+
+    async def diff(self, previous=None) -> Tuple[set, set]:
+        return self.added, self.removed
+
+
+class SourceLog:
+    """
+    Локальный список доменов с журналом изменений.
+
+    Сам файл списка не переписывается при каждом изменении: добавления
+    и удаления дописываются в соседний файл <path>.log записями "+домен"
+    и "-домен" (удаление - запись-надгробие). Итоговый список - это файл
+    с применёнными поверх него записями журнала, для каждого домена
+    действует последняя запись.
+
+    Когда записей набирается много, журнал уплотняется: новый файл списка
+    пишется рядом и атомарно подменяет старый через rename, после чего
+    журнал очищается. Если процесс упадёт между этими шагами, записи
+    журнала применятся к новому файлу повторно с тем же результатом.
+
+    Для проверки дубликатов в памяти держится индекс: итоговые записи
+    журнала и компактное множество отпечатков файла (DomainSet), которое
+    перестраивается, только когда файл изменился.
+    """
+
+    def __init__(self, path: str, parser: str = 'list'):
+        self.path = path
+        self.log_path = path + '.log'
+        self.parser = parser
+        self.normalize = PARSERS[parser]
+        # Итоговая запись журнала по домену: True - добавлен, False - удалён
+        self.overlay: Dict[str, bool] = {}
+        self.offset = 0  # Прочитанная часть журнала в байтах
+        self.records = 0
+        self._index: Optional[DomainSet] = None
+        self._index_stat: Optional[list] = None
+        self.lock = asyncio.Lock()
+
+    def log_size(self) -> int:
+        try:
+            return os.path.getsize(self.log_path)
+        except FileNotFoundError:
+            return 0
+
+    async def _read_records(self, offset: int) -> Tuple[Dict[str, bool], int, int]:
+        # Читаются только целые строки: оборванная сбоем последняя запись пропускается
+        if not os.path.exists(self.log_path):
+            return {}, 0, 0
+        async with aiofiles.open(self.log_path, 'rb') as f:
+            await f.seek(offset)
+            data = await f.read()
+        end = data.rfind(b'\n') + 1
+        ops = {}
+        count = 0
+        for line in data[:end].decode('utf-8', errors='replace').splitlines():
+            if len(line) < 2 or line[0] not in '+-':
+                continue
+            ops[line[1:]] = line[0] == '+'
+            count += 1
+        return ops, offset + end, count
+
+    async def refresh(self) -> int:
+        """
+        Дочитывает в индекс новые записи журнала. Возвращает прочитанную длину журнала.
+        """
+        if self.log_size() < self.offset:
+            # Журнал уплотнили или удалили в обход этого объекта: читаем заново
+            self.overlay, self.offset, self.records = {}, 0, 0
+        ops, self.offset, count = await self._read_records(self.offset)
+        self.overlay.update(ops)
+        self.records += count
+        return self.offset
+
+    async def read_tail(self, offset: int) -> Optional[Tuple[Dict[str, bool], int]]:
+        """
+        Итоговые записи журнала после позиции offset и новая позиция.
+        Возвращает None, если журнал с тех пор уплотнён и позиция недействительна.
+        """
+        if self.log_size() < offset:
+            return None
+        ops, end, _ = await self._read_records(offset)
+        return ops, end
+
+    def batches(self) -> AsyncIterator[List[str]]:
+        """
+        Пачки доменов итогового списка: файл с применёнными записями журнала.
+        Журнал берётся на момент вызова, поэтому сначала нужно вызвать refresh.
+        """
+        return self._batches(dict(self.overlay))
+
+    async def _batches(self, overlay: Dict[str, bool]) -> AsyncIterator[List[str]]:
+        if os.path.exists(self.path):
+            async for batch in iter_domain_batches(iter_file_chunks(self.path), name=self.path,
+                                                   normalize=self.normalize):
+                if overlay:
+                    batch = [domain for domain in batch if overlay.get(domain, True)]
+                if batch:
+                    yield batch
+        added = [domain for domain, present in overlay.items() if present]
+        if added:
+            yield added
+
+    async def contains(self, domain: str) -> bool:
+        """
+        Есть ли домен в итоговом списке. Файл читается, только если
+        индекс ещё не построен или файл изменился.
+        """
+        await self.refresh()
+        if domain in self.overlay:
+            return self.overlay[domain]
+        if not os.path.exists(self.path):
+            return False
+        stat = file_stat(self.path)
+        if self._index is None or stat != self._index_stat:
+            self._index = await DomainSet.build(
+                iter_domain_batches(iter_file_chunks(self.path), name=self.path, normalize=self.normalize)
+            )
+            self._index_stat = stat
+            logger.debug(f"Индекс локального списка {self.path} построен: {len(self._index)} доменов.")
+        return domain in self._index
+
+    async def add(self, domain: str) -> bool:
+        """
+        Добавляет домен в список. Возвращает False, если домен уже есть.
+        """
+        return await self._append(domain, True)
+
+    async def remove(self, domain: str) -> bool:
+        """
+        Удаляет домен из списка. Возвращает False, если домена в списке нет.
+        """
+        return await self._append(domain, False)
+
+    async def _append(self, domain: str, present: bool) -> bool:
+        domain = normalize_domain(domain)
+        if domain is None:
+            raise ValueError("Неверный формат домена.")
+        async with self.lock:
+            if await self.contains(domain) == present:
+                return False
+            if self.log_size() > self.offset:
+                # Запись, оборванная сбоем, иначе склеится с новой
+                async with aiofiles.open(self.log_path, 'r+b') as f:
+                    await f.truncate(self.offset)
+            record = f"{'+' if present else '-'}{domain}\n".encode('utf-8')
+            async with aiofiles.open(self.log_path, 'ab') as f:
+                await f.write(record)
+            self.overlay[domain] = present
+            self.offset += len(record)
+            self.records += 1
+        return True
+
+    async def compact(self) -> Optional[Tuple[Optional[list], int]]:
+        """
+        Переносит записи журнала в файл списка и очищает журнал.
+
+        Возвращает ключ stat файла до уплотнения и уплотнённую длину журнала,
+        чтобы владелец мог перенести на новый файл состояние своей последней
+        проверки, или None, если уплотнять нечего.
+        """
+        async with self.lock:
+            await self.refresh()
+            if not self.records:
+                return None
+            if os.path.exists(self.path):
+                with open(self.path, 'rb') as f:
+                    if f.read(len(GZIP_MAGIC)) == GZIP_MAGIC:
+                        logger.warning(f"Локальный список {self.path} сжат, журнал изменений не уплотняется.")
+                        return None
+            stat = file_stat(self.path) if os.path.exists(self.path) else None
+            offset = self.offset
+            # Переписывание файла - синхронный последовательный проход, выполняем его вне цикла событий
+            await asyncio.get_event_loop().run_in_executor(None, self._rewrite, dict(self.overlay))
+            os.remove(self.log_path)
+            self.overlay, self.offset, self.records = {}, 0, 0
+            self._index = None
+        logger.info(f"Журнал изменений локального списка {self.path} уплотнён.")
+        return stat, offset
+
+    def _rewrite(self, overlay: Dict[str, bool]):
+        # Строки файла сохраняются как есть (с комментариями и форматом),
+        # выбрасываются только удалённые домены; добавленные дописываются в конец
+        pending = {domain for domain, present in overlay.items() if present}
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as dst:
+            if os.path.exists(self.path):
+                with open(self.path, 'r', encoding='utf-8', errors='replace') as src:
+                    for line in src:
+                        domain = self.normalize(line)
+                        if domain is not None and domain in overlay:
+                            if not overlay[domain]:
+                                continue
+                            pending.discard(domain)
+                        dst.write(line if line.endswith('\n') else line + '\n')
+            line_format = LINE_FORMATS[self.parser]
+            for domain in sorted(pending):
+                dst.write(line_format.format(domain) + '\n')
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,84 @@
+# sources.py
+
+import asyncio
+import json
+import logging
+import os
+from typing import List, Optional
+
+from config import Config
+from domain_parser import PARSERS
+from report import ReportDigest
+from source_log import SourceLog
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SOURCE = 'default'  # Имя источника из SOURCE_URL / SOURCE_PATH
+
+
+class Source:
+    """
+    Один отслеживаемый список доменов.
+
+    Хранит настройки источника (адрес, интервал проверки, формат) и состояние
+    его проверок: валидаторы последней загрузки, дайджест и текущий запуск.
+
+    :param location: URL (http/https) или путь к локальному файлу
+    :param interval: Интервал проверки в минутах
+    :param parser: Формат списка: ключ domain_parser.PARSERS
+    """
+
+    def __init__(self, name: str, location: str, interval: int = Config.CHECK_INTERVAL, parser: str = 'list'):
+        if parser not in PARSERS:
+            raise ValueError(f"Неизвестный формат списка {parser} у источника {name}")
+        self.name = name
+        self.location = location
+        self.local = not location.startswith(('http://', 'https://'))
+        self.interval = interval
+        self.parser = parser
+        # Локальный файл изменяется через журнал (см. SourceLog)
+        self.log = SourceLog(location, parser) if self.local else None
+        # Валидаторы последней применённой загрузки (None - ещё не загружены из базы)
+        # и загрузки, ожидающей применения
+        self.state: Optional[dict] = None
+        self.pending_state: Optional[dict] = None
+        self.digest = (ReportDigest(Config.REPORT_DIGEST_MINUTES * 60, Config.REPORT_DIGEST_MAX_ENTRIES)
+                       if Config.REPORT_DIGEST_MINUTES > 0 else None)
+        # Текущий запуск проверки (к нему присоединяются одновременные запросы)
+        # и блокировка, не дающая проверкам и ручным изменениям списка пересекаться
+        self.check_task: Optional[asyncio.Future] = None
+        self.lock = asyncio.Lock()
+
+    @property
+    def normalize(self):
+        return PARSERS[self.parser]
+
+    def __repr__(self):
+        return f"Source({self.name!r}, {self.location!r})"
+
+
+def load_sources(path: str = Config.SOURCES_FILE) -> List[Source]:
+    """
+    Загружает список источников из JSON-файла вида
+    [{"name": "...", "url": "..." или "path": "...", "interval": 60, "format": "list"}].
+
+    Если файла нет, используется один источник из SOURCE_URL / SOURCE_PATH.
+    """
+    if not path or not os.path.exists(path):
+        location = Config.SOURCE_PATH if Config.LOCAL_SOURCE else Config.SOURCE_URL
+        return [Source(DEFAULT_SOURCE, location)]
+
+    with open(path, 'r', encoding='utf-8') as f:
+        items = json.load(f)
+    sources = []
+    for item in items:
+        location = item.get('url') or item.get('path')
+        if not item.get('name') or not location:
+            raise ValueError(f"У источника в {path} должны быть заданы name и url или path: {item}")
+        sources.append(Source(item['name'], location, int(item.get('interval', Config.CHECK_INTERVAL)),
+                              item.get('format', 'list')))
+    names = [source.name for source in sources]
+    if not sources or len(set(names)) != len(names):
+        raise ValueError(f"В {path} должен быть хотя бы один источник, имена источников не должны повторяться.")
+    logger.info(f"Загружено источников: {len(sources)} ({', '.join(names)}).")
+    return sources
@@ -0,0 +1,134 @@
+# subscriber_filters.py
+
+import logging
+from collections import deque
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+SUFFIX = 'suffix'    # ".ru", ".example.com": домен или его поддомены
+KEYWORD = 'keyword'  # "bank": подстрока в любом месте домена
+
+_USERS = None  # Ключ узла дерева суффиксов, под которым лежат подписчики
+
+
+def parse_filter(text: str) -> Optional[Tuple[str, str]]:
+    """
+    Разбирает фильтр из команды: ".ru" - суффикс, "bank" - ключевое слово.
+    Возвращает (вид, шаблон) в том виде, в каком домены хранятся в базе, или None.
+    """
+    text = text.strip().lower()
+    if text.startswith('.'):
+        labels = text.strip('.').split('.')
+        if not all(labels):
+            return None
+        try:
+            labels = [label if label.isascii() else label.encode('idna').decode('ascii') for label in labels]
+        except UnicodeError:
+            return None
+        return SUFFIX, '.' + '.'.join(labels)
+    # Домены хранятся в punycode, поэтому ключевые слова принимаются только латиницей
+    if not text or not text.isascii() or any(c.isspace() for c in text):
+        return None
+    return KEYWORD, text
+
+
+class _KeywordAutomaton:
+    """
+    Автомат Ахо-Корасик по ключевым словам всех подписчиков: за один проход
+    по домену находит всех, чьё ключевое слово в нём встречается.
+    """
+
+    def __init__(self, keywords: Dict[str, Set[int]]):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.out: List[frozenset] = [frozenset()]
+        for keyword, users in keywords.items():
+            state = 0
+            for ch in keyword:
+                nxt = self.goto[state].get(ch)
+                if nxt is None:
+                    nxt = self.goto[state][ch] = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append(frozenset())
+                state = nxt
+            self.out[state] = self.out[state] | users
+
+        # Ссылки неудачи строятся обходом в ширину; выход узла включает выходы
+        # по цепочке ссылок, чтобы при поиске не ходить по ней
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self.goto[state].items():
+                queue.append(nxt)
+                fallback = self.fail[state]
+                while fallback and ch not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[nxt] = self.goto[fallback].get(ch, 0)
+                self.out[nxt] = self.out[nxt] | self.out[self.fail[nxt]]
+
+    def match(self, text: str, result: Set[int]):
+        goto, fail, out = self.goto, self.fail, self.out
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                result |= out[state]
+
+
+class FilterIndex:
+    """
+    Фильтры всех подписчиков, собранные в общие структуры для маршрутизации изменений.
+
+    Суффиксы лежат в дереве по меткам справа налево, ключевые слова - в автомате
+    Ахо-Корасик, поэтому подписчики одного домена находятся за время,
+    пропорциональное его длине, независимо от числа пользователей и фильтров.
+    Пользователи без фильтров в индекс не попадают и получают все изменения.
+    """
+
+    def __init__(self, filters: Iterable[Tuple[int, str, str]] = ()):
+        self.users: Set[int] = set()
+        self._suffixes: dict = {}
+        keywords: Dict[str, Set[int]] = {}
+        for user_id, kind, pattern in filters:
+            self.users.add(user_id)
+            if kind == SUFFIX:
+                node = self._suffixes
+                for label in reversed(pattern.strip('.').split('.')):
+                    node = node.setdefault(label, {})
+                node.setdefault(_USERS, set()).add(user_id)
+            elif kind == KEYWORD:
+                keywords.setdefault(pattern, set()).add(user_id)
+            else:
+                logger.warning(f"Неизвестный вид фильтра {kind} у пользователя {user_id}.")
+        self._keywords = _KeywordAutomaton(keywords) if keywords else None
+
+    def match(self, domain: str) -> Set[int]:
+        """
+        Пользователи с фильтрами, которым подходит домен.
+        """
+        result: Set[int] = set()
+        node = self._suffixes
+        for label in reversed(domain.split('.')):
+            node = node.get(label)
+            if node is None:
+                break
+            users = node.get(_USERS)
+            if users:
+                result |= users
+        if self._keywords is not None:
+            self._keywords.match(domain, result)
+        return result
+
+    def route(self, domains: Iterable[str]) -> Dict[int, Set[str]]:
+        """
+        Раскладывает домены по пользователям с фильтрами.
+        """
+        result: Dict[int, Set[str]] = {}
+        for domain in domains:
+            for user_id in self.match(domain):
+                result.setdefault(user_id, set()).add(domain)
+        return result
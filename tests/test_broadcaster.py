@@ -0,0 +1,82 @@
+# test_broadcaster.py
+
+import asyncio
+from types import SimpleNamespace
+
+from pyrogram.errors import FloodWait, InternalServerError, RPCError, UserIsBlocked
+
+from broadcaster import Broadcaster
+
+
+class FakeApp:
+    """
+    Фейковый клиент Telegram: для каждого чата по очереди выбрасывает
+    заданные ошибки, затем отправляет сообщение.
+    """
+
+    def __init__(self, errors=None):
+        self.errors = {chat_id: list(items) for chat_id, items in (errors or {}).items()}
+        self.calls = []
+        self.sent = []
+
+    async def send_message(self, chat_id, text, parse_mode=None):
+        self.calls.append(chat_id)
+        pending = self.errors.get(chat_id)
+        if pending:
+            raise pending.pop(0)
+        self.sent.append(chat_id)
+        return SimpleNamespace(id=len(self.sent))
+
+
+def broadcast(app, chat_ids, on_blocked=None, max_retries=3):
+    broadcaster = Broadcaster(app, rate=1000, per_chat_interval=0, workers=4, max_retries=max_retries,
+                              on_blocked=on_blocked)
+    return asyncio.run(broadcaster.broadcast(chat_ids, "текст"))
+
+
+def test_flood_wait_requeues_message():
+    app = FakeApp({2: [FloodWait(value=1)]})
+    result = broadcast(app, [1, 2, 3])
+    assert sorted(app.sent) == [1, 2, 3]
+    assert app.calls.count(2) == 2
+    assert (result.sent, result.failed, result.flood_waits) == (3, 0, 1)
+    # Сообщение переносится на время FloodWait
+    assert result.elapsed >= 1
+
+
+def test_transient_error_is_retried():
+    app = FakeApp({1: [InternalServerError()]})
+    result = broadcast(app, [1, 2])
+    assert sorted(app.sent) == [1, 2]
+    assert app.calls.count(1) == 2
+    assert (result.sent, result.failed, result.retries) == (2, 0, 1)
+
+
+def test_transient_error_gives_up_after_max_retries():
+    app = FakeApp({1: [OSError("сеть недоступна")] * 2})
+    result = broadcast(app, [1], max_retries=1)
+    assert app.sent == []
+    assert app.calls == [1, 1]
+    assert (result.sent, result.failed, result.retries) == (0, 1, 1)
+
+
+def test_other_rpc_error_is_not_retried():
+    app = FakeApp({1: [RPCError()]})
+    result = broadcast(app, [1, 2])
+    assert app.sent == [2]
+    assert app.calls.count(1) == 1
+    assert (result.sent, result.failed, result.retries) == (1, 1, 0)
+
+
+def test_blocked_user_is_unsubscribed():
+    unsubscribed = []
+
+    async def on_blocked(chat_id):
+        unsubscribed.append(chat_id)
+
+    app = FakeApp({2: [UserIsBlocked()]})
+    result = broadcast(app, [1, 2, 3], on_blocked=on_blocked)
+    assert unsubscribed == [2]
+    assert sorted(app.sent) == [1, 3]
+    assert app.calls.count(2) == 1
+    assert (result.sent, result.failed, result.unsubscribed) == (2, 1, 1)
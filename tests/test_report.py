@@ -0,0 +1,25 @@
+# test_report.py
+
+import html
+
+from report import ReportBuilder, escape_markdown
+
+
+def test_long_line_is_not_cut_inside_entity():
+    limit = 50
+    for shift in range(10):
+        builder = ReportBuilder(limit)
+        line = "a" * shift + "_-*<&" * 20
+        builder.add(line)
+        text, = builder.build()
+        assert len(text) <= limit
+        # Обрезанная строка - начало экранированной и не содержит обрывков сущностей
+        assert escape_markdown(line).startswith(text)
+        assert line.startswith(html.unescape(text))
+
+
+def test_reserve_is_kept_for_truncated_line():
+    builder = ReportBuilder(40)
+    builder.add("x" * 100, reserve=10)
+    text, = builder.build()
+    assert text == "x" * 30
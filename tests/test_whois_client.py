@@ -0,0 +1,122 @@
+# test_whois_client.py
+
+import asyncio
+from contextlib import asynccontextmanager
+
+import pytest
+
+from whois_client import WhoisClient, WhoisRateLimitError
+from whois_scheduler import CircuitOpenError, WhoisScheduler
+
+
+class FakeWhoisServer:
+    """
+    Локальный WHOIS-сервер: отвечает на запрос функцией respond(query)
+    и запоминает полученные запросы.
+    """
+
+    def __init__(self, respond):
+        self.respond = respond
+        self.queries = []
+        self.address = None
+        self._server = None
+
+    async def _handle(self, reader, writer):
+        query = (await reader.readline()).decode('utf-8').strip()
+        self.queries.append(query)
+        writer.write(self.respond(query).encode('utf-8'))
+        await writer.drain()
+        writer.close()
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, '127.0.0.1', 0)
+        host, port = self._server.sockets[0].getsockname()[:2]
+        self.address = f"{host}:{port}"
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+
+@asynccontextmanager
+async def whois_servers(*responders):
+    servers = [FakeWhoisServer(respond) for respond in responders]
+    for server in servers:
+        await server.start()
+    try:
+        yield servers
+    finally:
+        for server in servers:
+            await server.stop()
+
+
+def test_lookup_follows_referral():
+    async def scenario():
+        async with whois_servers(lambda q: "", lambda q: "Registrant Organization: Example LLC\r\n") as (
+                registry, registrar):
+            registry.respond = lambda q: f"Domain Name: {q}\r\nRegistrar WHOIS Server: {registrar.address}\r\n"
+            client = WhoisClient(timeout=2, servers={'test': registry.address})
+            organization = await client.get_organization('example.test')
+            return organization, registry.queries, registrar.queries
+
+    organization, registry_queries, registrar_queries = asyncio.run(scenario())
+    assert organization == "Example LLC"
+    assert registry_queries == ['example.test']
+    assert registrar_queries == ['example.test']
+
+
+def test_unknown_zone_uses_iana():
+    async def scenario():
+        async with whois_servers(lambda q: "", lambda q: "org: Zone Owner\r\n") as (iana, registry):
+            iana.respond = lambda q: f"domain: {q.upper()}\r\nwhois: {registry.address}\r\n"
+            client = WhoisClient(timeout=2, iana_server=iana.address)
+            first = await client.get_organization('example.zzzz')
+            second = await client.get_organization('other.zzzz')
+            return first, second, iana.queries, registry.queries, client.servers.get('zzzz'), registry.address
+
+    first, second, iana_queries, registry_queries, remembered, registry_address = asyncio.run(scenario())
+    assert first == second == "Zone Owner"
+    # Сервер зоны запоминается после первого ответа IANA
+    assert iana_queries == ['zzzz']
+    assert registry_queries == ['example.zzzz', 'other.zzzz']
+    assert remembered == registry_address
+
+
+def test_rate_limit_halves_server_limits():
+    async def scenario():
+        async with whois_servers(lambda q: "%% Query limit exceeded, try again later\r\n") as (server,):
+            scheduler = WhoisScheduler(concurrency=8, max_concurrency=16, rate=100, total_concurrency=10,
+                                       threshold=10, cooldown=60)
+            client = WhoisClient(timeout=2, servers={'test': server.address}, scheduler=scheduler)
+            with pytest.raises(WhoisRateLimitError):
+                await client.lookup('example.test')
+            first = scheduler.stats()[server.address]
+            with pytest.raises(WhoisRateLimitError):
+                await client.lookup('example.test')
+            second = scheduler.stats()[server.address]
+            return first, second
+
+    first, second = asyncio.run(scenario())
+    assert (first['limit'], first['rate'], first['errors']) == (4, 50, 1)
+    assert (second['limit'], second['rate'], second['errors']) == (2, 25, 2)
+    assert not second['open']
+
+
+def test_breaker_opens_after_consecutive_failures():
+    async def scenario():
+        async with whois_servers(lambda q: "Too many requests\r\n") as (server,):
+            scheduler = WhoisScheduler(concurrency=4, max_concurrency=4, rate=100, total_concurrency=10,
+                                       threshold=3, cooldown=60)
+            client = WhoisClient(timeout=2, servers={'test': server.address}, scheduler=scheduler)
+            for _ in range(3):
+                with pytest.raises(WhoisRateLimitError):
+                    await client.lookup('example.test')
+            # Предохранитель сработал: сервер больше не опрашивается
+            with pytest.raises(CircuitOpenError):
+                await client.lookup('example.test')
+            return len(server.queries), scheduler.stats()[server.address]
+
+    queries, stats = asyncio.run(scenario())
+    assert queries == 3
+    assert stats['open']
+    assert stats['limit'] == 1
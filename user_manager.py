@@ -1,7 +1,10 @@
 # user_manager.py
 
 import json
+import os
+from typing import Dict, Optional, Set, Tuple
 from config import Config
+from subscriber_filters import FilterIndex
 import logging
 import aiofiles
 
@@ -9,56 +12,150 @@ logger = logging.getLogger(__name__)
 
 
 class UserManager:
-    def __init__(self, users_file: str = Config.USERS_FILE):
+    """
+    Реестр подписчиков: множество в памяти, загружаемое один раз,
+    и таблица subscribers в базе данных для сохранения изменений.
+
+    Фильтры подписчиков хранятся в таблице subscriber_filters и в памяти;
+    общий индекс для маршрутизации изменений пересобирается при первом
+    обращении после изменения фильтров.
+    """
+
+    def __init__(self, database, users_file: str = Config.USERS_FILE):
+        self.database = database
         self.users_file = users_file
+        self.users = set()
+        self.filters: Dict[int, Set[Tuple[str, str]]] = {}
+        self._index: Optional[FilterIndex] = None
 
-    async def add_user(self, user_id: int) -> bool:
+    async def load(self):
+        self.users = await self.database.get_subscribers()
+        if not self.users:
+            await self.migrate_users_file()
+        self.filters = {}
+        for user_id, kind, pattern in await self.database.get_subscriber_filters():
+            self.filters.setdefault(user_id, set()).add((kind, pattern))
+        self._index = None
+        logger.info(f"Загружено {len(self.users)} подписчиков, фильтры у {len(self.filters)}.")
+
+    async def migrate_users_file(self):
+        """
+        Однократный перенос подписчиков из users.json в базу данных.
+        После переноса файл переименовывается в users.json.migrated.
+        """
+        if not os.path.exists(self.users_file):
+            return
+        data = await self.load_users()
+        if not isinstance(data, dict) or not isinstance(data.get("users", []), list):
+            # Файл не прочитан: оставляем его на месте, чтобы не потерять подписчиков
+            logger.error(f"Подписчики из {self.users_file} не перенесены: файл не удалось прочитать. "
+                         f"Исправьте файл и перезапустите бота.")
+            return
+        users = {user_id for user_id in data.get("users", []) if isinstance(user_id, int)}
         try:
-            data = await self.load_users()
-            if user_id not in data["users"]:
-                data["users"].append(user_id)
-                await self.save_users(data)
-                logger.info(f"Пользователь {user_id} добавлен.")
-                return True
+            if users:
+                await self.database.add_subscribers(users)
+            os.replace(self.users_file, self.users_file + ".migrated")
+            self.users |= users
+            logger.info(f"Перенесено {len(users)} подписчиков из {self.users_file} в базу данных.")
+        except Exception as e:
+            logger.error(f"Ошибка при переносе подписчиков из {self.users_file}: {e}")
+
+    async def add_user(self, user_id: int) -> bool:
+        if user_id in self.users:
             logger.debug(f"Пользователь {user_id} уже существует.")
             return False
+        # Добавляем в память до записи, чтобы параллельный /start не записал пользователя дважды
+        self.users.add(user_id)
+        try:
+            await self.database.add_subscribers([user_id])
+            logger.info(f"Пользователь {user_id} добавлен.")
+            return True
         except Exception as e:
+            self.users.discard(user_id)
             logger.error(f"Ошибка при добавлении пользователя {user_id}: {e}")
             return False
 
     async def remove_user(self, user_id: int) -> bool:
-        try:
-            data = await self.load_users()
-            if user_id in data["users"]:
-                data["users"].remove(user_id)
-                await self.save_users(data)
-                logger.info(f"Пользователь {user_id} удалён.")
-                return True
+        if user_id not in self.users:
             logger.debug(f"Пользователь {user_id} не найден.")
             return False
+        self.users.discard(user_id)
+        try:
+            await self.database.remove_subscriber(user_id)
+            if self.filters.pop(user_id, None) is not None:
+                self._index = None
+            logger.info(f"Пользователь {user_id} удалён.")
+            return True
         except Exception as e:
+            self.users.add(user_id)
             logger.error(f"Ошибка при удалении пользователя {user_id}: {e}")
             return False
 
-    async def load_users(self) -> dict:
+    def get_filters(self, user_id: int) -> Set[Tuple[str, str]]:
+        return self.filters.get(user_id, set())
+
+    async def add_filter(self, user_id: int, kind: str, pattern: str) -> bool:
+        if (kind, pattern) in self.get_filters(user_id):
+            return False
+        try:
+            await self.database.add_subscriber_filter(user_id, kind, pattern)
+        except Exception as e:
+            logger.error(f"Ошибка при добавлении фильтра {pattern} пользователю {user_id}: {e}")
+            return False
+        self.filters.setdefault(user_id, set()).add((kind, pattern))
+        self._index = None
+        return True
+
+    async def remove_filter(self, user_id: int, kind: Optional[str] = None, pattern: Optional[str] = None) -> bool:
+        """
+        Удаляет фильтр пользователя или, если он не указан, все его фильтры.
+        """
+        filters = self.filters.get(user_id)
+        if not filters or (kind is not None and (kind, pattern) not in filters):
+            return False
+        try:
+            await self.database.remove_subscriber_filters(user_id, kind, pattern)
+        except Exception as e:
+            logger.error(f"Ошибка при удалении фильтров пользователя {user_id}: {e}")
+            return False
+        if kind is None:
+            filters.clear()
+        else:
+            filters.discard((kind, pattern))
+        if not filters:
+            del self.filters[user_id]
+        self._index = None
+        return True
+
+    @property
+    def filter_index(self) -> FilterIndex:
+        if self._index is None:
+            self._index = FilterIndex(
+                (user_id, kind, pattern) for user_id, filters in self.filters.items() for kind, pattern in filters
+            )
+        return self._index
+
+    def get_users(self) -> list:
+        return list(self.users)
+
+    def count(self) -> int:
+        return len(self.users)
+
+    async def load_users(self) -> Optional[dict]:
+        """
+        Содержимое файла пользователей; None - файл повреждён или не читается.
+        """
         try:
             async with aiofiles.open(self.users_file, 'r', encoding='utf-8') as f:
                 content = await f.read()
                 return json.loads(content)
         except FileNotFoundError:
-            logger.warning(f"Файл {self.users_file} не найден. Создаётся новый файл.")
+            logger.warning(f"Файл {self.users_file} не найден.")
             return {"users": []}
         except json.JSONDecodeError as e:
             logger.error(f"Ошибка декодирования JSON в файле {self.users_file}: {e}")
-            return {"users": []}
+            return None
         except Exception as e:
             logger.error(f"Ошибка при загрузке пользователей из {self.users_file}: {e}")
-            return {"users": []}
-
-    async def save_users(self, data: dict):
-        try:
-            async with aiofiles.open(self.users_file, 'w', encoding='utf-8') as f:
-                await f.write(json.dumps(data, ensure_ascii=False, indent=4))
-            logger.debug(f"Список пользователей сохранён в {self.users_file}.")
-        except Exception as e:
-            logger.error(f"Ошибка при сохранении пользователей в {self.users_file}: {e}")
+            return None
@@ -0,0 +1,62 @@
+# whois_cache.py
+
+import time
+from collections import OrderedDict
+from typing import Dict, NamedTuple, Optional
+
+
+class CacheEntry(NamedTuple):
+    organization: Optional[str]  # None - отрицательный результат (ошибка или организация не найдена)
+    expires_at: float
+    failures: int = 0
+
+
+class TTLCache:
+    """
+    LRU-кэш в памяти процесса с ограниченным временем жизни записей.
+
+    Считает попадания, промахи, вытеснения по размеру и устаревшие записи,
+    чтобы по счётчикам можно было подобрать размер кэша.
+    """
+
+    def __init__(self, maxsize: int = 10000):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: str, now: Optional[float] = None) -> Optional[CacheEntry]:
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry.expires_at <= (now if now is not None else time.time()):
+            del self._data[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def set(self, key: str, entry: CacheEntry):
+        self._data[key] = entry
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
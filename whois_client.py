@@ -0,0 +1,269 @@
+# whois_client.py
+
+import asyncio
+import logging
+import re
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+WHOIS_PORT = 43
+IANA_SERVER = 'whois.iana.org'
+MAX_RESPONSE_SIZE = 1024 * 1024  # Ответы WHOIS больше мегабайта не читаем
+MAX_REFERRALS = 2  # IANA -> реестр -> регистратор
+
+# WHOIS-серверы реестров для популярных зон; остальные определяются через IANA
+TLD_SERVERS: Dict[str, str] = {
+    'com': 'whois.verisign-grs.com',
+    'net': 'whois.verisign-grs.com',
+    'org': 'whois.pir.org',
+    'info': 'whois.nic.info',
+    'biz': 'whois.nic.biz',
+    'ru': 'whois.tcinet.ru',
+    'su': 'whois.tcinet.ru',
+    'xn--p1ai': 'whois.tcinet.ru',
+    'ua': 'whois.ua',
+    'by': 'whois.cctld.by',
+    'kz': 'whois.nic.kz',
+    'io': 'whois.nic.io',
+    'me': 'whois.nic.me',
+    'co': 'whois.nic.co',
+    'us': 'whois.nic.us',
+    'tv': 'whois.nic.tv',
+    'cc': 'ccwhois.verisign-grs.com',
+    'xyz': 'whois.nic.xyz',
+    'online': 'whois.nic.online',
+    'app': 'whois.nic.google',
+    'dev': 'whois.nic.google',
+    'uk': 'whois.nic.uk',
+    'de': 'whois.denic.de',
+    'fr': 'whois.nic.fr',
+    'nl': 'whois.domain-registry.nl',
+    'eu': 'whois.eu',
+    'pl': 'whois.dns.pl',
+    'it': 'whois.nic.it',
+    'ch': 'whois.nic.ch',
+    'se': 'whois.iis.se',
+    'jp': 'whois.jprs.jp',
+    'cn': 'whois.cnnic.cn',
+    'in': 'whois.registry.in',
+    'ca': 'whois.cira.ca',
+}
+
+# Серверы, которые ждут запрос в особом формате
+QUERY_FORMATS: Dict[str, str] = {
+    'whois.verisign-grs.com': '={domain}',
+    'ccwhois.verisign-grs.com': '={domain}',
+    'whois.denic.de': '-T dn,ace {domain}',
+}
+
+REFERRAL_RE = re.compile(
+    r'^\s*(?:registrar whois server|whois server|whois|refer|referralserver)\s*:\s*(\S+)',
+    re.IGNORECASE | re.MULTILINE
+)
+
+# Поля с названием организации в порядке предпочтения
+ORGANIZATION_FIELDS = (
+    'registrant organization',
+    'registrant organisation',
+    'org',
+    'organization',
+    'organisation',
+    'orgname',
+    'org-name',
+    'registrant',
+    'owner',
+    'registrant name',
+)
+
+NOT_FOUND_MARKERS = ('no match', 'not found', 'no entries found', 'no data found', 'no object found')
+RATE_LIMIT_MARKERS = ('limit exceeded', 'exceeded the query limit', 'too many requests', 'quota exceeded',
+                      'try again later')
+
+
+class WhoisError(Exception):
+    pass
+
+
+class WhoisRateLimitError(WhoisError):
+    pass
+
+
+def parse_referral(text: str) -> Optional[str]:
+    """
+    Ищет в ответе ссылку на следующий WHOIS-сервер.
+    """
+    for match in REFERRAL_RE.finditer(text):
+        server = match.group(1).strip().lower()
+        if server.startswith('whois://'):
+            server = server[len('whois://'):]
+        server = server.rstrip('/')
+        # Ссылки на веб-интерфейсы и пустые значения пропускаем
+        if server and '://' not in server and '.' in server:
+            return server
+    return None
+
+
+def parse_fields(text: str) -> Dict[str, List[str]]:
+    """
+    Разбирает ответ WHOIS на пары "ключ: значение".
+
+    Пустое значение с последующей строкой с отступом (формат .uk)
+    трактуется как значение на следующей строке.
+    """
+    fields: Dict[str, List[str]] = {}
+    pending_key = None
+    for raw_line in text.splitlines():
+        line = raw_line.strip()
+        if not line or line.startswith(('%', '#', '>>>')):
+            pending_key = None
+            continue
+        if pending_key and raw_line[:1].isspace() and ':' not in line:
+            fields.setdefault(pending_key, []).append(line)
+            pending_key = None
+            continue
+        key, sep, value = line.partition(':')
+        if not sep:
+            continue
+        key = key.strip().lower()
+        value = value.strip()
+        if value:
+            fields.setdefault(key, []).append(value)
+            pending_key = None
+        else:
+            pending_key = key
+    return fields
+
+
+def parse_organization(text: str) -> Optional[str]:
+    """
+    Извлекает название организации-владельца из ответа WHOIS.
+    """
+    fields = parse_fields(text)
+    for name in ORGANIZATION_FIELDS:
+        values = [value for value in fields.get(name, []) if not value.upper().startswith('REDACTED')]
+        if values:
+            # Объединяем несколько значений в строку через запятую, без повторов
+            return ", ".join(dict.fromkeys(values))
+    return None
+
+
+def is_rate_limited(text: str) -> bool:
+    head = text[:512].lower()
+    return any(marker in head for marker in RATE_LIMIT_MARKERS)
+
+
+def is_not_found(text: str) -> bool:
+    head = text[:2048].lower()
+    return any(marker in head for marker in NOT_FOUND_MARKERS)
+
+
+class WhoisClient:
+    """
+    Асинхронный клиент протокола WHOIS (RFC 3912, порт 43) без потоков.
+
+    Определяет сервер реестра по зоне (по таблице или через IANA),
+    следует ссылкам на серверы регистраторов и прерывает запрос
+    по таймауту вместе с соединением.
+
+    :param timeout: Таймаут одного запроса к серверу в секундах
+    :param servers: Дополнительные соответствия зоны и сервера ("host" или "host:port")
+    :param iana_server: Сервер для определения WHOIS-сервера неизвестной зоны
+    :param scheduler: Планировщик с лимитами по серверам (WhoisScheduler)
+    """
+
+    def __init__(self, timeout: float = 10, servers: Optional[Dict[str, str]] = None,
+                 iana_server: str = IANA_SERVER, port: int = WHOIS_PORT, scheduler=None):
+        self.timeout = timeout
+        self.scheduler = scheduler
+        self.servers = dict(TLD_SERVERS)
+        if servers:
+            self.servers.update(servers)
+        self.iana_server = iana_server
+        self.port = port
+
+    async def get_organization(self, domain: str) -> Optional[str]:
+        """
+        Возвращает организацию-владельца домена или None, если она не указана.
+        """
+        text = await self.lookup(domain)
+        if is_not_found(text):
+            return None
+        return parse_organization(text)
+
+    async def lookup(self, domain: str) -> str:
+        """
+        Возвращает наиболее подробный ответ WHOIS для домена:
+        ответ регистратора, если реестр на него сослался, иначе ответ реестра.
+        """
+        server = await self.server_for(domain)
+        text = await self.query(server, domain)
+        visited = {server}
+        for _ in range(MAX_REFERRALS):
+            referral = parse_referral(text)
+            if not referral or referral in visited:
+                break
+            visited.add(referral)
+            try:
+                referred = await self.query(referral, domain)
+            except (OSError, asyncio.TimeoutError, WhoisError) as e:
+                # Сервер регистратора недоступен - остаёмся с ответом реестра
+                logger.debug(f"WHOIS-сервер {referral} недоступен для {domain}: {e}")
+                break
+            if referred.strip():
+                text = referred
+        return text
+
+    async def server_for(self, domain: str) -> str:
+        tld = domain.rstrip('.').rsplit('.', 1)[-1].lower()
+        server = self.servers.get(tld)
+        if server:
+            return server
+        # Неизвестная зона: спрашиваем IANA и запоминаем ответ
+        text = await self.query(self.iana_server, tld)
+        server = parse_referral(text)
+        if not server:
+            raise WhoisError(f"WHOIS-сервер для зоны .{tld} не найден")
+        self.servers[tld] = server
+        logger.debug(f"WHOIS-сервер для зоны .{tld}: {server}")
+        return server
+
+    async def query(self, server: str, domain: str) -> str:
+        """
+        Отправляет один запрос на WHOIS-сервер. При таймауте соединение закрывается.
+        """
+        query = QUERY_FORMATS.get(server, '{domain}').format(domain=domain)
+        if self.scheduler is None:
+            return await self._timed_query(server, query)
+        # Ожидание в очереди сервера не входит в таймаут самого запроса
+        return await self.scheduler.run(server, lambda: self._timed_query(server, query))
+
+    async def _timed_query(self, server: str, query: str) -> str:
+        text = await asyncio.wait_for(self._query(server, query), timeout=self.timeout)
+        if is_rate_limited(text):
+            raise WhoisRateLimitError(f"WHOIS-сервер {server} ограничил частоту запросов")
+        return text
+
+    def _address(self, server: str) -> Tuple[str, int]:
+        host, sep, port = server.rpartition(':')
+        if sep and port.isdigit():
+            return host, int(port)
+        return server, self.port
+
+    async def _query(self, server: str, query: str) -> str:
+        host, port = self._address(server)
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            writer.write(query.encode('utf-8') + b'\r\n')
+            await writer.drain()
+            chunks = []
+            size = 0
+            while size < MAX_RESPONSE_SIZE:
+                chunk = await reader.read(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                size += len(chunk)
+        finally:
+            writer.close()
+        return b''.join(chunks).decode('utf-8', errors='replace')
@@ -0,0 +1,53 @@
+# whois_queue.py
+
+import asyncio
+import logging
+from typing import Dict, Iterable, Optional
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+
+class WhoisQueue:
+    """
+    Сторона бота в очереди WHOIS-заданий.
+
+    Промахи кэша ставятся в таблицу whois_jobs одной пачкой, запросы выполняют
+    отдельные процессы (whois_worker.py), а бот только ждёт, пока пачка
+    не будет выполнена целиком, и забирает результаты. Разбор ответов
+    WHOIS и сетевой ввод-вывод не занимают процесс, который обрабатывает команды.
+    """
+
+    def __init__(self, database, poll_interval: float = Config.WHOIS_QUEUE_POLL):
+        self.database = database
+        self.poll_interval = poll_interval
+
+    async def clear(self):
+        """
+        Удаляет пачки прошлого запуска бота: их результатов больше никто не ждёт.
+        """
+        await self.database.delete_whois_jobs()
+
+    async def resolve(self, domains: Iterable[str]) -> Dict[str, Optional[str]]:
+        """
+        Организации доменов через очередь; None - определить не удалось.
+        """
+        domains = list(domains)
+        if not domains:
+            return {}
+        batch_id = await self.database.enqueue_whois_jobs(domains)
+        logger.debug(f"В очередь WHOIS поставлена пачка {batch_id}: {len(domains)} доменов.")
+        try:
+            while await self.database.count_pending_whois_jobs(batch_id):
+                await asyncio.sleep(self.poll_interval)
+            return await self.database.pop_whois_results(batch_id)
+        except asyncio.CancelledError:
+            await asyncio.shield(self.database.delete_whois_jobs(batch_id))
+            raise
+
+    async def stats(self) -> Dict[str, int]:
+        try:
+            return await self.database.get_whois_queue_stats()
+        except Exception as e:
+            logger.error(f"Ошибка при получении состояния очереди WHOIS: {e}")
+            return {}
@@ -0,0 +1,175 @@
+# whois_scheduler.py
+
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, TypeVar
+
+from config import Config
+from metrics import WHOIS_QUEUE_DEPTH, WHOIS_SERVER_REQUESTS
+from ratelimit import TokenBucket
+from whois_client import WhoisError, WhoisRateLimitError
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+# Ошибки, которые говорят о проблемах самого сервера, а не о конкретном домене
+SERVER_ERRORS = (OSError, asyncio.TimeoutError, WhoisRateLimitError)
+
+
+class CircuitOpenError(WhoisError):
+    pass
+
+
+class ServerLimiter:
+    """
+    Ограничения для одного WHOIS-сервера.
+
+    Число одновременных запросов и скорость меняются по схеме AIMD:
+    растут на единицу/10% после серии быстрых успешных ответов и
+    уменьшаются вдвое при ошибке. После threshold ошибок подряд
+    срабатывает предохранитель: сервер не опрашивается cooldown секунд,
+    при повторных срабатываниях пауза удваивается.
+    """
+
+    def __init__(self, server: str, concurrency: int, max_concurrency: int, rate: float,
+                 threshold: int, cooldown: float, latency_target: float):
+        self.server = server
+        self.limit = concurrency
+        self.max_concurrency = max_concurrency
+        self.max_rate = rate
+        self.bucket = TokenBucket(rate)
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.latency_target = latency_target
+        self.active = 0
+        self.waiting = 0
+        self._slot = asyncio.Condition()
+        self.consecutive_failures = 0
+        self.trips = 0
+        self.open_until = 0.0
+        self._streak = 0
+        # Счётчики для статистики
+        self.requests = 0
+        self.errors = 0
+        self.latency = 0.0  # Экспоненциальное среднее времени ответа
+
+    @property
+    def is_open(self) -> bool:
+        return time.monotonic() < self.open_until
+
+    async def run(self, factory: Callable[[], Awaitable[T]], global_slots: asyncio.Semaphore) -> T:
+        if self.is_open:
+            raise CircuitOpenError(f"WHOIS-сервер {self.server} временно отключён после ошибок")
+
+        self.waiting += 1
+        try:
+            async with self._slot:
+                await self._slot.wait_for(lambda: self.active < self.limit)
+                self.active += 1
+        finally:
+            self.waiting -= 1
+
+        try:
+            # Общий лимит берём только после слота сервера, чтобы очередь
+            # к одному медленному реестру не занимала слоты остальных
+            async with global_slots:
+                if self.is_open:
+                    raise CircuitOpenError(f"WHOIS-сервер {self.server} временно отключён после ошибок")
+                await self.bucket.acquire()
+                self.requests += 1
+                started = time.monotonic()
+                try:
+                    result = await factory()
+                except SERVER_ERRORS:
+                    WHOIS_SERVER_REQUESTS.inc(server=self.server, outcome='error')
+                    self._on_failure()
+                    raise
+                WHOIS_SERVER_REQUESTS.inc(server=self.server, outcome='ok')
+                self._on_success(time.monotonic() - started)
+                return result
+        finally:
+            async with self._slot:
+                self.active -= 1
+                self._slot.notify_all()
+
+    def _on_success(self, latency: float):
+        self.latency = latency if not self.latency else 0.8 * self.latency + 0.2 * latency
+        self.consecutive_failures = 0
+        self.trips = 0
+        if latency > self.latency_target:
+            self._streak = 0
+            return
+        self._streak += 1
+        if self._streak >= self.limit:
+            self._streak = 0
+            self.limit = min(self.limit + 1, self.max_concurrency)
+            self.bucket.rate = min(self.bucket.rate * 1.1, self.max_rate)
+
+    def _on_failure(self):
+        self.errors += 1
+        self._streak = 0
+        self.consecutive_failures += 1
+        self.limit = max(1, self.limit // 2)
+        self.bucket.rate = max(self.max_rate / 16, self.bucket.rate / 2)
+        if self.consecutive_failures >= self.threshold and not self.is_open:
+            self.trips += 1
+            pause = min(self.cooldown * 2 ** (self.trips - 1), Config.WHOIS_BREAKER_COOLDOWN_MAX)
+            self.open_until = time.monotonic() + pause
+            logger.warning(f"WHOIS-сервер {self.server} отключён на {pause:.0f} с после "
+                           f"{self.consecutive_failures} ошибок подряд.")
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "limit": self.limit,
+            "rate": round(self.bucket.rate, 3),
+            "active": self.active,
+            "waiting": self.waiting,
+            "requests": self.requests,
+            "errors": self.errors,
+            "latency": round(self.latency, 3),
+            "open": self.is_open,
+        }
+
+
+class WhoisScheduler:
+    """
+    Распределяет WHOIS-запросы по серверам: у каждого сервера свои
+    лимиты параллельности и скорости и свой предохранитель, поэтому
+    всплеск доменов одной зоны не тормозит запросы к остальным реестрам.
+    """
+
+    def __init__(self, concurrency: int = Config.WHOIS_SERVER_CONCURRENCY,
+                 max_concurrency: int = Config.WHOIS_SERVER_MAX_CONCURRENCY,
+                 rate: float = Config.WHOIS_SERVER_RATE,
+                 total_concurrency: int = Config.WHOIS_MAX_CONCURRENCY,
+                 threshold: int = Config.WHOIS_BREAKER_THRESHOLD,
+                 cooldown: float = Config.WHOIS_BREAKER_COOLDOWN,
+                 latency_target: float = 2.0):
+        self.concurrency = concurrency
+        self.max_concurrency = max_concurrency
+        self.rate = rate
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.latency_target = latency_target
+        self._global_slots = asyncio.Semaphore(total_concurrency)
+        self._servers: Dict[str, ServerLimiter] = {}
+        WHOIS_QUEUE_DEPTH.func = self._queue_depths
+
+    def limiter(self, server: str) -> ServerLimiter:
+        limiter = self._servers.get(server)
+        if limiter is None:
+            limiter = ServerLimiter(server, self.concurrency, self.max_concurrency, self.rate,
+                                    self.threshold, self.cooldown, self.latency_target)
+            self._servers[server] = limiter
+        return limiter
+
+    async def run(self, server: str, factory: Callable[[], Awaitable[T]]) -> T:
+        return await self.limiter(server).run(factory, self._global_slots)
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        return {server: limiter.stats() for server, limiter in self._servers.items()}
+
+    def _queue_depths(self):
+        return {(('server', server),): limiter.waiting for server, limiter in self._servers.items()}
@@ -1,61 +1,212 @@
 # whois_service.py
 
-import whois
 import asyncio
-from functools import lru_cache
+import random
+import time
 from config import Config
 import logging
-from tenacity import retry, stop_after_attempt, wait_fixed
+from typing import Dict, Iterable, List, Optional, Tuple
+from metrics import WHOIS_CACHE, WHOIS_IN_FLIGHT, WHOIS_LOOKUP_SECONDS
+from public_suffix import PublicSuffixList, get_public_suffix_list
+from whois_cache import CacheEntry, TTLCache
+from whois_client import WhoisClient
+from whois_queue import WhoisQueue
+from whois_scheduler import SERVER_ERRORS, CircuitOpenError, WhoisScheduler
 
 logger = logging.getLogger(__name__)
 
+UNKNOWN = "Неизвестно"
+RETRY_ATTEMPTS = 3
+RETRY_DELAY = 2  # в секундах
+
 
 class WhoisService:
-    def __init__(self, timeout=Config.WHOIS_TIMEOUT, database=None):
+    def __init__(self, timeout=Config.WHOIS_TIMEOUT, database=None, client: Optional[WhoisClient] = None,
+                 public_suffixes: Optional[PublicSuffixList] = None, queue: Optional[WhoisQueue] = None):
         self.timeout = timeout
         self.database = database
+        # С очередью запросы выполняют процессы whois_worker.py, а здесь остаются кэш и группировка
+        self.queue = queue
+        if client is None:
+            client = WhoisClient(timeout=timeout, scheduler=WhoisScheduler())
+        self.client = client
+        self.scheduler = client.scheduler
+        self.public_suffixes = public_suffixes or get_public_suffix_list()
+        self.memory_cache = TTLCache(Config.WHOIS_MEMORY_CACHE_SIZE)
+        self._in_flight: Dict[str, asyncio.Future] = {}
+        # Счётчики для подбора размеров кэша
+        self.db_hits = 0
+        self.lookups = 0
+        self.coalesced = 0
+        self.grouped = 0  # Доменов, получивших результат запроса к общему родительскому домену
 
-    @retry(stop=stop_after_attempt(3), wait=wait_fixed(2))
-    @lru_cache(maxsize=1000)
-    def get_company_name(self, domain: str) -> str:
-        try:
-            w = whois.whois(domain)
-            organization = w.org or w.organization or w.name
-
-            if isinstance(organization, list):
-                # Объединяем список в строку через запятую
-                organization = ", ".join([str(item).strip() for item in organization if isinstance(item, str)])
-            elif isinstance(organization, str):
-                organization = organization.strip()
+    async def get_company_name_async(self, domain: str) -> str:
+        companies = await self.get_company_names_async([domain])
+        return companies[domain]
+
+    def whois_key(self, domain: str) -> str:
+        """
+        Домен, по которому делается WHOIS-запрос: регистрируемый родитель (eTLD+1).
+        WHOIS отвечает только за него, поэтому все поддомены получают его результат.
+        """
+        return self.public_suffixes.registrable_domain(domain) or domain
+
+    async def get_company_names_async(self, domains: Iterable[str]) -> Dict[str, str]:
+        """
+        Определяет организации для набора доменов.
+
+        Домены группируются по регистрируемому родителю: WHOIS-запрос и запись
+        в кэше делаются один раз на родителя, результат раздаётся всем его
+        поддоменам.
+        """
+        keys = {domain: self.whois_key(domain) for domain in set(domains)}
+        companies = await self._get_companies(set(keys.values()))
+        self.grouped += len(keys) - len(companies)
+        return {domain: companies[key] for domain, key in keys.items()}
+
+    async def _get_companies(self, domains: Iterable[str]) -> Dict[str, str]:
+        """
+        Определяет организации для набора регистрируемых доменов за один проход.
+
+        Порядок поиска: кэш в памяти, затем кэш в SQLite одним пакетным
+        запросом, затем WHOIS-запросы только для промахов. Параллельность
+        запросов ограничивает планировщик отдельно для каждого сервера.
+        Одновременные запросы одного домена объединяются в один.
+        Новые результаты сохраняются в SQLite одной транзакцией.
+        """
+        now = time.time()
+        companies = {}
+        pending = []
+        for domain in domains:
+            entry = self.memory_cache.get(domain, now)
+            if entry is not None:
+                companies[domain] = entry.organization or UNKNOWN
             else:
-                organization = "Неизвестно"
+                pending.append(domain)
+        memory_hits = len(companies)
+        WHOIS_CACHE.inc(memory_hits, result='memory_hit')
+
+        previous_failures = {}
+        if pending and self.database:
+            stored = await self.database.get_whois_entries(pending)
+            misses = []
+            for domain in pending:
+                entry = stored.get(domain)
+                if entry is not None and entry.expires_at > now:
+                    self.db_hits += 1
+                    self.memory_cache.set(domain, entry)
+                    companies[domain] = entry.organization or UNKNOWN
+                else:
+                    if entry is not None:
+                        previous_failures[domain] = entry.failures
+                    misses.append(domain)
+            pending = misses
+        WHOIS_CACHE.inc(len(companies) - memory_hits, result='db_hit')
+        WHOIS_CACHE.inc(len(pending), result='miss')
+        logger.debug(f"WHOIS: {len(companies)} доменов из кэша, {len(pending)} требуют запроса.")
+
+        if self.queue is not None:
+            results = await self._lookup_queued(pending, previous_failures)
+        else:
+            results = await asyncio.gather(*(
+                self._lookup_coalesced(domain, previous_failures.get(domain, 0)) for domain in pending
+            ))
 
-            return organization if organization else "Неизвестно"
+        new_entries = {}
+        for domain, (entry, owner) in zip(pending, results):
+            companies[domain] = entry.organization or UNKNOWN
+            if owner:
+                new_entries[domain] = entry
+        if self.database and new_entries:
+            await self.database.store_whois_entries(new_entries)
+        return companies
+
+    async def _lookup_coalesced(self, domain: str, failures: int) -> Tuple[CacheEntry, bool]:
+        # Если этот домен уже запрашивается, ждём тот же результат, а не шлём второй запрос.
+        # Второй элемент кортежа - признак того, что запрос выполнила именно эта задача.
+        future = self._in_flight.get(domain)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future), False
+
+        future = asyncio.get_event_loop().create_future()
+        self._in_flight[domain] = future
+        try:
+            organization = await self._resolve(domain)
+            entry = self._make_entry(organization, failures)
+            self.memory_cache.set(domain, entry)
+            future.set_result(entry)
+            return entry, True
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
         except Exception as e:
-            logger.error(f"Ошибка при получении WHOIS для домена {domain}: {e}")
-            raise e  # Повторная попытка
+            future.set_exception(e)
+            # Исключение уже получено этой задачей; помечаем его как обработанное для ожидающих
+            future.exception()
+            raise
+        finally:
+            del self._in_flight[domain]
 
-    async def get_company_name_async(self, domain: str) -> str:
-        loop = asyncio.get_event_loop()
+    async def _lookup_queued(self, domains: List[str], previous_failures: Dict[str, int]) -> List[Tuple[CacheEntry, bool]]:
+        # Кэш в SQLite пополняют сами процессы, выполнившие запросы, поэтому здесь
+        # результаты попадают только в кэш в памяти
+        self.lookups += len(domains)
+        organizations = await self.queue.resolve(domains)
+        results = []
+        for domain in domains:
+            entry = self._make_entry(organizations.get(domain), previous_failures.get(domain, 0))
+            self.memory_cache.set(domain, entry)
+            results.append((entry, False))
+        return results
+
+    @staticmethod
+    def _make_entry(organization: Optional[str], failures: int) -> CacheEntry:
+        now = time.time()
+        if organization:
+            return CacheEntry(organization, now + Config.WHOIS_CACHE_TTL, 0)
+        # Отрицательный результат: короткий TTL, удваивающийся с каждой неудачей подряд
+        ttl = min(Config.WHOIS_NEGATIVE_TTL * 2 ** failures, Config.WHOIS_NEGATIVE_TTL_MAX)
+        return CacheEntry(None, now + ttl, failures + 1)
+
+    async def _resolve(self, domain: str) -> Optional[str]:
+        # Выполнить WHOIS-запрос, минуя кэш. None - организацию определить не удалось.
+        # Таймаут действует на каждый запрос к серверу и прерывает его вместе с соединением;
+        # ожидание в очереди планировщика в таймаут не входит.
+        self.lookups += 1
+        WHOIS_IN_FLIGHT.inc()
         try:
-            # Попытка получить данные из кэша
-            if self.database:
-                cached = await self.database.get_cached_whois(domain)
-                if cached:
-                    logger.debug(f"Данные WHOIS для {domain} получены из кэша.")
-                    return cached
-
-            # Если нет в кэше, выполнить WHOIS-запрос с таймаутом
-            company = await asyncio.wait_for(
-                loop.run_in_executor(None, self.get_company_name, domain),
-                timeout=Config.WHOIS_TIMEOUT
-            )
-            if self.database and company != "Неизвестно":
-                await self.database.cache_whois(domain, company)
-            return company
+            with WHOIS_LOOKUP_SECONDS.time():
+                return await self._resolve_with_retries(domain)
         except asyncio.TimeoutError:
             logger.error(f"Таймаут при получении WHOIS для домена {domain[:min(len(domain), 50)]}.")
-            return "Неизвестно"
+            return None
+        except CircuitOpenError as e:
+            logger.debug(f"WHOIS для домена {domain[:min(len(domain), 50)]} пропущен: {e}")
+            return None
         except Exception as e:
             logger.error(f"Не удалось получить название компании для домена {domain[:min(len(domain), 50)]} после повторных попыток: {e}")
-            return "Неизвестно"
+            return None
+        finally:
+            WHOIS_IN_FLIGHT.dec()
+
+    async def _resolve_with_retries(self, domain: str) -> Optional[str]:
+        for attempt in range(1, RETRY_ATTEMPTS + 1):
+            try:
+                return await self.client.get_organization(domain)
+            except SERVER_ERRORS as e:
+                if attempt == RETRY_ATTEMPTS:
+                    raise
+                # Экспоненциальная пауза со случайным разбросом; сервер, который
+                # продолжает отказывать, отключит предохранитель планировщика
+                delay = RETRY_DELAY * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+                logger.debug(f"Ошибка WHOIS для домена {domain} (попытка {attempt}): {e}")
+                await asyncio.sleep(delay)
+
+    def server_stats(self) -> Dict[str, Dict[str, float]]:
+        return self.scheduler.stats() if self.scheduler is not None else {}
+
+    def cache_stats(self) -> Dict[str, int]:
+        stats = {f"memory_{key}": value for key, value in self.memory_cache.stats().items()}
+        stats.update(db_hits=self.db_hits, lookups=self.lookups, coalesced=self.coalesced, grouped=self.grouped)
+        return stats
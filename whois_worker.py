@@ -0,0 +1,188 @@
+# whois_worker.py
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+from typing import Dict, List, Optional, Tuple
+from config import Config
+from database import Database
+from whois_client import WhoisClient
+from whois_scheduler import WhoisScheduler
+from whois_service import UNKNOWN, WhoisService
+
+logger = logging.getLogger(__name__)
+
+
+def shared_scheduler(workers: int) -> WhoisScheduler:
+    """
+    Планировщик процесса, получающего свою долю общих лимитов: вместе
+    workers процессов нагружают каждый WHOIS-сервер не сильнее, чем один бот.
+    """
+    workers = max(1, workers)
+    return WhoisScheduler(
+        concurrency=max(1, Config.WHOIS_SERVER_CONCURRENCY // workers),
+        max_concurrency=max(1, Config.WHOIS_SERVER_MAX_CONCURRENCY // workers),
+        rate=Config.WHOIS_SERVER_RATE / workers,
+        total_concurrency=max(1, Config.WHOIS_MAX_CONCURRENCY // workers),
+    )
+
+
+class WhoisWorker:
+    """
+    Процесс, выполняющий WHOIS-задания из очереди в базе.
+
+    Задания берутся пачками в аренду; пока пачка выполняется, аренда
+    продлевается. Если процесс упадёт, аренда истечёт и задания возьмёт
+    другой процесс. Результаты записываются в очередь и в кэш WHOIS
+    одной транзакцией на пачку.
+    """
+
+    def __init__(self, database: Database, service: WhoisService, owner: Optional[str] = None,
+                 batch_size: int = Config.WHOIS_WORKER_BATCH,
+                 visibility: float = Config.WHOIS_JOB_VISIBILITY,
+                 max_attempts: int = Config.WHOIS_JOB_MAX_ATTEMPTS,
+                 poll_interval: float = Config.WHOIS_QUEUE_POLL):
+        self.database = database
+        self.service = service
+        # Имя владельца аренды уникально и между машинами, которые делят очередь
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}"
+        self.batch_size = batch_size
+        self.visibility = visibility
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.completed = 0
+
+    async def run(self):
+        try:
+            while True:
+                try:
+                    jobs = await self.database.claim_whois_jobs(
+                        self.owner, self.batch_size, self.visibility, self.max_attempts
+                    )
+                except Exception as e:
+                    logger.error(f"Ошибка при получении заданий WHOIS: {e}")
+                    jobs = []
+                if not jobs:
+                    await asyncio.sleep(self.poll_interval)
+                    continue
+                await self._process(jobs)
+        finally:
+            # Невыполненные задания сразу возвращаются в очередь, не дожидаясь конца аренды
+            await asyncio.shield(self._release())
+
+    async def _process(self, jobs: List[Tuple[int, str]]):
+        heartbeat = asyncio.ensure_future(self._heartbeat([job_id for job_id, _ in jobs]))
+        try:
+            companies = await self.service.get_company_names_async(domain for _, domain in jobs)
+        finally:
+            heartbeat.cancel()
+        results: Dict[int, Optional[str]] = {}
+        for job_id, domain in jobs:
+            organization = companies.get(domain, UNKNOWN)
+            results[job_id] = None if organization == UNKNOWN else organization
+        try:
+            await self.database.complete_whois_jobs(self.owner, results)
+            self.completed += len(results)
+            logger.debug(f"Процесс {self.owner} выполнил {len(results)} заданий WHOIS.")
+        except Exception as e:
+            # Аренда истечёт, и задания выполнит другой процесс
+            logger.error(f"Ошибка при записи результатов WHOIS: {e}")
+
+    async def _heartbeat(self, job_ids: List[int]):
+        while True:
+            await asyncio.sleep(self.visibility / 3)
+            try:
+                await self.database.extend_whois_leases(self.owner, job_ids, self.visibility)
+            except Exception as e:
+                logger.error(f"Ошибка при продлении аренды заданий WHOIS: {e}")
+
+    async def _release(self):
+        try:
+            await self.database.release_whois_jobs(self.owner)
+        except Exception as e:
+            logger.error(f"Ошибка при возврате заданий WHOIS в очередь: {e}")
+
+
+async def serve(workers: int):
+    database = Database()
+    await database.connect()
+    service = WhoisService(database=database, client=WhoisClient(timeout=Config.WHOIS_TIMEOUT,
+                                                                 scheduler=shared_scheduler(workers)))
+    worker = WhoisWorker(database, service)
+    task = asyncio.ensure_future(worker.run())
+    loop = asyncio.get_event_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, task.cancel)
+    logger.info(f"Процесс WHOIS {worker.owner} запущен.")
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    finally:
+        await database.close()
+        logger.info(f"Процесс WHOIS {worker.owner} остановлен, выполнено заданий: {worker.completed}.")
+
+
+def run_process(workers: int):
+    logging.basicConfig(
+        filename='bot.log',
+        filemode='a',
+        format='%(asctime)s - %(processName)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO,
+        force=True  # При запуске из бота настройка main.py уже применена при импорте
+    )
+    asyncio.run(serve(workers))
+
+
+class WorkerPool:
+    """
+    Локальные процессы WHOIS, запущенные ботом. Упавший процесс перезапускается
+    при очередной проверке, его задания забирают остальные по истечении аренды.
+    """
+
+    def __init__(self, count: int = Config.WHOIS_WORKERS):
+        self.count = count
+        # spawn: дочерний процесс не наследует цикл событий и соединения бота
+        self._context = multiprocessing.get_context('spawn')
+        self.processes: List[Optional[multiprocessing.Process]] = [None] * count
+        self.restarts = 0
+
+    def _spawn(self, index: int):
+        process = self._context.Process(
+            target=run_process, args=(self.count,), name=f"whois-worker-{index}", daemon=True
+        )
+        process.start()
+        self.processes[index] = process
+
+    def start(self):
+        for index in range(self.count):
+            self._spawn(index)
+        logger.info(f"Запущено процессов WHOIS: {self.count}.")
+
+    def check(self):
+        for index, process in enumerate(self.processes):
+            if process is not None and not process.is_alive():
+                logger.warning(f"Процесс {process.name} завершился с кодом {process.exitcode}, перезапуск.")
+                self.restarts += 1
+                self._spawn(index)
+
+    def alive(self) -> int:
+        return sum(1 for process in self.processes if process is not None and process.is_alive())
+
+    def stop(self, timeout: float = 10):
+        for process in self.processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            if process is not None:
+                process.join(timeout)
+        self.processes = [None] * self.count
+        logger.info("Процессы WHOIS остановлены.")
+
+
+if __name__ == '__main__':
+    # Отдельный запуск, например на другой машине: доля лимитов считается по WHOIS_WORKERS
+    run_process(Config.WHOIS_WORKERS or 1)